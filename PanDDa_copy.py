@@ -1,10 +1,23 @@
 import os
 import shutil
 
+import results_db
+
+try:
+    import mtz_file
+except ImportError:  # NumPy not available: MTZ files are copied unchecked
+    mtz_file = None
+
 # Define the base paths
 base_path = "/Data/1TB_SSD/X-ray/p97/Covalent/CPS6191_jun_2023"
 panDDA_run_path = os.path.join(base_path, "PanDDA_run")
 dimple_file_path = "dimple_results_filtered.dat"
+# Results database of crystal_pipeline.py. If it exists, the files are looked up
+# there instead of walking each dataset folder.
+results_db_path = os.path.join(base_path, "results.sqlite")
+use_db = os.path.isfile(results_db_path)
+# Quick-look folders of crystal_pipeline.py (QUICK_LOOK_DIR) hold partial data: never copied
+quick_look_dir = "quick_look"
 
 # Create the PanDDA_run directory if it doesn't exist
 if not os.path.exists(panDDA_run_path):
@@ -34,7 +47,15 @@ with open(dimple_file_path, 'r') as f:
         final_mtz_src = None
         final_pdb_src = None
         files_exist = False
-        for root, dirs, files in os.walk(folder_path):
+        if use_db:
+            walk = results_db.artifact_walk(results_db_path, folder_path,
+                                            {"merged_mtz", "dimple_mtz", "dimple_pdb"})
+        else:
+            walk = os.walk(folder_path)
+        for root, dirs, files in walk:
+            dirs[:] = [d for d in dirs if d != quick_look_dir]
+            if quick_look_dir in os.path.relpath(root, folder_path).split(os.sep):
+                continue
             if "Merged.mtz" in files:
                 merged_mtz_src = os.path.join(root, "Merged.mtz")
             if "final.mtz" in files:
@@ -50,6 +71,16 @@ with open(dimple_file_path, 'r') as f:
             print(f"Not all required files found for {folder}")
             continue
 
+        # Check both MTZ files before copying; PanDDA fails on empty or broken ones
+        if mtz_file is not None:
+            problems = []
+            for mtz_src in (merged_mtz_src, final_mtz_src):
+                _, mtz_problems = mtz_file.validate_mtz(mtz_src)
+                problems += [f"{os.path.basename(mtz_src)}: {p}" for p in mtz_problems]
+            if problems:
+                print(f"Skipping {folder}: {'; '.join(problems)}")
+                continue
+
         # Create the PanDDA_run/SHP-{i} directory
         panDDA_folder_path = os.path.join(panDDA_run_path, folder)
         if not os.path.exists(panDDA_folder_path):
@@ -3,6 +3,8 @@ import re
 import shutil
 import subprocess
 
+import log_parser
+
 # ============================================================
 # USER CONFIGURATION
 # If you do not want to change a parameter, leave as None.
@@ -190,28 +192,7 @@ def parse_aimless_summary(log_path):
     Extract only: space group and high-resolution limit from aimless.log.
     Returns (space_group_str, high_res_str) or ('UNKNOWN', 'UNKNOWN').
     """
-    space_group = "UNKNOWN"
-    high_res = "UNKNOWN"
-
-    try:
-        with open(log_path, "r") as f:
-            text = f.read()
-    except FileNotFoundError:
-        return space_group, high_res
-
-    sg_matches = list(re.finditer(r"Space\s+group\s*[:=]\s*(.+)", text))
-    if sg_matches:
-        sg_line = sg_matches[-1].group(1).strip()
-        sg_line = re.sub(r"\(.*?\)", "", sg_line).strip()
-        space_group = sg_line
-
-    res_matches = list(re.finditer(r"High\s+resolution\s+limit\s+([0-9.]+)", text))
-    if not res_matches:
-        res_matches = list(re.finditer(r"Resolution\s+range\s+[0-9.]+\s+to\s+([0-9.]+)", text))
-    if res_matches:
-        high_res = res_matches[-1].group(1)
-
-    return space_group, high_res
+    return log_parser.parse_aimless_summary(log_path)
 
 
 def run_ccp4_pipeline(folder):
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import os
-import re
 from datetime import datetime
 
+import log_parser
+import results_db
+
 # ==========================
 # USER CONFIG
 # ==========================
 ROOT_DIR = "/media/lauren/T7/Processed_data/processed_data/CC138A"
 OUTPUT_LOG = os.path.join(ROOT_DIR, "aimless_summary.log")
+# Results database of crystal_pipeline.py. If it exists, space group and resolution
+# are read from it instead of searching ROOT_DIR for aimless.log files.
+RESULTS_DB = os.path.join(ROOT_DIR, "results.sqlite")
+# Quick-look folders of crystal_pipeline.py (QUICK_LOOK_DIR): partial data, not listed.
+QUICK_LOOK_DIR = "quick_look"
 
 
 def parse_aimless_log(log_path):
@@ -15,48 +22,7 @@ def parse_aimless_log(log_path):
     Return (space_group, high_resolution_A) from an aimless.log.
     If not found, returns ('UNKNOWN', 'UNKNOWN').
     """
-    space_group = "UNKNOWN"
-    high_res = "UNKNOWN"
-
-    try:
-        with open(log_path, "r", errors="replace") as f:
-            text = f.read()
-    except FileNotFoundError:
-        return space_group, high_res
-
-    # Space group (use last occurrence)
-    sg_matches = list(
-        re.finditer(r"Space\s+group\s*[:=]\s*(.+)", text, flags=re.IGNORECASE)
-    )
-    if sg_matches:
-        sg_line = sg_matches[-1].group(1).strip()
-        sg_line = re.sub(r"\(.*?\)", "", sg_line).strip()
-        space_group = sg_line
-
-    # High resolution limit
-    res_matches = list(
-        re.finditer(
-            r"High\s+resolution\s+limit\s+([0-9]+(?:\.[0-9]+)?)",
-            text,
-            flags=re.IGNORECASE,
-        )
-    )
-    if res_matches:
-        high_res = res_matches[-1].group(1)
-        return space_group, high_res
-
-    # Fallback
-    rr_matches = list(
-        re.finditer(
-            r"Resolution\s+range\s+[0-9]+(?:\.[0-9]+)?\s+to\s+([0-9]+(?:\.[0-9]+)?)",
-            text,
-            flags=re.IGNORECASE,
-        )
-    )
-    if rr_matches:
-        high_res = rr_matches[-1].group(1)
-
-    return space_group, high_res
+    return log_parser.parse_aimless_summary(log_path)
 
 
 def iter_aimless_logs(root_dir):
@@ -64,7 +30,8 @@ def iter_aimless_logs(root_dir):
     Yield (dataset_id, aimless_log_path).
     dataset_id = first directory under ROOT_DIR.
     """
-    for subdir, _, files in os.walk(root_dir):
+    for subdir, dirs, files in os.walk(root_dir):
+        dirs[:] = [d for d in dirs if d != QUICK_LOOK_DIR]
         if "aimless.log" not in files:
             continue
 
@@ -74,13 +41,29 @@ def iter_aimless_logs(root_dir):
         yield dataset_id, os.path.join(subdir, "aimless.log")
 
 
+def iter_database_rows(db_path):
+    """
+    Yield (dataset_id, space_group, high_resolution_A, folder) for every dataset
+    whose latest result has aimless statistics (also dimple-only reruns, which
+    read them from the existing aimless output). Quick-look rows are left out.
+    """
+    for row in results_db.latest_results(db_path):
+        if os.path.basename(row["dataset_rel"]) == QUICK_LOOK_DIR:
+            continue
+        if row["space_group"] not in (None, "UNKNOWN"):
+            yield row["dataset_id"], row["space_group"], row["resolution"], row["processing_dir"]
+
+
 def main():
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     rows = []
 
-    for dataset_id, log_path in iter_aimless_logs(ROOT_DIR):
-        sg, res = parse_aimless_log(log_path)
-        rows.append((dataset_id, sg, res, os.path.dirname(log_path)))
+    if RESULTS_DB and os.path.isfile(RESULTS_DB):
+        rows = list(iter_database_rows(RESULTS_DB))
+    else:
+        for dataset_id, log_path in iter_aimless_logs(ROOT_DIR):
+            sg, res = parse_aimless_log(log_path)
+            rows.append((dataset_id, sg, res, os.path.dirname(log_path)))
 
     rows.sort(key=lambda x: (x[0], x[3]))
 
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the orchestration overhead of crystal_pipeline.py on a synthetic visit.
+
+For every scale in SCALES a raw-data tree and a processed-data tree are generated
+in one of the README layouts, and fake xds_par, pointless, aimless, ctruncate,
+freerflag and dimple programs are put on PATH. The fakes sleep and burn CPU for a
+configurable time and write small but valid output files (XDS_ASCII.HKL, MTZ,
+XDS.xml, logs, final.pdb), so every parsing and checking step of the pipeline runs.
+
+Measured per scale:
+  - dataset discovery and raw-frame indexing, cold (no manifest) and warm;
+  - every MODE end to end (full, full rerun with everything up to date, quick-look,
+    aimless-only, dimple-only, coordinator with one worker): wall time,
+    datasets/hour, and scheduling efficiency = time spent in tools / (wall time
+    x worker slots);
+  - parser throughput for aimless XML/log, dimple.log and XDS_ASCII.HKL triage.
+
+Results are printed and written to REPORT_FILE. With BASELINE_FILE set, the run
+fails (exit code 1) when a metric is more than REGRESSION_TOLERANCE worse than in
+the baseline report, so it can run in CI.
+
+No XDS/CCP4 installation or beamline data is needed.
+"""
+import gzip
+import io
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from dataclasses import replace
+from functools import partial
+
+# ============================================================
+# USER CONFIGURATION
+# ============================================================
+
+# Everything is generated below this directory (removed and recreated per scale).
+BENCH_DIR = "/tmp/crystal_pipeline_benchmark"
+
+# Number of datasets of each synthetic visit (10 .. 50000).
+SCALES = [10, 100, 1000]
+
+# Folder layout of the visit, as in the README:
+#   - "flat": dataset00001/xds_run/XDS.INP
+#   - "puck": Puck001/Pin01/DS1/xds_run/XDS.INP (16 pins per puck)
+LAYOUT = "puck"
+PINS_PER_PUCK = 16
+
+# Frames per dataset in the raw tree (tiny .cbf.gz files).
+FRAMES_PER_DATASET = 10
+
+# Time each fake tool spends per call: sleeping (waiting on I/O) and burning CPU.
+TOOL_SLEEP_SECONDS = {"xds_par": 0.2, "pointless": 0.02, "aimless": 0.05,
+                      "ctruncate": 0.02, "freerflag": 0.02, "dimple": 0.1}
+TOOL_CPU_SECONDS = {"xds_par": 0.05, "pointless": 0.0, "aimless": 0.01,
+                    "ctruncate": 0.0, "freerflag": 0.0, "dimple": 0.02}
+
+# Modes to run end to end ("full-rerun" is a second full run with everything up to date,
+# "quick-look" includes the full pass, "coordinator" runs the coordinator of a full
+# WORK_MODE with one worker in this process).
+MODES = ["full", "full-rerun", "quick-look", "aimless-only", "dimple-only", "coordinator"]
+
+# Pipeline settings for the benchmark runs. The fake tools mostly sleep, so
+# TOTAL_CORES may be larger than the cores of this host (None = this host).
+MAX_CONCURRENT_DATASETS = 4
+TOTAL_CORES = None
+SCHEDULER = "pool"
+# How often the coordinator polls the work queue; part of the coordinator overhead.
+WORK_POLL_SECONDS = 0.5
+
+# Files parsed per scale for the parser throughput.
+PARSER_SAMPLE = 200
+
+REPORT_FILE = os.path.join(BENCH_DIR, "benchmark_report.json")
+# Earlier report to compare with; None = no comparison.
+BASELINE_FILE = None
+REGRESSION_TOLERANCE = 0.25
+
+# ============================================================
+# ===== DO NOT CHANGE ANYTHING FROM THIS POINT ONWARDS =======
+# ============================================================
+
+FAKE_TOOLS = ("xds_par", "pointless", "aimless", "ctruncate", "freerflag", "dimple")
+
+SPACE_GROUP = (19, "P 21 21 21", "PG222",
+               ("X,  Y,  Z", "-X+1/2,  -Y,  Z+1/2", "-X,  Y+1/2,  -Z+1/2", "X+1/2,  -Y+1/2,  -Z"))
+CELL = (50.1, 60.2, 70.3, 90.0, 90.0, 90.0)
+D_MIN = 2.2
+MULTIPLICITY = 2
+
+AIMLESS_LOG = """ Space group: P 21 21 21 (19)
+ Resolution range  45.00 to  {d_min:.2f}
+ High resolution limit   {d_min:.2f}
+"""
+
+AIMLESS_XML = """<?xml version="1.0"?>
+<AIMLESS_PIPE>
+ <ReflectionFile stream="HKLIN" name="XDS_ASCII.mtz"><cell><a>{a}</a><b>{b}</b><c>{c}</c><alpha>{al}</alpha><beta>{be}</beta><gamma>{ga}</gamma></cell><SpacegroupName> P 21 21 21</SpacegroupName></ReflectionFile>
+ <Result>
+  <Dataset name="bench/xtal/data">
+   <ResolutionLow><Overall>45.0</Overall><Inner>45.0</Inner><Outer>{outer_low:.2f}</Outer></ResolutionLow>
+   <ResolutionHigh><Overall>{d_min:.2f}</Overall><Inner>6.50</Inner><Outer>{d_min:.2f}</Outer></ResolutionHigh>
+   <RmergeOverall><Overall>0.071</Overall><Inner>0.025</Inner><Outer>0.95</Outer></RmergeOverall>
+   <RmeasOverall><Overall>0.085</Overall><Inner>0.030</Inner><Outer>1.20</Outer></RmeasOverall>
+   <RpimOverall><Overall>0.045</Overall><Inner>0.015</Inner><Outer>0.60</Outer></RpimOverall>
+   <MeanIoverSD><Overall>12.3</Overall><Inner>40.1</Inner><Outer>1.1</Outer></MeanIoverSD>
+   <Completeness><Overall>99.5</Overall><Inner>99.9</Inner><Outer>98.0</Outer></Completeness>
+   <Multiplicity><Overall>{multiplicity:.1f}</Overall><Inner>{multiplicity:.1f}</Inner><Outer>{multiplicity:.1f}</Outer></Multiplicity>
+   <CChalf><Overall>0.998</Overall><Inner>0.999</Inner><Outer>0.45</Outer></CChalf>
+  </Dataset>
+ </Result>
+</AIMLESS_PIPE>
+"""
+
+FINAL_PDB = """REMARK   3   RESOLUTION RANGE HIGH (ANGSTROMS) : {d_min:.2f}
+REMARK   3   FREE R VALUE                     : 0.245
+CRYST1{a:9.3f}{b:9.3f}{c:9.3f}{al:7.2f}{be:7.2f}{ga:7.2f} P 21 21 21    4
+ATOM      1  CA  GLY A   1      10.000  10.000  10.000  1.00 20.00           C
+END
+"""
+
+XDS_INP = """JOB= XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT
+NAME_TEMPLATE_OF_DATA_FRAMES= /unset/img_?????.cbf.gz
+DATA_RANGE= 1 {frames}
+SPOT_RANGE= 1 {frames}
+OSCILLATION_RANGE= 0.1
+DELPHI= 5
+DETECTOR= EIGER
+NX= 4150 NY= 4371
+MAXIMUM_NUMBER_OF_JOBS= 1
+"""
+
+
+# ============================================================
+# SYNTHETIC FILES
+# ============================================================
+
+def unique_reflections(cell=CELL, d_min=D_MIN):
+    """
+    (h, k, l, 1/d^2) with h, k, l >= 0 inside d_min, for an orthorhombic cell.
+    """
+    a, b, c = cell[:3]
+    limit = 1.0 / d_min ** 2
+    refl = []
+    for h in range(int(a / d_min) + 1):
+        for k in range(int(b / d_min) + 1):
+            for l in range(int(c / d_min) + 1):
+                s2 = (h / a) ** 2 + (k / b) ** 2 + (l / c) ** 2
+                if 0 < s2 <= limit:
+                    refl.append((h, k, l, s2))
+    return refl
+
+
+def intensity(rng, s2):
+    return 3000.0 * math.exp(-20.0 * s2) * rng.expovariate(1.0)
+
+
+def write_xds_ascii(path, refl, rng):
+    with open(path, "w") as f:
+        f.write("!FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE\n")
+        f.write(f"!SPACE_GROUP_NUMBER=   {SPACE_GROUP[0]}\n")
+        f.write("!UNIT_CELL_CONSTANTS=  " + " ".join(f"{v:.3f}" for v in CELL) + "\n")
+        f.write("!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=5\n")
+        f.write("!ITEM_H=1\n!ITEM_K=2\n!ITEM_L=3\n!ITEM_IOBS=4\n!ITEM_SIGMA(IOBS)=5\n")
+        f.write("!END_OF_HEADER\n")
+        for _ in range(MULTIPLICITY):
+            for h, k, l, s2 in refl:
+                i = intensity(rng, s2)
+                sign = rng.choice((-1, 1))
+                f.write(f"{sign * h:6d}{k:6d}{sign * l:6d} {i:10.3E} {math.sqrt(i + 50.0) * 2:10.3E}\n")
+        f.write("!END_OF_DATA\n")
+
+
+def mtz_record(text):
+    return text[:80].ljust(80).encode("ascii")
+
+
+def write_mtz(path, columns, rows, d_min=D_MIN):
+    """
+    Minimal little-endian merged MTZ file: one crystal/dataset, columns [(label, type)].
+    """
+    ncol, nref = len(columns), len(rows)
+    data = struct.pack(f"<{ncol * nref}f", *(v for row in rows for v in row))
+    header_word = (80 + len(data)) // 4 + 1
+    prefix = bytearray(80)
+    prefix[0:4] = b"MTZ "
+    prefix[4:8] = struct.pack("<i", header_word)
+    prefix[8:12] = bytes((0x44, 0x41, 0, 0))
+
+    sg_number, sg_name, point_group, symops = SPACE_GROUP
+    cell = " ".join(f"{v:.4f}" for v in CELL)
+    records = [
+        "VERS MTZ:V1.1",
+        "TITLE synthetic benchmark data",
+        f"NCOL {ncol:8d} {nref:12d} {0:8d}",
+        f"CELL  {cell}",
+        "SORT    1   2   3   0   0",
+        f"SYMINF {len(symops):3d} {len(symops):2d} P {sg_number:5d} '{sg_name}' {point_group}",
+    ]
+    records += [f"SYMM {op}" for op in symops]
+    records += [f"RESO {1.0 / 45.0 ** 2:.6f} {1.0 / d_min ** 2:.6f}", "VALM NAN"]
+    for index, (label, col_type) in enumerate(columns):
+        values = [row[index] for row in rows]
+        dataset = 0 if col_type == "H" else 1
+        records.append(f"COLUMN {label:<30} {col_type} {min(values):17.9g} {max(values):17.9g} {dataset:4d}")
+    records += ["NDIF        2",
+                "PROJECT       0 HKL_base", "CRYSTAL       0 HKL_base", "DATASET       0 HKL_base",
+                f"DCELL         0 {cell}", "DWAVEL        0    0.00000",
+                "PROJECT       1 bench", "CRYSTAL       1 xtal", "DATASET       1 data",
+                f"DCELL         1 {cell}", "DWAVEL        1    0.97625",
+                "END", "MTZENDOFHEADERS"]
+    with open(path, "wb") as f:
+        f.write(prefix)
+        f.write(data)
+        f.writelines(mtz_record(r) for r in records)
+
+
+def write_templates(template_dir):
+    """
+    Output files the fake tools copy into the processing folders.
+    """
+    os.makedirs(template_dir, exist_ok=True)
+    rng = random.Random(1)
+    refl = unique_reflections()
+    write_xds_ascii(os.path.join(template_dir, "XDS_ASCII.HKL"), refl, rng)
+
+    hkl = [("H", "H"), ("K", "H"), ("L", "H")]
+    intensities = [(h, k, l, intensity(rng, s2)) for h, k, l, s2 in refl]
+    merged = [(h, k, l, i, math.sqrt(i + 50.0)) for h, k, l, i in intensities]
+    write_mtz(os.path.join(template_dir, "Merged.mtz"), hkl + [("IMEAN", "J"), ("SIGIMEAN", "Q")], merged)
+    truncated = [(h, k, l, i, s, math.sqrt(max(i, 0.0)), 1.0) for h, k, l, i, s in merged]
+    truncate_columns = hkl + [("IMEAN", "J"), ("SIGIMEAN", "Q"), ("F", "F"), ("SIGF", "Q")]
+    write_mtz(os.path.join(template_dir, "Truncate.mtz"), truncate_columns, truncated)
+    flagged = [row + (float(n % 20),) for n, row in enumerate(truncated)]
+    write_mtz(os.path.join(template_dir, "Final_with_FreeR.mtz"),
+              truncate_columns + [("FreeR_flag", "I")], flagged)
+
+    values = dict(zip(("a", "b", "c", "al", "be", "ga"), CELL), d_min=D_MIN,
+                  outer_low=D_MIN + 0.05, multiplicity=MULTIPLICITY)
+    for name, text in (("aimless.log", AIMLESS_LOG), ("XDS.xml", AIMLESS_XML), ("final.pdb", FINAL_PDB)):
+        with open(os.path.join(template_dir, name), "w") as f:
+            f.write(text.format(**values))
+
+
+def dataset_rel(index, layout):
+    if layout == "flat":
+        return f"dataset{index + 1:05d}"
+    if layout == "puck":
+        return os.path.join(f"Puck{index // PINS_PER_PUCK + 1:03d}",
+                            f"Pin{index % PINS_PER_PUCK + 1:02d}", "DS1")
+    raise ValueError(f"Unknown LAYOUT='{layout}'. Use 'flat' or 'puck'.")
+
+
+CBF_HEADER = """###CBF: VERSION 1.5, CBFlib v0.7.8 - synthetic benchmark frame
+
+data_frame
+
+_array_data.header_convention "PILATUS_1.2"
+_array_data.header_contents
+;
+# Detector: Eiger2 X 16M, S/N E-32-0000
+# 2026-10-18T12:00:00.000
+# Pixel_size 75e-6 m x 75e-6 m
+# Silicon sensor, thickness 0.000450 m
+# Exposure_time 0.0100000 s
+# Exposure_period 0.0100000 s
+# Count_cutoff 65535 counts
+# Wavelength 0.97625 A
+# Detector_distance 0.20000 m
+# Beam_xy (2075.00, 2185.00) pixels
+# Start_angle 0.0000 deg.
+# Angle_increment 0.1000 deg.
+;
+
+_array_data.data
+;
+--CIF-BINARY-FORMAT-SECTION--
+Content-Type: application/octet-stream;
+     conversions="x-CBF_BYTE_OFFSET"
+Content-Transfer-Encoding: BINARY
+X-Binary-Size: {size}
+X-Binary-ID: 1
+X-Binary-Element-Type: "signed 32-bit integer"
+X-Binary-Element-Byte-Order: LITTLE_ENDIAN
+X-Binary-Number-of-Elements: {size}
+X-Binary-Size-Fastest-Dimension: 4150
+X-Binary-Size-Second-Dimension: 4371
+X-Binary-Size-Padding: 4095
+
+"""
+
+
+def synthetic_cbf(size=256):
+    """
+    A small miniCBF frame (PILATUS-style header, byte-offset binary section of size bytes).
+    The header gives the geometry of XDS_INP; the binary section is not a full image.
+    """
+    header = CBF_HEADER.format(size=size).replace("\n", "\r\n").encode("ascii")
+    return (header + b"\x0c\x1a\x04\xd5" + bytes(size) + bytes(4095)
+            + b"\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n")
+
+
+def make_visit(raw_dir, root_dir, n_datasets, layout, frames):
+    """
+    Raw tree with a frame series per dataset and a processed tree with XDS.INP files.
+    """
+    frame = gzip.compress(synthetic_cbf())
+    xds_inp = XDS_INP.format(frames=frames)
+    for index in range(n_datasets):
+        rel = dataset_rel(index, layout)
+        raw = os.path.join(raw_dir, rel)
+        os.makedirs(raw)
+        for number in range(1, frames + 1):
+            with open(os.path.join(raw, f"img_{number:05d}.cbf.gz"), "wb") as f:
+                f.write(frame)
+        processing = os.path.join(root_dir, rel, "xds_run")
+        os.makedirs(processing)
+        with open(os.path.join(processing, "XDS.INP"), "w") as f:
+            f.write(xds_inp)
+
+
+# ============================================================
+# FAKE TOOLS
+# ============================================================
+
+def write_fake_tools(bin_dir, template_dir):
+    """
+    Wrapper scripts that run this file as the named tool, and a CCP4 setup script
+    that puts them on PATH.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    here = os.path.abspath(__file__)
+    for tool in FAKE_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{here}" --fake-tool {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    setup = os.path.join(bin_dir, "ccp4.setup-sh")
+    with open(setup, "w") as f:
+        f.write(f'export PATH="{bin_dir}:$PATH"\nexport FAKE_TOOL_TEMPLATES="{template_dir}"\n')
+    # xds_par is started from a login shell, which rebuilds PATH from the profile
+    # files; a HOME of our own puts the fake tools first again.
+    home = os.path.join(os.path.dirname(bin_dir), "home")
+    os.makedirs(home, exist_ok=True)
+    with open(os.path.join(home, ".bash_profile"), "w") as f:
+        f.write(f'. "{setup}"\n')
+    os.environ["HOME"] = home
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["FAKE_TOOL_TEMPLATES"] = template_dir
+    for tool in FAKE_TOOLS:
+        os.environ[f"FAKE_{tool.upper()}_SLEEP"] = str(TOOL_SLEEP_SECONDS.get(tool, 0.0))
+        os.environ[f"FAKE_{tool.upper()}_CPU"] = str(TOOL_CPU_SECONDS.get(tool, 0.0))
+    return setup
+
+
+def argument_after(argv, flag):
+    upper = [a.upper() for a in argv]
+    return argv[upper.index(flag.upper()) + 1] if flag.upper() in upper else None
+
+
+def fake_tool(tool, argv):
+    """
+    Behave like tool: spend the configured time, write its outputs, print a log.
+    """
+    sleep = float(os.environ.get(f"FAKE_{tool.upper()}_SLEEP", 0))
+    cpu = float(os.environ.get(f"FAKE_{tool.upper()}_CPU", 0))
+    templates = os.environ["FAKE_TOOL_TEMPLATES"]
+
+    def template(name, dst):
+        shutil.copyfile(os.path.join(templates, name), dst)
+
+    end = time.process_time() + cpu
+    x = 0
+    while time.process_time() < end:
+        x += 1
+    time.sleep(sleep)
+
+    if tool == "xds_par":
+        template("XDS_ASCII.HKL", "XDS_ASCII.HKL")
+        for name in ("XPARM.XDS", "SPOT.XDS", "INTEGRATE.HKL", "X-CORRECTIONS.cbf", "Y-CORRECTIONS.cbf",
+                     "BKGINIT.cbf", "BLANK.cbf", "GAIN.cbf"):
+            open(name, "w").close()
+        with open("CORRECT.LP", "w") as f:
+            f.write(" fake CORRECT\n")
+        print(" fake xds_par: XDS_ASCII.HKL written")
+    elif tool == "pointless":
+        template("Merged.mtz", argument_after(argv, "hklout"))
+        print(" fake pointless")
+    elif tool == "aimless":
+        template("Merged.mtz", argument_after(argv, "HKLOUT"))
+        template("XDS.xml", argument_after(argv, "XMLOUT"))
+        with open(os.path.join(templates, "aimless.log")) as f:
+            sys.stdout.write(f.read())
+    elif tool == "ctruncate":
+        template("Truncate.mtz", argument_after(argv, "-mtzout"))
+        print(" fake ctruncate")
+    elif tool == "freerflag":
+        template("Final_with_FreeR.mtz", argument_after(argv, "HKLOUT"))
+        print(" fake freerflag")
+    elif tool == "dimple":
+        outdir = argv[2]
+        os.makedirs(outdir, exist_ok=True)
+        template("final.pdb", os.path.join(outdir, "final.pdb"))
+        template("Final_with_FreeR.mtz", os.path.join(outdir, "final.mtz"))
+        print(f" fake dimple\nBlobs: {len(outdir) % 3}")
+    return 0
+
+
+# ============================================================
+# MEASUREMENTS
+# ============================================================
+
+def timed(fn, *args, **kwargs):
+    start = time.monotonic()
+    result = fn(*args, **kwargs)
+    return time.monotonic() - start, result
+
+
+def quiet(fn, *args, **kwargs):
+    with redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def bench_env(cp, root, n_datasets):
+    raw_dir, root_dir = os.path.join(root, "raw"), os.path.join(root, "processed")
+    return replace(
+        cp.ENV,
+        raw_data_base_dir=raw_dir,
+        root_dir=root_dir,
+        prefix_hint=None,
+        space_group_number=None,
+        unit_cell_constants=None,
+        data_range=None,
+        spot_range=None,
+        ccp4_setup=os.path.join(root, "bin", "ccp4.setup-sh"),
+        dimple_pdb=os.path.join(root, "templates", "final.pdb"),
+        summary_file=os.path.join(root_dir, "summary.txt"),
+        max_concurrent_datasets=MAX_CONCURRENT_DATASETS,
+        total_cores=TOTAL_CORES,
+        scheduler=SCHEDULER,
+        discovery_manifest=os.path.join(root_dir, "dataset_manifest.json"),
+        raw_index_manifest=os.path.join(root_dir, "raw_frame_index.json"),
+        ccp4_env_cache=os.path.join(root_dir, "ccp4_env.json"),
+        freer_reference_dir=os.path.join(root_dir, "freer_reference"),
+        freer_seed_mtz=None,
+        xds_tuning_file=None,
+        frame_cache_dir=None,
+        events_file=os.path.join(root_dir, "events.jsonl"),
+        host_sample_seconds=None,
+        results_db=os.path.join(root_dir, "results.sqlite"),
+        work_queue=os.path.join(root_dir, "work_queue.sqlite"),
+        work_mode="full",
+        work_poll_seconds=WORK_POLL_SECONDS,
+        debug=False,
+    )
+
+
+def worker_slots(cp, env):
+    if env.scheduler == "staged":
+        return env.xds_workers + env.ccp4_workers + (env.dimple_workers if env.dimple_pdb else 0)
+    return cp.dataset_workers(env)
+
+
+def last_run_events(events_file):
+    """
+    Timed events of the last run in the event log.
+    """
+    events = []
+    with open(events_file) as f:
+        for line in f:
+            event = json.loads(line)
+            if event["event"] == "run" and event.get("phase") == "start":
+                events = []
+            elif "duration" in event:
+                events.append(event)
+    return events
+
+
+def coordinator_with_worker(cp, env):
+    """
+    The coordinator in a thread and one worker in this thread, on a fresh queue.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(env.work_queue + suffix):
+            os.remove(env.work_queue + suffix)
+    coordinator = threading.Thread(target=cp.queue_coordinator, args=(env,))
+    coordinator.start()
+    # The worker stops at an empty queue: start it once every dataset is queued.
+    while coordinator.is_alive() and not os.path.exists(env.work_queue):
+        time.sleep(0.01)
+    jobs = cp.work_queue.WorkQueue(env.work_queue)
+    try:
+        while coordinator.is_alive() and sum(jobs.counts().values()) == 0:
+            time.sleep(0.01)
+    finally:
+        jobs.close()
+    cp.queue_worker(env)
+    coordinator.join()
+
+
+def run_mode(cp, env, mode, n_datasets):
+    events_file = env.events_file
+    if mode == "full":
+        fn, mode_env = cp.full_pipeline, env
+    elif mode == "full-rerun":
+        fn, mode_env = cp.full_pipeline, replace(env, skip_up_to_date=True)
+    elif mode == "quick-look":
+        fn, mode_env = cp.quick_look, replace(env, skip_up_to_date=False)
+    elif mode == "coordinator":
+        fn, mode_env = partial(coordinator_with_worker, cp), replace(env, skip_up_to_date=False)
+        # The tools run in the worker, which logs to its own event file.
+        events_file = cp.worker_events_file(env, cp.work_queue.worker_name())
+    elif mode == "aimless-only":
+        fn, mode_env = cp.aimless_only, replace(env, skip_up_to_date=False)
+    elif mode == "dimple-only":
+        fn, mode_env = cp.dimple_only, replace(env, skip_up_to_date=False)
+    else:
+        raise ValueError(f"Unknown benchmark mode '{mode}'")
+
+    wall, _ = timed(quiet, fn, mode_env)
+    events = last_run_events(events_file)
+    tool_seconds = sum(e["duration"] for e in events if e["event"] == "tool")
+    slots = worker_slots(cp, mode_env)
+    return {
+        "wall_s": round(wall, 3),
+        "datasets_per_hour": round(n_datasets / wall * 3600, 1) if wall > 0 else None,
+        "tool_s": round(tool_seconds, 3),
+        "scheduling_efficiency": round(tool_seconds / (wall * slots), 3) if wall > 0 else None,
+        "overhead_per_dataset_s": round(max(0.0, wall * slots - tool_seconds) / n_datasets, 4),
+    }
+
+
+def parser_throughput(cp, datasets):
+    folders = [ds.processing_dir for ds in datasets[:PARSER_SAMPLE]]
+    result = {}
+    if not folders:
+        return result
+    wall, _ = timed(lambda: [cp.read_aimless_results(f) for f in folders])
+    result["aimless_files_per_s"] = round(len(folders) / wall, 1) if wall > 0 else None
+    wall, _ = timed(lambda: [cp.parse_dimple_blobs(f) for f in folders])
+    result["dimple_logs_per_s"] = round(len(folders) / wall, 1) if wall > 0 else None
+    if cp.xds_ascii is not None:
+        hkls = [os.path.join(f, "XDS_ASCII.HKL") for f in folders if os.path.isfile(os.path.join(f, "XDS_ASCII.HKL"))]
+        size = sum(os.path.getsize(p) for p in hkls)
+        wall, _ = timed(lambda: [cp.xds_ascii.triage(p) for p in hkls])
+        result["triage_mb_per_s"] = round(size / 1e6 / wall, 1) if wall > 0 and hkls else None
+    return result
+
+
+def bench_scale(cp, n_datasets):
+    root = os.path.join(BENCH_DIR, f"visit_{n_datasets}")
+    shutil.rmtree(root, ignore_errors=True)
+    templates = os.path.join(root, "templates")
+    write_templates(templates)
+    write_fake_tools(os.path.join(root, "bin"), templates)
+    env = bench_env(cp, root, n_datasets)
+
+    gen, _ = timed(make_visit, env.raw_data_base_dir, env.root_dir, n_datasets, LAYOUT, FRAMES_PER_DATASET)
+    metrics = {"datasets": n_datasets, "generate_s": round(gen, 3)}
+
+    for manifest in (env.discovery_manifest, env.raw_index_manifest):
+        if os.path.exists(manifest):
+            os.remove(manifest)
+    metrics["discovery_cold_s"], datasets = timed(quiet, cp.find_datasets, env, "XDS.INP")
+    metrics["discovery_warm_s"], _ = timed(quiet, cp.find_datasets, env, "XDS.INP")
+    metrics["raw_index_cold_s"], _ = timed(quiet, cp.build_raw_index, env)
+    metrics["raw_index_warm_s"], _ = timed(quiet, cp.build_raw_index, env)
+    for key in ("discovery_cold_s", "discovery_warm_s", "raw_index_cold_s", "raw_index_warm_s"):
+        metrics[key] = round(metrics[key], 4)
+    if len(datasets) != n_datasets:
+        raise RuntimeError(f"discovery found {len(datasets)} of {n_datasets} datasets")
+
+    for mode in MODES:
+        metrics[mode] = run_mode(cp, env, mode, n_datasets)
+    metrics["parsers"] = parser_throughput(cp, datasets)
+    return metrics
+
+
+# ============================================================
+# REPORT
+# ============================================================
+
+def flatten(metrics, prefix=""):
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and value is not None:
+            flat[name] = value
+    return flat
+
+
+def higher_is_better(name):
+    return name.endswith(("_per_s", "_per_hour", "efficiency"))
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Metrics of report that are more than tolerance worse than in baseline.
+    """
+    found = []
+    old_scales = {str(m["datasets"]): flatten(m) for m in baseline.get("scales", [])}
+    for m in report["scales"]:
+        old = old_scales.get(str(m["datasets"]))
+        if old is None:
+            continue
+        for name, value in flatten(m).items():
+            if name.endswith(("datasets", "generate_s", "tool_s")) or name not in old or not old[name]:
+                continue
+            ratio = value / old[name]
+            worse = ratio < 1 - tolerance if higher_is_better(name) else ratio > 1 + tolerance
+            # Sub-10 ms timings are noise.
+            if worse and (higher_is_better(name) or max(value, old[name]) >= 0.01):
+                found.append(f"{m['datasets']} datasets: {name} {old[name]} -> {value}")
+    return found
+
+
+def print_scale(m):
+    print(f"\n--- {m['datasets']} datasets ({LAYOUT} layout) ---")
+    print(f"  discovery: cold {m['discovery_cold_s']:.3f} s, warm {m['discovery_warm_s']:.3f} s; "
+          f"raw index: cold {m['raw_index_cold_s']:.3f} s, warm {m['raw_index_warm_s']:.3f} s")
+    print(f"  {'mode':<14}{'wall':>10}{'ds/hour':>12}{'in tools':>10}{'efficiency':>12}{'overhead/ds':>13}")
+    for mode in MODES:
+        r = m[mode]
+        print(f"  {mode:<14}{r['wall_s']:>9.2f}s{r['datasets_per_hour']:>12.0f}{r['tool_s']:>9.2f}s"
+              f"{r['scheduling_efficiency']:>12.2f}{r['overhead_per_dataset_s']:>12.3f}s")
+    parsers = ", ".join(f"{k} {v}" for k, v in m["parsers"].items())
+    print(f"  parsers: {parsers}")
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import crystal_pipeline as cp
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "layout": LAYOUT,
+        "scheduler": SCHEDULER,
+        "max_concurrent_datasets": MAX_CONCURRENT_DATASETS,
+        "total_cores": TOTAL_CORES,
+        "tool_sleep_seconds": TOOL_SLEEP_SECONDS,
+        "tool_cpu_seconds": TOOL_CPU_SECONDS,
+        "scales": [],
+    }
+    for n_datasets in SCALES:
+        metrics = bench_scale(cp, n_datasets)
+        report["scales"].append(metrics)
+        print_scale(metrics)
+
+    with open(REPORT_FILE, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"\nReport written to: {REPORT_FILE}")
+
+    if BASELINE_FILE:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+        found = regressions(report, baseline, REGRESSION_TOLERANCE)
+        if found:
+            print(f"\nREGRESSIONS (more than {100 * REGRESSION_TOLERANCE:.0f}% worse than {BASELINE_FILE}):")
+            for line in found:
+                print(f"  {line}")
+            return 1
+        print(f"No regressions against {BASELINE_FILE}.")
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--fake-tool":
+        sys.exit(fake_tool(sys.argv[2], sys.argv[3:]))
+    sys.exit(main())
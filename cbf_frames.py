@@ -0,0 +1,249 @@
+"""
+.cbf.gz frames: integrity check before XDS reads them, and header-only reading
+of the detector geometry.
+
+A frame is good when its gzip stream decodes to the end (CRC and length
+included) and the binary section of the CBF is as long as its X-Binary-Size
+header says. Frames are checked on a thread pool (zlib releases the GIL), and
+the frames found good are remembered per processing folder by name, size and
+modification time, so a rerun only checks new or changed frames.
+
+read_header() inflates only the first few KB of a frame, up to the binary
+section, and parses the PILATUS-convention header (detector, wavelength,
+distance, oscillation, beam centre, pixel size, count cutoff).
+"""
+import json
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial
+
+CHECK_CACHE_FILE = "frame_check.json"
+READ_BLOCK = 1 << 20
+# The CBF header (and the MIME header of the binary section) is within this many bytes.
+HEADER_BYTES = 64 << 10
+
+BINARY_SECTION = b"--CIF-BINARY-FORMAT-SECTION--"
+BINARY_START = b"\x0c\x1a\x04\xd5"
+BINARY_SIZE_RE = re.compile(rb"X-Binary-Size:\s*(\d+)")
+
+
+def check_frame(path):
+    """
+    None if the frame is good, otherwise the reason.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    head = bytearray()
+    total = 0
+    try:
+        with open(path, "rb") as f:
+            for block in iter(partial(f.read, READ_BLOCK), b""):
+                while block:
+                    if decompressor.eof:
+                        # Concatenated gzip members are valid gzip.
+                        decompressor = zlib.decompressobj(wbits=31)
+                    data = decompressor.decompress(block)
+                    total += len(data)
+                    if len(head) < HEADER_BYTES:
+                        head += data[:HEADER_BYTES - len(head)]
+                    block = decompressor.unused_data if decompressor.eof else b""
+    except FileNotFoundError:
+        return "missing"
+    except OSError as e:
+        return f"unreadable ({e.strerror})"
+    except zlib.error as e:
+        return f"corrupt gzip ({e})"
+    if not decompressor.eof:
+        return "truncated gzip"
+
+    head = bytes(head)
+    section = head.find(BINARY_SECTION)
+    if section < 0:
+        return "no CBF binary section"
+    size = BINARY_SIZE_RE.search(head, section)
+    start = head.find(BINARY_START, section)
+    if size is None or start < 0:
+        return "no X-Binary-Size header"
+    expected = start + len(BINARY_START) + int(size.group(1))
+    if total < expected:
+        return f"binary section short by {expected - total} bytes"
+    return None
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class FrameChecker:
+    """
+    Thread pool shared by all datasets of a run.
+    """
+
+    def __init__(self, threads=8):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="frame-check")
+
+    def check(self, paths, cache_dir=None):
+        """
+        {path: reason} of the bad frames among paths. With cache_dir, frames
+        recorded there as good (same size and mtime) are not read again.
+        """
+        cache_path = os.path.join(cache_dir, CHECK_CACHE_FILE) if cache_dir else None
+        cached = load_cache(cache_path)
+        keys = {path: _stat_key(path) for path in paths}
+        todo = [p for p in paths if keys[p] is None or cached.get(os.path.basename(p)) != keys[p]]
+        reasons = dict(zip(todo, self._pool.map(check_frame, todo)))
+
+        if cache_path is not None:
+            good = {os.path.basename(p): keys[p] for p in paths
+                    if keys[p] is not None and reasons.get(p) is None}
+            save_cache(cache_path, good)
+        return {p: reason for p, reason in reasons.items() if reason is not None}
+
+
+def load_cache(cache_path):
+    if cache_path is None:
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache_path, good):
+    tmp = f"{cache_path}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(good, f, separators=(",", ":"))
+        os.replace(tmp, cache_path)
+    except OSError as e:
+        print(f"WARNING: could not write {cache_path}: {e}")
+
+
+# ============================================================
+# HEADER
+# ============================================================
+
+FRAME_HEADER_FILE = "frame_header.json"
+HEADER_BLOCK = 4096
+
+HEADER_PATTERNS = {
+    "detector": re.compile(r"^#\s*Detector:\s*(.+?)(?:,\s*S/N.*)?$", re.M),
+    "pixel_size": re.compile(r"^#\s*Pixel_size\s+([\d.eE+-]+)\s*m\s*x\s*([\d.eE+-]+)\s*m", re.M),
+    "wavelength": re.compile(r"^#\s*Wavelength\s+([\d.eE+-]+)\s*A", re.M),
+    "distance": re.compile(r"^#\s*Detector_distance\s+([\d.eE+-]+)\s*m", re.M),
+    "beam_xy": re.compile(r"^#\s*Beam_xy\s*\(\s*([\d.eE+-]+)\s*,\s*([\d.eE+-]+)\s*\)", re.M),
+    "start_angle": re.compile(r"^#\s*Start_angle\s+([\d.eE+-]+)", re.M),
+    "oscillation": re.compile(r"^#\s*Angle_increment\s+([\d.eE+-]+)", re.M),
+    "count_cutoff": re.compile(r"^#\s*Count_cutoff\s+(\d+)", re.M),
+    "thickness": re.compile(r"^#\s*\w+ sensor, thickness\s+([\d.eE+-]+)\s*m", re.M),
+    "nx": re.compile(r"^X-Binary-Size-Fastest-Dimension:\s*(\d+)", re.M),
+    "ny": re.compile(r"^X-Binary-Size-Second-Dimension:\s*(\d+)", re.M),
+}
+
+
+@dataclass
+class FrameHeader:
+    """
+    Geometry from a PILATUS-convention miniCBF header; lengths in mm, angles in degrees.
+    """
+    detector: str | None = None
+    nx: int | None = None
+    ny: int | None = None
+    pixel_x: float | None = None
+    pixel_y: float | None = None
+    wavelength: float | None = None
+    distance: float | None = None
+    beam_x: float | None = None
+    beam_y: float | None = None
+    start_angle: float | None = None
+    oscillation: float | None = None
+    count_cutoff: int | None = None
+    sensor_thickness: float | None = None
+
+    @property
+    def detector_type(self):
+        """
+        XDS DETECTOR= for the model, or None if unknown.
+        """
+        model = (self.detector or "").upper()
+        for family in ("EIGER", "PILATUS"):
+            if family in model:
+                return family
+        return None
+
+
+def read_header_text(path, limit=HEADER_BYTES):
+    """
+    Text of a .cbf.gz header up to the start of the binary data, decompressing
+    only the first few KB of the file.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    text = b""
+    with open(path, "rb") as f:
+        while len(text) < limit:
+            block = f.read(HEADER_BLOCK)
+            if not block:
+                break
+            text += decompressor.decompress(block, limit - len(text))
+            start = text.find(BINARY_START)
+            if start >= 0:
+                return text[:start].decode("ascii", "replace")
+    return text.decode("ascii", "replace")
+
+
+def parse_header(text):
+    values = {}
+    for name, pattern in HEADER_PATTERNS.items():
+        m = pattern.search(text)
+        if m:
+            values[name] = m.groups()
+    header = FrameHeader()
+    if "detector" in values:
+        header.detector = values["detector"][0].strip()
+    if "nx" in values:
+        header.nx = int(values["nx"][0])
+    if "ny" in values:
+        header.ny = int(values["ny"][0])
+    if "pixel_size" in values:
+        header.pixel_x, header.pixel_y = (float(v) * 1000 for v in values["pixel_size"])
+    if "wavelength" in values:
+        header.wavelength = float(values["wavelength"][0])
+    if "distance" in values:
+        header.distance = float(values["distance"][0]) * 1000
+    if "beam_xy" in values:
+        header.beam_x, header.beam_y = (float(v) for v in values["beam_xy"])
+    if "start_angle" in values:
+        header.start_angle = float(values["start_angle"][0])
+    if "oscillation" in values:
+        header.oscillation = float(values["oscillation"][0])
+    if "count_cutoff" in values:
+        header.count_cutoff = int(values["count_cutoff"][0])
+    if "thickness" in values:
+        header.sensor_thickness = float(values["thickness"][0]) * 1000
+    return header
+
+
+def read_header(path, cache_dir=None):
+    """
+    FrameHeader of one frame, or None if it cannot be read. With cache_dir, the
+    header is kept in frame_header.json there and reused while the frame is unchanged.
+    """
+    key = _stat_key(path)
+    cache_path = os.path.join(cache_dir, FRAME_HEADER_FILE) if cache_dir else None
+    cached = load_cache(cache_path)
+    if key is not None and cached.get("frame") == path and cached.get("key") == key:
+        return FrameHeader(**cached["header"])
+    try:
+        header = parse_header(read_header_text(path))
+    except (OSError, zlib.error):
+        return None
+    if cache_path is not None and key is not None:
+        save_cache(cache_path, {"frame": path, "key": key, "header": asdict(header)})
+    return header
@@ -1,8 +1,39 @@
+import bisect
+import hashlib
+import json
+import math
 import os
+import queue
 import re
 import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
-from dataclasses import dataclass
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import asdict, dataclass, field, replace
+from functools import partial
+from typing import Callable
+
+import cbf_frames
+import event_log
+import frame_cache
+import log_parser
+import raw_watch
+import results_db
+import work_queue
+
+try:
+    import freer_flags
+    import mtz_file
+    import xds_ascii
+except ImportError:  # NumPy not available: no MTZ checks or triage, freerflag is used
+    freer_flags = None
+    mtz_file = None
+    xds_ascii = None
 
 # ============================================================
 # USER CONFIGURATION
@@ -30,29 +61,203 @@ PREFIX_HINT = None
 SPACE_GROUP_NUMBER = None
 UNIT_CELL_CONSTANTS = None
 
-DATA_RANGE = "1 3600"
-SPOT_RANGE = "1 3600"
+# XDS frame ranges, e.g. "1 3600". None = take the range of each dataset
+# from its raw images. A series with missing frames is rejected by FRAME_CHECK;
+# only with FRAME_CHECK = False is the longest run of frames without gaps used.
+DATA_RANGE = None
+SPOT_RANGE = None
+# Fast indexing: with SPOT_RANGE = None, COLSPOT searches spots only in SPOT_WEDGES wedges
+# of SPOT_WEDGE_DEGREES, one every SPOT_WEDGE_SPACING_DEGREES from the first frame
+# (e.g. 3 x 5 deg at 0/45/90 deg). If IDXREF then indexes too few spots, spots are
+# searched in the whole DATA_RANGE and XDS runs again. None = spots from the whole DATA_RANGE.
+SPOT_WEDGES = None
+SPOT_WEDGE_DEGREES = 5
+SPOT_WEDGE_SPACING_DEGREES = 45
 DETECTOR_TYPE = "EIGER"   # "EIGER", "PILATUS", or None
+# Geometry from the header of the first frame of each series (only its first few KB are read):
+# "fill"   - add the keywords XDS.INP lacks; DETECTOR and OVERLOAD come from the header
+#            (DETECTOR_TYPE is used only if the header names no EIGER/PILATUS detector);
+#            other values that differ from the header are reported and kept
+# "header" - header values replace those in XDS.INP that differ
+# "check"  - only report differences
+# None     - do not read frame headers
+XDS_INP_FROM_HEADER = "fill"
 
 # Path to CCP4 setup script for pointless/aimless/ctruncate/freerflag
 # if you are using the work station copy the path below
 # "/usr/local/ccp4/ccp4-8.0/bin/ccp4.setup-sh"
 CCP4_SETUP = "/opt/xtal/ccp4-9/bin/ccp4.setup-sh"
+# CCP4_SETUP is sourced once per run and the resulting environment is stored here,
+# reused until the setup script changes. None = do not keep it on disk.
+CCP4_ENV_CACHE = os.path.join(ROOT_DIR, "ccp4_env.json")
+
+# FreeR flags
+#   - "builtin":   the flag of a reflection depends only on its h,k,l and is kept in a
+#                  reference table per space group and cell, so all datasets of the
+#                  screen share one free set (what PanDDA / joint refinement expect).
+#   - "freerflag": CCP4 freerflag, an independent random free set per dataset.
+FREER_FLAGS = "builtin"
+FREER_FRACTION = 0.05
+# Reference tables for "builtin", one .npz file per space group and cell.
+FREER_REFERENCE_DIR = os.path.join(ROOT_DIR, "freer_reference")
+# Optional MTZ with FreeR flags (e.g. the data DIMPLE_PDB was refined against)
+# whose flags are kept when a new reference table is started. None = no seed.
+FREER_SEED_MTZ = None
 
 DIMPLE_PDB = "/path/to/reference_model.pdb"   # None to skip DIMPLE
 DIMPLE_OUTDIR = "dimple_out"
 
 # Pipeline mode
-MODE = "full"   # "full", "aimless-only", "dimple-only"
+MODE = "full"   # "full", "quick-look", "aimless-only", "dimple-only", "xds-benchmark", "coordinator", "worker", "watch"
+
+# Concurrency
+# Number of datasets processed at the same time (1 = one after another).
+MAX_CONCURRENT_DATASETS = 1
+# Total number of CPU cores the pipeline may use. None = all cores of this machine.
+# Each xds_par run gets TOTAL_CORES // MAX_CONCURRENT_DATASETS threads,
+# so the machine is never oversubscribed.
+TOTAL_CORES = None
+
+# Scheduler
+#   - "pool":   each dataset runs XDS -> CCP4 -> DIMPLE in one worker,
+#               MAX_CONCURRENT_DATASETS workers at a time.
+#   - "staged": one worker pool per stage with a bounded queue in between,
+#               so XDS of one dataset overlaps CCP4/DIMPLE of others.
+SCHEDULER = "pool"
+# Staged scheduler only: workers per stage and queue length between stages.
+# XDS workers share the cores left after one core per CCP4/DIMPLE worker.
+XDS_WORKERS = 2
+CCP4_WORKERS = 4
+DIMPLE_WORKERS = 4
+STAGE_QUEUE_SIZE = 4
+
+# XDS parallelism
+#   - "auto": set MAXIMUM_NUMBER_OF_JOBS, MAXIMUM_NUMBER_OF_PROCESSORS and
+#             NUMBER_OF_IMAGES_IN_CACHE per dataset from its number of frames,
+#             the cores and memory left for it, and the calibration of this host.
+#   - None:   leave jobs and image cache to XDS.
+XDS_PARALLELISM = "auto"
+# Per-host calibration written by MODE = "xds-benchmark".
+XDS_TUNING_FILE = os.path.join(ROOT_DIR, "xds_tuning.json")
+# Share of the machine's memory that the image caches of all running XDS jobs may use.
+XDS_MEMORY_FRACTION = 0.5
+# xds-benchmark: number of frames of the first dataset integrated per setting.
+XDS_BENCHMARK_FRAMES = 400
+
+# Frame staging. Set FRAME_CACHE_DIR to a local SSD or tmpfs directory to copy the
+# frames of the dataset in XDS, and of the next FRAME_PREFETCH_DATASETS datasets,
+# there in the background; XDS then reads the local copy. The directory is limited
+# to FRAME_CACHE_MAX_GB, least recently used series are removed first.
+# None = XDS reads the frames from RAW_DATA_BASE_DIR.
+FRAME_CACHE_DIR = None
+FRAME_CACHE_MAX_GB = 100
+FRAME_PREFETCH_DATASETS = 2
+FRAME_STAGING_THREADS = 8
+# Store the staged frames gunzipped (.cbf) so XDS does not decompress them twice.
+FRAME_CACHE_DECOMPRESS = False
+
+# Check every frame XDS will read before it runs: the gzip stream must decode to the
+# end and the CBF binary section must be as long as its header says; missing frames
+# count as bad. A dataset with bad frames fails XDS without running it. Frames found
+# good are remembered in frame_check.json in the processing folder (name, size, mtime).
+FRAME_CHECK = True
+FRAME_CHECK_THREADS = 8
 
 # Timeouts
 XDS_TIMEOUT_SECONDS = 3600
 CCP4_TIMEOUT_SECONDS = 1800
 DIMPLE_TIMEOUT_SECONDS = 3600
 
-# Summary file
+# Results database (SQLite) with every run's results; summary.txt is written from it
+# and lists the latest result of every dataset. Keep it on a local disk if ROOT_DIR
+# is on NFS (SQLite locking is unreliable there).
+RESULTS_DB = os.path.join(ROOT_DIR, "results.sqlite")
 SUMMARY_FILE = os.path.join(ROOT_DIR, "summary.txt")
 
+# Event log: one JSON line per tool run, stage and phase (discovery, log parsing, ...),
+# with start/end times, duration and exit code. None = no event log or run report.
+EVENTS_FILE = os.path.join(ROOT_DIR, "events.jsonl")
+# Record host CPU, iowait and memory use every this many seconds (None = off).
+HOST_SAMPLE_SECONDS = 5
+
+# Several hosts: MODE = "coordinator" puts the datasets of WORK_MODE into WORK_QUEUE
+# (SQLite on the shared filesystem) and stores the results as they come in.
+# MODE = "worker", started on any number of hosts with the same settings, takes
+# datasets from the queue and processes them. A worker renews its lease on a dataset
+# while it runs; a dataset whose lease is older than LEASE_SECONDS (worker killed,
+# host down) is queued again, up to LEASE_MAX_ATTEMPTS times.
+WORK_QUEUE = os.path.join(ROOT_DIR, "work_queue.sqlite")
+WORK_MODE = "full"   # "full", "aimless-only", "dimple-only"
+LEASE_SECONDS = 600
+LEASE_MAX_ATTEMPTS = 3
+WORK_POLL_SECONDS = 10
+
+# Watch mode (MODE = "watch"): during the beamtime, run XDS -> CCP4 -> DIMPLE for each
+# dataset as soon as its image series under RAW_DATA_BASE_DIR is complete.
+# A series is complete when its expected last frame is there and no frame was added
+# for WATCH_SETTLE_SECONDS, or when no frame was added for WATCH_QUIET_SECONDS.
+#   - WATCH_METHOD: "auto" (inotify, or polling on NFS and other network filesystems),
+#                   "inotify" or "poll" (every WATCH_POLL_SECONDS).
+#   - WATCH_EXPECTED_FRAMES: frames per series; None = the DATA_RANGE of XDS.INP.
+#   - WATCH_EXISTING: also process the series already complete when the watch starts.
+#   - WATCH_STOP_IDLE_HOURS: stop when no new series arrived for this long (None = run until Ctrl-C).
+WATCH_METHOD = "auto"
+WATCH_POLL_SECONDS = 30
+WATCH_SETTLE_SECONDS = 10
+WATCH_QUIET_SECONDS = 300
+WATCH_EXPECTED_FRAMES = None
+WATCH_EXISTING = True
+WATCH_STOP_IDLE_HOURS = None
+
+# Processing order of the datasets of a run; earlier entries decide first:
+#   "priority"    - datasets below the paths in PRIORITY_FILE first, in the order of the file
+#   "unprocessed" - datasets without a completed stage first (reruns)
+#   "shortest"    - shortest estimated runtime first (frame count, timings in RESULTS_DB)
+#   "path"        - sorted by path below ROOT_DIR (always the final tie-break)
+DATASET_ORDER = ["priority", "unprocessed", "shortest"]
+# Text file with one path below ROOT_DIR per line (e.g. Puck01/Pin03 or Puck02),
+# most important first; blank lines and # comments are ignored. None = no priorities.
+PRIORITY_FILE = None
+# Runtime per frame assumed until RESULTS_DB has timings of this visit.
+ESTIMATE_SECONDS_PER_FRAME = 0.5
+
+# Quick look (MODE = "quick-look"): XDS and CCP4 on the first QUICK_LOOK_DEGREES of every
+# dataset, in QUICK_LOOK_DIR below its processing folder, for a first verdict (summary row
+# "<dataset>_quick"). The full pass of each dataset follows as soon as all quick looks are
+# handed out, in the order they finish; with QUICK_LOOK_SKIP_FAILED not for datasets whose
+# quick look failed. QUICK_LOOK_FULL_PASS = False stops after the quick looks.
+QUICK_LOOK_DEGREES = 90
+QUICK_LOOK_DIR = "quick_look"
+QUICK_LOOK_SKIP_FAILED = True
+QUICK_LOOK_FULL_PASS = True
+
+# Dataset discovery cache. The directory listing of ROOT_DIR is stored here and
+# only directories whose modification time changed are listed again on the next run.
+# None = always scan the whole tree.
+DISCOVERY_MANIFEST = os.path.join(ROOT_DIR, "dataset_manifest.json")
+# Directory names that are never searched for datasets (tool output / scratch).
+# DIMPLE_OUTDIR is always skipped as well.
+DISCOVERY_PRUNE_DIRS = ["CCP4_SCRATCH"]
+# Cache of the image series found under RAW_DATA_BASE_DIR (same rules as above).
+RAW_INDEX_MANIFEST = os.path.join(ROOT_DIR, "raw_frame_index.json")
+
+# Reruns: skip XDS / CCP4 / DIMPLE for a dataset when the inputs of that stage
+# (XDS.INP, raw frames, reflection files, reference PDB, tools, settings) and
+# its outputs are unchanged since its last successful run.
+SKIP_UP_TO_DATE = True
+
+# Quick check of XDS_ASCII.HKL before any CCP4 program runs (needs NumPy).
+# Datasets with fewer unique reflections than TRIAGE_MIN_UNIQUE, or whose estimated
+# resolution is worse than TRIAGE_MAX_RESOLUTION (Angstrom, None = no limit), are
+# rejected without running CCP4.
+TRIAGE = True
+TRIAGE_MIN_UNIQUE = 500
+TRIAGE_MAX_RESOLUTION = None
+# Estimated merged I/sigma(I) at the edge of the resolution estimate.
+TRIAGE_ISIGI_CUTOFF = 1.5
+# Give the resolution estimate to aimless as its high-resolution limit.
+TRIAGE_APPLY_CUTOFF = False
+
 # In aimless-only mode: which file triggers CCP4?
 #   - If this is *.HKL  → start from HKL, run pointless + aimless.
 #   - If this is *.mtz  → start from MTZ, run aimless only.
@@ -90,6 +295,64 @@ class PipelineEnv:
     summary_file: str
     aimless_input_file: str
     debug: bool = False
+    max_concurrent_datasets: int = 1
+    total_cores: int | None = None
+    scheduler: str = "pool"
+    xds_workers: int = 2
+    ccp4_workers: int = 4
+    dimple_workers: int = 4
+    stage_queue_size: int = 4
+    discovery_manifest: str | None = None
+    discovery_prune_dirs: tuple = ("CCP4_SCRATCH",)
+    raw_index_manifest: str | None = None
+    skip_up_to_date: bool = True
+    ccp4_env_cache: str | None = None
+    freer_flags: str = "builtin"
+    freer_fraction: float = 0.05
+    freer_reference_dir: str | None = None
+    freer_seed_mtz: str | None = None
+    triage: bool = True
+    triage_min_unique: int = 500
+    triage_max_resolution: float | None = None
+    triage_isigi_cutoff: float = 1.5
+    triage_apply_cutoff: bool = False
+    xds_parallelism: str | None = "auto"
+    xds_tuning_file: str | None = None
+    xds_memory_fraction: float = 0.5
+    xds_benchmark_frames: int = 400
+    frame_cache_dir: str | None = None
+    frame_cache_max_gb: float = 100
+    frame_prefetch_datasets: int = 2
+    frame_staging_threads: int = 8
+    frame_check: bool = True
+    frame_check_threads: int = 8
+    xds_inp_from_header: str | None = "fill"
+    spot_wedges: int | None = None
+    spot_wedge_degrees: float = 5
+    spot_wedge_spacing_degrees: float = 45
+    frame_cache_decompress: bool = False
+    events_file: str | None = None
+    host_sample_seconds: float | None = None
+    results_db: str | None = None
+    work_queue: str | None = None
+    work_mode: str = "full"
+    lease_seconds: float = 600
+    lease_max_attempts: int = 3
+    work_poll_seconds: float = 10
+    watch_method: str = "auto"
+    watch_poll_seconds: float = 30
+    watch_settle_seconds: float = 10
+    watch_quiet_seconds: float = 300
+    watch_expected_frames: int | None = None
+    watch_existing: bool = True
+    watch_stop_idle_hours: float | None = None
+    dataset_order: list = field(default_factory=lambda: ["path"])
+    priority_file: str | None = None
+    estimate_seconds_per_frame: float = 0.5
+    quick_look_degrees: float = 90
+    quick_look_dir: str = "quick_look"
+    quick_look_skip_failed: bool = True
+    quick_look_full_pass: bool = True
 
 
 ENV = PipelineEnv(
@@ -110,6 +373,64 @@ ENV = PipelineEnv(
     summary_file=SUMMARY_FILE,
     aimless_input_file=AIMLESS_INPUT_FILE,
     debug=DEBUG,
+    max_concurrent_datasets=MAX_CONCURRENT_DATASETS,
+    total_cores=TOTAL_CORES,
+    scheduler=SCHEDULER,
+    xds_workers=XDS_WORKERS,
+    ccp4_workers=CCP4_WORKERS,
+    dimple_workers=DIMPLE_WORKERS,
+    stage_queue_size=STAGE_QUEUE_SIZE,
+    discovery_manifest=DISCOVERY_MANIFEST,
+    discovery_prune_dirs=tuple(DISCOVERY_PRUNE_DIRS),
+    raw_index_manifest=RAW_INDEX_MANIFEST,
+    skip_up_to_date=SKIP_UP_TO_DATE,
+    ccp4_env_cache=CCP4_ENV_CACHE,
+    freer_flags=FREER_FLAGS,
+    freer_fraction=FREER_FRACTION,
+    freer_reference_dir=FREER_REFERENCE_DIR,
+    freer_seed_mtz=FREER_SEED_MTZ,
+    triage=TRIAGE,
+    triage_min_unique=TRIAGE_MIN_UNIQUE,
+    triage_max_resolution=TRIAGE_MAX_RESOLUTION,
+    triage_isigi_cutoff=TRIAGE_ISIGI_CUTOFF,
+    triage_apply_cutoff=TRIAGE_APPLY_CUTOFF,
+    xds_parallelism=XDS_PARALLELISM,
+    xds_tuning_file=XDS_TUNING_FILE,
+    xds_memory_fraction=XDS_MEMORY_FRACTION,
+    xds_benchmark_frames=XDS_BENCHMARK_FRAMES,
+    frame_cache_dir=FRAME_CACHE_DIR,
+    frame_cache_max_gb=FRAME_CACHE_MAX_GB,
+    frame_prefetch_datasets=FRAME_PREFETCH_DATASETS,
+    frame_staging_threads=FRAME_STAGING_THREADS,
+    frame_check=FRAME_CHECK,
+    frame_check_threads=FRAME_CHECK_THREADS,
+    xds_inp_from_header=XDS_INP_FROM_HEADER,
+    spot_wedges=SPOT_WEDGES,
+    spot_wedge_degrees=SPOT_WEDGE_DEGREES,
+    spot_wedge_spacing_degrees=SPOT_WEDGE_SPACING_DEGREES,
+    frame_cache_decompress=FRAME_CACHE_DECOMPRESS,
+    events_file=EVENTS_FILE,
+    host_sample_seconds=HOST_SAMPLE_SECONDS,
+    results_db=RESULTS_DB,
+    work_queue=WORK_QUEUE,
+    work_mode=WORK_MODE,
+    lease_seconds=LEASE_SECONDS,
+    lease_max_attempts=LEASE_MAX_ATTEMPTS,
+    work_poll_seconds=WORK_POLL_SECONDS,
+    watch_method=WATCH_METHOD,
+    watch_poll_seconds=WATCH_POLL_SECONDS,
+    watch_settle_seconds=WATCH_SETTLE_SECONDS,
+    watch_quiet_seconds=WATCH_QUIET_SECONDS,
+    watch_expected_frames=WATCH_EXPECTED_FRAMES,
+    watch_existing=WATCH_EXISTING,
+    watch_stop_idle_hours=WATCH_STOP_IDLE_HOURS,
+    dataset_order=DATASET_ORDER,
+    priority_file=PRIORITY_FILE,
+    estimate_seconds_per_frame=ESTIMATE_SECONDS_PER_FRAME,
+    quick_look_degrees=QUICK_LOOK_DEGREES,
+    quick_look_dir=QUICK_LOOK_DIR,
+    quick_look_skip_failed=QUICK_LOOK_SKIP_FAILED,
+    quick_look_full_pass=QUICK_LOOK_FULL_PASS,
 )
 
 
@@ -117,51 +438,264 @@ ENV = PipelineEnv(
 # UTILS
 # ============================================================
 
-def run_cmd(cmd, cwd, timeout, env: PipelineEnv):
+@dataclass
+class ResourceUsage:
+    """
+    Resources used by external commands, from wait4(). Block I/O is what the
+    kernel counts as filesystem reads and writes; peak RSS is that of the
+    largest single process, not the sum over the process tree, and never less
+    than this script's own size at the fork.
+    """
+    wall: float = 0.0
+    user_cpu: float = 0.0
+    sys_cpu: float = 0.0
+    max_rss_kb: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    commands: int = 0
+
+    @property
+    def cpu(self):
+        return self.user_cpu + self.sys_cpu
+
+    def add(self, other: "ResourceUsage"):
+        self.wall += other.wall
+        self.user_cpu += other.user_cpu
+        self.sys_cpu += other.sys_cpu
+        self.max_rss_kb = max(self.max_rss_kb, other.max_rss_kb)
+        self.read_bytes += other.read_bytes
+        self.write_bytes += other.write_bytes
+        self.commands += other.commands
+
+
+@dataclass
+class CmdResult:
+    ok: bool
+    returncode: int
+    timed_out: bool
+    usage: ResourceUsage = field(default_factory=ResourceUsage)
+
+
+# ru_inblock / ru_oublock count 512-byte blocks.
+RUSAGE_BLOCK_BYTES = 512
+
+# After SIGTERM to a timed-out process group, wait this long before SIGKILL.
+KILL_GRACE_SECONDS = 10.0
+
+_usage_sink = threading.local()
+
+
+def usage_from_rusage(ru, wall):
+    return ResourceUsage(
+        wall=wall,
+        user_cpu=ru.ru_utime,
+        sys_cpu=ru.ru_stime,
+        max_rss_kb=ru.ru_maxrss,
+        read_bytes=ru.ru_inblock * RUSAGE_BLOCK_BYTES,
+        write_bytes=ru.ru_oublock * RUSAGE_BLOCK_BYTES,
+        commands=1,
+    )
+
+
+def collect_usage(usage: ResourceUsage | None):
+    """
+    Add the usage of every run_cmd() in this thread to usage (None stops collecting).
+    """
+    _usage_sink.usage = usage
+
+
+def kill_process_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def wait_process(pid, deadline=None):
+    """
+    wait4() for pid, polling so a deadline can be kept.
+    Returns (status, rusage), or None if the deadline passed first.
+    """
+    delay = 0.01
+    while True:
+        wpid, status, ru = os.wait4(pid, os.WNOHANG)
+        if wpid == pid:
+            return status, ru
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(delay if deadline is None else max(0.0, min(delay, deadline - time.monotonic())))
+        delay = min(delay * 2, 0.5)
+
+
+def run_cmd(cmd, cwd, timeout, env: PipelineEnv, log_path=None, stdin_text=None, proc_env=None):
+    """
+    Run cmd (an argument list) in its own session, so that on timeout the whole
+    process tree (bash, xds_par and its forked jobs, ...) is killed, not just
+    the top process. With log_path, stdout and stderr go to that file.
+    Returns a CmdResult with the wait4() resource usage of the tree.
+    """
+    log = None
+    p = None
+    start = time.monotonic()
+    started = time.time()
     try:
-        if env.debug:
+        if log_path is not None:
+            log = open(os.path.join(cwd, log_path), "w")
+            stdout = log
+            stderr = subprocess.STDOUT
+        elif env.debug:
             stdout = None
             stderr = None
         else:
             stdout = subprocess.DEVNULL
             stderr = subprocess.DEVNULL
 
-        p = subprocess.run(
+        p = subprocess.Popen(
             cmd,
             cwd=cwd,
+            stdin=subprocess.DEVNULL if stdin_text is None else subprocess.PIPE,
             stdout=stdout,
             stderr=stderr,
+            env=proc_env,
             text=True,
-            timeout=timeout,
+            start_new_session=True,
         )
-        return p.returncode == 0, p.returncode, False
-    except subprocess.TimeoutExpired:
-        return False, 124, True
-    except Exception:
-        return False, 125, False
-
-
-def write_summary_header(summary_path):
-    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
-    with open(summary_path, "w") as f:
-        f.write("dataset\tspace_group\tresolution_A\tdimple_ok\tblobs\n")
-
-
-def append_summary_line(summary_path, dataset_id, space_group, resolution, dimple_ok, blobs):
-    with open(summary_path, "a") as f:
-        f.write(f"{dataset_id}\t{space_group}\t{resolution}\t{dimple_ok}\t{blobs}\n")
+        if stdin_text is not None:
+            try:
+                p.stdin.write(stdin_text)
+            except BrokenPipeError:
+                pass
+            finally:
+                p.stdin.close()
+
+        deadline = None if timeout is None else start + timeout
+        waited = wait_process(p.pid, deadline)
+        timed_out = waited is None
+        if timed_out:
+            kill_process_group(p.pid, signal.SIGTERM)
+            waited = wait_process(p.pid, time.monotonic() + KILL_GRACE_SECONDS)
+            if waited is None:
+                kill_process_group(p.pid, signal.SIGKILL)
+                waited = wait_process(p.pid)
+        status, ru = waited
+        # Workers the top process left running in the background go too.
+        kill_process_group(p.pid, signal.SIGKILL)
+        p.returncode = os.waitstatus_to_exitcode(status)
+
+        usage = usage_from_rusage(ru, time.monotonic() - start)
+        if timed_out:
+            result = CmdResult(False, 124, True, usage)
+        else:
+            result = CmdResult(p.returncode == 0, p.returncode, False, usage)
+    except BaseException as e:
+        if p is not None and p.returncode is None:
+            kill_process_group(p.pid, signal.SIGKILL)
+            p.wait()
+        if not isinstance(e, Exception):
+            raise
+        result = CmdResult(False, 125, False, ResourceUsage(wall=time.monotonic() - start))
+    finally:
+        if log is not None:
+            log.close()
+
+    sink = getattr(_usage_sink, "usage", None)
+    if sink is not None:
+        sink.add(result.usage)
+    usage = result.usage
+    event_log.timed("tool", started, time.time(), tool=tool_name(cmd), returncode=result.returncode,
+                    timed_out=result.timed_out, user_cpu=round(usage.user_cpu, 3),
+                    sys_cpu=round(usage.sys_cpu, 3), max_rss_kb=usage.max_rss_kb,
+                    read_bytes=usage.read_bytes, write_bytes=usage.write_bytes)
+    return result
+
+
+def tool_name(cmd):
+    """
+    Program name for the event log; for `bash -c "prog args"` the program inside.
+    """
+    if os.path.basename(cmd[0]) == "bash" and len(cmd) > 2 and cmd[1] in ("-c", "-lc"):
+        words = cmd[-1].split()
+        if words:
+            return os.path.basename(words[0])
+    return os.path.basename(cmd[0])
 
 
 def print_counter(counts, env: PipelineEnv):
+    def skipped(stage):
+        n = counts[f"{stage}_skipped"]
+        return f"   ({n} up to date)" if n else ""
+
     print(f"\n{'='*52}")
-    print(f"  XDS:    {counts['xds_ok']:>4} OK   /  {counts['xds_fail']:>4} FAILED")
-    print(f"  CCP4:   {counts['ccp4_ok']:>4} OK   /  {counts['ccp4_fail']:>4} FAILED")
+    bad_frames = f"   ({counts['xds_rejected']} with bad frames)" if counts["xds_rejected"] else ""
+    print(f"  XDS:    {counts['xds_ok']:>4} OK   /  {counts['xds_fail']:>4} FAILED{skipped('xds')}{bad_frames}")
+    rejected = f"   ({counts['ccp4_rejected']} rejected by triage)" if counts["ccp4_rejected"] else ""
+    print(f"  CCP4:   {counts['ccp4_ok']:>4} OK   /  {counts['ccp4_fail']:>4} FAILED{skipped('ccp4')}{rejected}")
     if env.dimple_pdb is not None:
-        print(f"  DIMPLE: {counts['dimple_ok']:>4} OK   /  {counts['dimple_fail']:>4} FAILED")
+        print(f"  DIMPLE: {counts['dimple_ok']:>4} OK   /  {counts['dimple_fail']:>4} FAILED{skipped('dimple')}")
         print(f"  Blobs:  {counts['blobs_found']:>4} dataset(s) with potential ligand density")
+    if counts["usage"]:
+        print("  Resources (stage wall / command CPU / peak RSS / read / written):")
+        for stage, usage in counts["usage"].items():
+            print(f"    {stage:<7}{format_hours(usage.wall):>9} {format_hours(usage.cpu):>9} "
+                  f"{format_bytes(usage.max_rss_kb * 1024):>9} {format_bytes(usage.read_bytes):>9} "
+                  f"{format_bytes(usage.write_bytes):>9}")
     print(f"{'='*52}\n")
 
 
+def new_run_id():
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+
+
+def open_results(env: PipelineEnv, mode, run_id):
+    # Without RESULTS_DB the summary lists the datasets of this run only.
+    path = env.results_db or ":memory:"
+    return results_db.ResultsDB(path, run_id, mode, env.root_dir, host=socket.gethostname())
+
+
+def close_results(results: results_db.ResultsDB, env: PipelineEnv):
+    results.flush()
+    results.write_summary(env.summary_file)
+    results.close()
+
+
+def open_run_log(env: PipelineEnv, mode, run_id):
+    if env.events_file is None:
+        return None
+    return event_log.RunLog(env.events_file, mode, run_id, env.host_sample_seconds)
+
+
+def close_run_log(run_log, counts):
+    """
+    Close the event log and print the run report.
+    """
+    if run_log is None:
+        return
+    run_log.close()
+    for line in event_log.report(run_log, counts["datasets"]):
+        print(line)
+    print()
+
+
+def format_hours(seconds):
+    return f"{seconds / 3600:.2f} h" if seconds >= 360 else f"{seconds:.0f} s"
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def new_counts():
+    return {"xds_ok": 0, "xds_fail": 0, "ccp4_ok": 0, "ccp4_fail": 0,
+            "dimple_ok": 0, "dimple_fail": 0, "blobs_found": 0,
+            "xds_skipped": 0, "ccp4_skipped": 0, "dimple_skipped": 0,
+            "xds_rejected": 0, "ccp4_rejected": 0,
+            "datasets": 0, "usage": {}}
+
+
 # ============================================================
 # DATASET HANDLING
 # ============================================================
@@ -172,6 +706,10 @@ class Dataset:
     dataset_dir: str
     dataset_rel: str
     dataset_id: str
+    # Quick-look pass: XDS and CCP4 on the first this many degrees only.
+    quick_look_degrees: float | None = None
+    # Estimated processing time (see order_datasets()).
+    estimated_seconds: float | None = None
 
 
 def derive_dataset_info_from_xds_dir(xds_dir, root_dir) -> Dataset:
@@ -187,35 +725,386 @@ def derive_dataset_info_from_xds_dir(xds_dir, root_dir) -> Dataset:
 
 
 # ============================================================
-# XDS HANDLING
+# DISCOVERY
+# ============================================================
+
+# Files that make a directory interesting to one of the modes.
+MARKER_FILES = ("XDS.INP", "XDS_ASCII.HKL", "XDS_ASCII.mtz", "Final_with_FreeR.mtz", "aimless.log")
+
+# A directory modified this recently may still change within the same mtime tick,
+# so its cached listing is not trusted on the next run.
+MANIFEST_MTIME_SLACK_SECONDS = 2
+
+
+def load_manifest(manifest_path, signature):
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("signature") != signature:
+        return {}
+    return manifest.get("dirs", {})
+
+
+def save_manifest(manifest_path, signature, dirs):
+    tmp = f"{manifest_path}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"signature": signature, "dirs": dirs}, f)
+        os.replace(tmp, manifest_path)
+    except OSError as e:
+        print(f"Could not write discovery manifest {manifest_path}: {e}")
+
+
+def scan_tree(root, prune, summarize, manifest_path=None, signature=None):
+    """
+    List every directory under root (except pruned names) with os.scandir.
+
+    summarize(entries) turns the DirEntry list of one directory into JSON data.
+    With a manifest, a directory whose mtime did not change since the last scan
+    is not listed again; its cached subdirectories and data are reused.
+    Returns {relative_dir: data}.
+    """
+    # Round-trip through JSON so it compares equal to the stored copy.
+    signature = json.loads(json.dumps([signature, sorted(prune)]))
+    cached = load_manifest(manifest_path, signature)
+    scanned = {}
+    rescanned = 0
+    now = time.time()
+
+    stack = ["."]
+    while stack:
+        rel = stack.pop()
+        path = root if rel == "." else os.path.join(root, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        entry = cached.get(rel)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns:
+            rescanned += 1
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            subdirs = sorted(
+                e.name for e in entries
+                if e.name not in prune and e.is_dir(follow_symlinks=False)
+            )
+            mtime_ns = st.st_mtime_ns
+            if now - st.st_mtime < MANIFEST_MTIME_SLACK_SECONDS:
+                mtime_ns = -1
+            entry = {"mtime_ns": mtime_ns, "subdirs": subdirs, "data": summarize(entries)}
+
+        scanned[rel] = entry
+        for name in reversed(entry["subdirs"]):
+            stack.append(name if rel == "." else os.path.join(rel, name))
+
+    if manifest_path is not None and (rescanned or len(scanned) != len(cached)):
+        save_manifest(manifest_path, signature, scanned)
+
+    print(f"Discovery under {root}: {len(scanned)} directories, {rescanned} listed")
+    return {rel: entry["data"] for rel, entry in scanned.items()}
+
+
+def summarize_markers(entries, markers=MARKER_FILES):
+    return sorted(e.name for e in entries if e.name in markers)
+
+
+def discovery_prune(env: PipelineEnv):
+    return set(env.discovery_prune_dirs) | {env.dimple_outdir, env.quick_look_dir}
+
+
+def find_datasets(env: PipelineEnv, marker_file):
+    """
+    Return one Dataset per directory under env.root_dir that contains marker_file,
+    sorted by path.
+    """
+    markers = tuple(sorted(set(MARKER_FILES) | {env.aimless_input_file}))
+    with event_log.phase("discovery", marker=marker_file):
+        tree = scan_tree(
+            env.root_dir,
+            discovery_prune(env),
+            partial(summarize_markers, markers=markers),
+            env.discovery_manifest,
+            signature=["markers", markers],
+        )
+    datasets = []
+    for rel in sorted(tree):
+        if marker_file in tree[rel]:
+            subdir = os.path.normpath(os.path.join(env.root_dir, rel))
+            datasets.append(derive_dataset_info_from_xds_dir(subdir, env.root_dir))
+    return datasets
+
+
+def find_files_named(top, name, prune=()):
+    """
+    Return paths of all files called name below top, skipping pruned directory names.
+    """
+    found = []
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if e.name not in prune:
+                            stack.append(e.path)
+                    elif e.name == name:
+                        found.append(e.path)
+        except OSError:
+            continue
+    return found
+
+
+# ============================================================
+# RAW FRAME INDEX
+# ============================================================
+
+FRAME_NAME_RE = re.compile(r"^(.*?)(\d+)\.cbf\.gz$")
+
+
+@dataclass
+class FrameSeries:
+    directory: str
+    prefix: str
+    width: int
+    first: int
+    last: int
+    count: int
+    # Missing frame numbers between first and last, as [start, end] pairs.
+    missing: list
+    suffix: str = ".cbf.gz"
+
+    @property
+    def template(self):
+        return os.path.join(self.directory, f"{self.prefix}{'?' * self.width}{self.suffix}")
+
+    def frame_name(self, number):
+        return f"{self.prefix}{number:0{self.width}d}{self.suffix}"
+
+    def frame_path(self, number):
+        return os.path.join(self.directory, self.frame_name(number))
+
+    def contiguous_range(self):
+        """
+        Longest run of frames without gaps, as (first, last).
+        """
+        best = (self.first, self.first - 1)
+        start = self.first
+        for gap_start, gap_end in self.missing + [[self.last + 1, self.last + 1]]:
+            if gap_start - 1 - start > best[1] - best[0]:
+                best = (start, gap_start - 1)
+            start = gap_end + 1
+        return best
+
+
+def summarize_frame_series(entries):
+    """
+    Group the .cbf.gz files of one directory into image series.
+    """
+    numbers = {}
+    for e in entries:
+        m = FRAME_NAME_RE.match(e.name)
+        if m:
+            prefix, digits = m.groups()
+            numbers.setdefault((prefix, len(digits)), []).append(int(digits))
+
+    series = []
+    for (prefix, width), nums in sorted(numbers.items()):
+        nums.sort()
+        missing = []
+        for a, b in zip(nums, nums[1:]):
+            if b > a + 1:
+                missing.append([a + 1, b - 1])
+        series.append({
+            "prefix": prefix,
+            "width": width,
+            "first": nums[0],
+            "last": nums[-1],
+            "count": len(nums),
+            "missing": missing,
+        })
+    return series
+
+
+def build_raw_index(env: PipelineEnv):
+    """
+    Index all image series under env.raw_data_base_dir once per run.
+    Returns {relative_dir: [series dict, ...]}.
+    """
+    with event_log.phase("raw_index"):
+        return scan_tree(
+            env.raw_data_base_dir,
+            set(),
+            summarize_frame_series,
+            env.raw_index_manifest,
+            signature="frame-series",
+        )
+
+
+# (raw index, number of entries, its directories sorted) of the index last searched.
+# Entries are only ever added to an index, so a changed size means new directories.
+_sorted_raw_dirs = (None, 0, [])
+
+
+def sorted_raw_dirs(raw_index):
+    global _sorted_raw_dirs
+    index, size, dirs = _sorted_raw_dirs
+    if index is not raw_index or size != len(raw_index):
+        # sorted() copies the keys: in watch mode the index grows while datasets run.
+        dirs = sorted(raw_index)
+        _sorted_raw_dirs = (raw_index, len(dirs), dirs)
+    return dirs
+
+
+def frame_series_for_dataset(raw_index, raw_base, dataset_rel):
+    """
+    All image series stored in or below raw_base/dataset_rel.
+    """
+    rel = os.path.normpath(dataset_rel)
+    if rel not in raw_index:
+        raise FileNotFoundError(f"Raw dataset directory not found: {os.path.join(raw_base, dataset_rel)}")
+
+    dirs = sorted_raw_dirs(raw_index)
+    if rel == ".":
+        below = dirs
+    else:
+        # The directories below rel sort between "rel/" and "rel0" ("0" follows "/").
+        below = [rel] + dirs[bisect.bisect_left(dirs, rel + os.sep):bisect.bisect_left(dirs, rel + "0")]
+    found = []
+    for dir_rel in below:
+        directory = os.path.normpath(os.path.join(raw_base, dir_rel))
+        found.extend(FrameSeries(directory=directory, **data) for data in raw_index.get(dir_rel, ()))
+    return found
+
+
+def select_frame_series(raw_index, raw_base, dataset_rel, prefix_hint=None, quiet=False) -> FrameSeries:
+    """
+    Pick the image series to process: the largest one whose file names
+    start with prefix_hint.
+    """
+    candidates = [
+        series for series in frame_series_for_dataset(raw_index, raw_base, dataset_rel)
+        if prefix_hint is None or series.frame_name(series.first).startswith(prefix_hint)
+    ]
+    if not candidates:
+        raise FileNotFoundError(f"No matching .cbf.gz found under: {os.path.join(raw_base, dataset_rel)}")
+
+    candidates.sort(key=lambda series: (-series.count, series.template))
+    if len(candidates) > 1 and not quiet:
+        others = ", ".join(f"{os.path.basename(c.template)} ({c.count})" for c in candidates[1:])
+        print(f"  Several image series for '{dataset_rel}', using the largest; ignored: {others}")
+    return candidates[0]
+
+
+# ============================================================
+# FRAME STAGING
 # ============================================================
 
-def find_name_template_in_raw_data(raw_base, dataset_rel, prefix_hint=None):
-    search_root = os.path.join(raw_base, dataset_rel)
-    if not os.path.isdir(search_root):
-        raise FileNotFoundError(f"Raw dataset directory not found: {search_root}")
+def series_frame_names(series: FrameSeries, data_range=None):
+    """
+    File names of the frames XDS reads: DATA_RANGE, or the longest run without gaps.
+    """
+    data_range = data_range or "{} {}".format(*series.contiguous_range())
+    first, last = (int(v) for v in data_range.split()[:2])
+    return [series.frame_name(n) for n in range(first, last + 1)]
+
+
+class FrameStaging:
+    """
+    Copies the frames of the dataset about to run XDS, and of the next
+    env.frame_prefetch_datasets datasets of the run, into env.frame_cache_dir.
+    """
+
+    def __init__(self, env: PipelineEnv, datasets, raw_index):
+        self.env = env
+        self.raw_index = raw_index
+        self.order = [ds.dataset_id for ds in datasets]
+        self.datasets = {ds.dataset_id: ds for ds in datasets}
+        self.requested = set()
+        self.lock = threading.Lock()
+        self.cache = frame_cache.FrameCache(
+            env.frame_cache_dir,
+            int(env.frame_cache_max_gb * (1 << 30)),
+            threads=env.frame_staging_threads,
+            decompress=env.frame_cache_decompress,
+        )
+        print(f"Frame staging in {env.frame_cache_dir} "
+              f"({self.cache.used_bytes() / (1 << 30):.1f} of {env.frame_cache_max_gb} GB in use)")
+
+    def prefetch(self, ds: Dataset, series: FrameSeries):
+        with self.lock:
+            if ds.dataset_id in self.requested:
+                return
+            self.requested.add(ds.dataset_id)
+        self.cache.prefetch(ds.dataset_id, series.directory, series_frame_names(series, self.env.data_range))
+
+    def prefetch_after(self, ds: Dataset):
+        """
+        Start staging the next datasets of the run, skipping ones whose XDS output is current.
+        """
+        index = self.order.index(ds.dataset_id)
+        for dataset_id in self.order[index + 1:index + 1 + self.env.frame_prefetch_datasets]:
+            upcoming = self.datasets[dataset_id]
+            if xds_outputs_current(upcoming.processing_dir, self.env):
+                continue
+            try:
+                series = select_frame_series(self.raw_index, self.env.raw_data_base_dir,
+                                             upcoming.dataset_rel, self.env.prefix_hint, quiet=True)
+            except FileNotFoundError:
+                continue
+            self.prefetch(upcoming, series)
+
+    def acquire(self, ds: Dataset, series: FrameSeries):
+        """
+        The staged copy of series (pinned until release), or None to use the raw frames.
+        """
+        self.prefetch(ds, series)
+        self.prefetch_after(ds)
+        directory = self.cache.acquire(ds.dataset_id, series.directory,
+                                       series_frame_names(series, self.env.data_range))
+        if directory is None:
+            reason = self.cache.failure(ds.dataset_id) or "does not fit in the frame cache"
+            print(f"    Frames not staged ({reason}); reading them from the raw data directory")
+            return None
+        suffix = ".cbf" if self.env.frame_cache_decompress and series.suffix.endswith(".gz") else series.suffix
+        return replace(series, directory=directory, suffix=suffix)
+
+    def release(self, ds: Dataset):
+        self.cache.release(ds.dataset_id)
 
-    for root, _, files in os.walk(search_root):
-        for file in files:
-            if file.endswith(".cbf.gz") and (prefix_hint is None or file.startswith(prefix_hint)):
-                wildcard_file = re.sub(r"_(\d+)\.cbf\.gz$", r"_?????.cbf.gz", file)
-                return os.path.join(root, wildcard_file)
+    def close(self):
+        self.cache.close()
 
-    raise FileNotFoundError(f"No matching .cbf.gz found under: {search_root}")
 
+# ============================================================
+# XDS HANDLING
+# ============================================================
 
 def transform_xds_inp_auto_template(
     inp,
-    raw_base,
-    dataset_rel,
-    prefix_hint=None,
+    series: FrameSeries,
     space_group_number=None,
     unit_cell_constants=None,
     data_range=None,
     spot_range=None,
     detector_type=None,
+    max_processors=None,
+    max_jobs=None,
+    images_in_cache=None,
 ):
-    name_template = find_name_template_in_raw_data(raw_base, dataset_rel, prefix_hint)
+    name_template = series.template
+    if not data_range:
+        data_range = "{} {}".format(*series.contiguous_range())
+    # spot_range may be a list of ranges, one SPOT_RANGE= line each.
+    spot_ranges = spot_range if isinstance(spot_range, list) else [spot_range or data_range]
 
     with open(inp, "r") as f:
         lines = f.readlines()
@@ -224,6 +1113,11 @@ def transform_xds_inp_auto_template(
     has_sg = False
     has_uc = False
     has_detector = False
+    has_max_processors = False
+    has_max_jobs = False
+    has_cache = False
+    has_data_range = False
+    has_spot_range = False
 
     for line in lines:
         s = line.lstrip()
@@ -255,14 +1149,31 @@ def transform_xds_inp_auto_template(
             continue
 
         if s.startswith("MAXIMUM_NUMBER_OF_JOBS="):
-            new_lines.append("!" + line if not s.startswith("!") else line)
+            if max_jobs is not None:
+                has_max_jobs = True
+                new_lines.append(f"MAXIMUM_NUMBER_OF_JOBS= {max_jobs}\n")
+            else:
+                new_lines.append("!" + line)
+            continue
+
+        if s.startswith("NUMBER_OF_IMAGES_IN_CACHE=") and images_in_cache is not None:
+            has_cache = True
+            new_lines.append(f"NUMBER_OF_IMAGES_IN_CACHE= {images_in_cache}\n")
+            continue
+
+        if s.startswith("MAXIMUM_NUMBER_OF_PROCESSORS=") and max_processors is not None:
+            has_max_processors = True
+            new_lines.append(f"MAXIMUM_NUMBER_OF_PROCESSORS= {max_processors}\n")
             continue
 
-        if s.startswith("SPOT_RANGE=") and spot_range:
-            new_lines.append(f"SPOT_RANGE= {spot_range}\n")
+        if s.startswith("SPOT_RANGE="):
+            if not has_spot_range:
+                new_lines += [f"SPOT_RANGE= {r}\n" for r in spot_ranges]
+            has_spot_range = True
             continue
 
-        if s.startswith("DATA_RANGE=") and data_range:
+        if s.startswith("DATA_RANGE="):
+            has_data_range = True
             new_lines.append(f"DATA_RANGE= {data_range}\n")
             continue
 
@@ -274,6 +1185,12 @@ def transform_xds_inp_auto_template(
 
         new_lines.append(line)
 
+    if not has_data_range:
+        new_lines.append(f"DATA_RANGE= {data_range}\n")
+
+    if not has_spot_range:
+        new_lines += [f"SPOT_RANGE= {r}\n" for r in spot_ranges]
+
     if detector_type is not None and not has_detector:
         new_lines.append(f"\nDETECTOR= {detector_type}\n")
         if detector_type.upper() == "EIGER":
@@ -285,6 +1202,15 @@ def transform_xds_inp_auto_template(
     if unit_cell_constants is not None and not has_uc:
         new_lines.append(f"UNIT_CELL_CONSTANTS= {unit_cell_constants}\n")
 
+    if max_processors is not None and not has_max_processors:
+        new_lines.append(f"MAXIMUM_NUMBER_OF_PROCESSORS= {max_processors}\n")
+
+    if max_jobs is not None and not has_max_jobs:
+        new_lines.append(f"MAXIMUM_NUMBER_OF_JOBS= {max_jobs}\n")
+
+    if images_in_cache is not None and not has_cache:
+        new_lines.append(f"NUMBER_OF_IMAGES_IN_CACHE= {images_in_cache}\n")
+
     backup = inp.replace("XDS.INP", "XDS_org.INP")
     if not os.path.exists(backup):
         shutil.copy2(inp, backup)
@@ -295,190 +1221,821 @@ def transform_xds_inp_auto_template(
     return True
 
 
+# Differences between XDS.INP and the frame header up to these are not reported (A, mm, deg, px).
+HEADER_TOLERANCES = {
+    "X-RAY_WAVELENGTH": 0.0005, "DETECTOR_DISTANCE": 0.5, "OSCILLATION_RANGE": 0.0005,
+    "ORGX": 2.0, "ORGY": 2.0, "QX": 0.0005, "QY": 0.0005, "SENSOR_THICKNESS": 0.005,
+}
+# Keywords "fill" takes from the header even when XDS.INP has them.
+HEADER_DETECTOR_KEYWORDS = ("DETECTOR", "MINIMUM_VALID_PIXEL_VALUE", "OVERLOAD")
+
+
+def series_frame_header(env: PipelineEnv, folder, series: FrameSeries):
+    """
+    Header of the first frame of the series (cached in the processing folder), or None.
+    """
+    if env.xds_inp_from_header is None:
+        return None
+    if env.xds_inp_from_header not in ("fill", "header", "check"):
+        raise ValueError(f"Unknown XDS_INP_FROM_HEADER='{env.xds_inp_from_header}'. "
+                         "Use 'fill', 'header', 'check' or None.")
+    header = cbf_frames.read_header(series.frame_path(series.first), cache_dir=folder)
+    if header is None:
+        print(f"    WARNING: could not read the header of {series.frame_name(series.first)}")
+    return header
+
+
+def header_xds_keywords(header: cbf_frames.FrameHeader):
+    """
+    {keyword: value} of the XDS.INP keywords the frame header gives.
+    """
+    values = {
+        "DETECTOR": header.detector_type,
+        "MINIMUM_VALID_PIXEL_VALUE": 0 if header.detector_type else None,
+        "OVERLOAD": header.count_cutoff,
+        "NX": header.nx,
+        "NY": header.ny,
+        "QX": header.pixel_x,
+        "QY": header.pixel_y,
+        "ORGX": header.beam_x,
+        "ORGY": header.beam_y,
+        "DETECTOR_DISTANCE": header.distance,
+        "X-RAY_WAVELENGTH": header.wavelength,
+        "OSCILLATION_RANGE": header.oscillation,
+        "SENSOR_THICKNESS": header.sensor_thickness,
+    }
+    return {key: f"{v:g}" if isinstance(v, float) else str(v) for key, v in values.items() if v is not None}
+
+
+def header_mismatches(keywords, values):
+    """
+    {keyword: XDS.INP value} where XDS.INP (xds_inp_keywords()) disagrees with the header values.
+    """
+    found = {}
+    for key, value in values.items():
+        if not keywords.get(key):
+            continue
+        current = keywords[key][-1]
+        try:
+            differs = abs(float(current.split()[0]) - float(value)) > HEADER_TOLERANCES.get(key, 0)
+        except (ValueError, IndexError):
+            differs = current.upper() != value.upper()
+        if differs:
+            found[key] = current
+    return found
+
+
+def apply_frame_header(xds_inp, header: cbf_frames.FrameHeader, how):
+    """
+    Fill or cross-check the geometry keywords of XDS.INP from a frame header (see XDS_INP_FROM_HEADER).
+    """
+    values = header_xds_keywords(header)
+    keywords = xds_inp_keywords(xds_inp)
+    mismatches = header_mismatches(keywords, values)
+    missing = {key: value for key, value in values.items() if not keywords.get(key)}
+    if how == "header":
+        update = {**missing, **{key: values[key] for key in mismatches}}
+    elif how == "fill":
+        update = {**missing, **{key: values[key] for key in mismatches if key in HEADER_DETECTOR_KEYWORDS}}
+    else:
+        update = {}
+    for key, current in mismatches.items():
+        action = "using the header" if key in update else "keeping XDS.INP"
+        print(f"    WARNING: XDS.INP has {key}= {current}, the frame header {values[key]}; {action}")
+    if update:
+        set_xds_inp_keywords(xds_inp, update)
+    return update
+
+
 def xds_failed_due_to_low_indexing(folder):
-    lp = os.path.join(folder, "IDXREF.LP")
-    if not os.path.isfile(lp):
-        return False
-    try:
-        with open(lp) as f:
-            txt = f.read()
-    except Exception:
-        return False
-    return "INSUFFICIENT PERCENTAGE" in txt and "INDEXED REFLECTIONS" in txt
+    return log_parser.idxref_low_indexing(os.path.join(folder, "IDXREF.LP"))
+
+
+XDS_INP_KEYWORD = re.compile(r"([A-Z][A-Z0-9_().'/\-]*)=")
+
+# Keywords that only CORRECT reads: changing them needs JOB= CORRECT on the existing INTEGRATE.HKL.
+XDS_CORRECT_KEYWORDS = frozenset({
+    "SPACE_GROUP_NUMBER", "UNIT_CELL_CONSTANTS", "REIDX", "FRIEDEL'S_LAW",
+    "TEST_RESOLUTION_RANGE", "STRICT_ABSORPTION_CORRECTION", "CORRECTIONS",
+    "MINIMUM_I/SIGMA", "NBATCH", "REFLECTIONS/CORRECTION_FACTOR", "REFERENCE_DATA_SET",
+    "REFINE(CORRECT)", "MAX_CELL_AXIS_ERROR", "MAX_CELL_ANGLE_ERROR", "WFAC1",
+    "PATCH_SHUTTER_PROBLEM", "MINIMUM_ZETA",
+})
+# Keywords read from DEFPIX onwards that do not change the indexing solution.
+XDS_INTEGRATE_KEYWORDS = frozenset({
+    "INCLUDE_RESOLUTION_RANGE", "EXCLUDE_RESOLUTION_RANGE", "DATA_RANGE", "EXCLUDE_DATA_RANGE",
+    "DELPHI", "REFINE(INTEGRATE)", "BEAM_DIVERGENCE", "BEAM_DIVERGENCE_E.S.D.",
+    "REFLECTING_RANGE", "REFLECTING_RANGE_E.S.D.", "NUMBER_OF_PROFILE_GRID_POINTS_ALONG_ALPHA/BETA",
+    "NUMBER_OF_PROFILE_GRID_POINTS_ALONG_GAMMA", "CUT", "MINPK", "PROFILE_FITTING",
+    "VALUE_RANGE_FOR_TRUSTED_DETECTOR_PIXELS",
+})
+# Keywords that IDXREF reads (geometry and indexing); SPOT.XDS stays valid.
+XDS_IDXREF_KEYWORDS = frozenset({
+    "ORGX", "ORGY", "DETECTOR_DISTANCE", "X-RAY_WAVELENGTH", "ROTATION_AXIS",
+    "INCIDENT_BEAM_DIRECTION", "OSCILLATION_RANGE", "STARTING_ANGLE", "STARTING_FRAME",
+    "FRACTION_OF_POLARIZATION", "POLARIZATION_PLANE_NORMAL", "DIRECTION_OF_DETECTOR_X-AXIS",
+    "DIRECTION_OF_DETECTOR_Y-AXIS", "INDEX_ORIGIN", "INDEX_ERROR", "INDEX_MAGNITUDE",
+    "INDEX_QUALITY", "MAXIMUM_ERROR_OF_SPOT_POSITION", "MAXIMUM_ERROR_OF_SPINDLE_POSITION",
+    "MINIMUM_FRACTION_OF_INDEXED_SPOTS", "SEPMIN", "CLUSTER_RADIUS", "REFINE(IDXREF)",
+    "UNIT_CELL_A-AXIS", "UNIT_CELL_B-AXIS", "UNIT_CELL_C-AXIS",
+})
+
+# Smallest job for a set of changed keywords, with the files that job reads.
+XDS_PARTIAL_JOBS = (
+    ("CORRECT", XDS_CORRECT_KEYWORDS, ("INTEGRATE.HKL", "XPARM.XDS")),
+    ("DEFPIX INTEGRATE CORRECT", XDS_CORRECT_KEYWORDS | XDS_INTEGRATE_KEYWORDS,
+     ("XPARM.XDS", "X-CORRECTIONS.cbf", "Y-CORRECTIONS.cbf", "BKGINIT.cbf", "BLANK.cbf", "GAIN.cbf")),
+    ("IDXREF DEFPIX INTEGRATE CORRECT",
+     XDS_CORRECT_KEYWORDS | XDS_INTEGRATE_KEYWORDS | XDS_IDXREF_KEYWORDS,
+     ("SPOT.XDS", "X-CORRECTIONS.cbf", "Y-CORRECTIONS.cbf", "BKGINIT.cbf", "BLANK.cbf", "GAIN.cbf")),
+)
 
+LOW_INDEXING_RETRY_JOB = "DEFPIX INTEGRATE CORRECT"
+# Rerun after spot wedges indexed too few spots; XYCORR and INIT results stay valid.
+SPOT_FALLBACK_JOB = "COLSPOT IDXREF DEFPIX INTEGRATE CORRECT"
 
-def patch_job_defpix_integrate_correct(xds_inp_path):
-    with open(xds_inp_path) as f:
-        lines = f.readlines()
 
-    new_lines = []
-    replaced = False
-    for line in lines:
-        if line.lstrip().startswith("JOB="):
-            new_lines.append("JOB= DEFPIX INTEGRATE CORRECT\n")
-            replaced = True
-        else:
-            new_lines.append(line)
+def spot_wedges(env: PipelineEnv, first, last, oscillation):
+    """
+    SPOT_RANGE values of the spot wedges within frames first..last, or None if
+    fast indexing is off or the wedges would cover half the frames or more.
+    """
+    if not env.spot_wedges or not oscillation or oscillation <= 0:
+        return None
+    width = max(1, round(env.spot_wedge_degrees / oscillation))
+    step = max(width, round(env.spot_wedge_spacing_degrees / oscillation))
+    ranges = []
+    for start in range(first, last + 1, step)[:env.spot_wedges]:
+        ranges.append((start, min(last, start + width - 1)))
+    if 2 * sum(b - a + 1 for a, b in ranges) >= last - first + 1:
+        return None
+    return [f"{a} {b}" for a, b in ranges]
 
-    if not replaced:
-        new_lines.append("\nJOB= DEFPIX INTEGRATE CORRECT\n")
 
-    shutil.copy2(xds_inp_path, xds_inp_path.replace("XDS.INP", "XDS_before_retry.INP"))
-    with open(xds_inp_path, "w") as f:
-        f.writelines(new_lines)
+def xds_oscillation(folder, header=None):
+    """
+    OSCILLATION_RANGE of XDS.INP, else of the frame header; None if neither has it.
+    """
+    values = xds_inp_keywords(os.path.join(folder, "XDS.INP")).get("OSCILLATION_RANGE")
+    try:
+        return float(values[-1].split()[0])
+    except (TypeError, IndexError, ValueError):
+        return header.oscillation if header is not None else None
 
 
-def run_xds(folder, env: PipelineEnv):
-    ok, rc, timed_out = run_cmd(
-        ["bash", "-lc", "xds_par > XDS_run.log 2>&1"],
-        cwd=folder,
-        timeout=env.xds_timeout,
-        env=env,
-    )
+def xds_inp_keywords(path):
+    """
+    {keyword: [values]} of XDS.INP without comments and the XDS_INP_VOLATILE_KEYWORDS.
+    """
+    keywords = {}
+    with open(path) as f:
+        for line in f:
+            text = line.split("!", 1)[0]
+            matches = list(XDS_INP_KEYWORD.finditer(text))
+            for m, nxt in zip(matches, matches[1:] + [None]):
+                if f"{m.group(1)}=" in XDS_INP_VOLATILE_KEYWORDS:
+                    continue
+                value = " ".join(text[m.end():nxt.start() if nxt else len(text)].split())
+                keywords.setdefault(m.group(1), []).append(value)
+    return keywords
 
-    xds_ascii = os.path.join(folder, "XDS_ASCII.HKL")
-    if ok and os.path.isfile(xds_ascii):
-        return True
 
-    if xds_failed_due_to_low_indexing(folder):
-        folder_name = os.path.basename(os.path.abspath(folder))
-        print(f"Low indexing stop for '{folder_name}'; retrying with JOB= DEFPIX INTEGRATE CORRECT")
-        try:
-            patch_job_defpix_integrate_correct(os.path.join(folder, "XDS.INP"))
-        except Exception as e:
-            print(f"  Failed to patch XDS.INP: {e}")
-            return False
+def changed_xds_keywords(old, new):
+    return sorted(k for k in old.keys() | new.keys() if old.get(k) != new.get(k))
+
+
+def smallest_xds_job(folder, changed):
+    """
+    Smallest JOB that recomputes everything the changed keywords affect and whose
+    input files are all in folder, or None if the full job is needed.
+    """
+    if not changed:
+        return None
+    for job, keywords, inputs in XDS_PARTIAL_JOBS:
+        if set(changed) <= keywords:
+            if all(os.path.isfile(os.path.join(folder, name)) for name in inputs):
+                return job
+    return None
 
-        ok2, rc2, timed_out2 = run_cmd(
-            ["bash", "-lc", "xds_par > XDS_retry.log 2>&1"],
+
+def run_xds_once(folder, env: PipelineEnv, log_name, job=None, output="XDS_ASCII.HKL", spot_range=None):
+    """
+    Run xds_par once; True if it succeeded and wrote output. With job (and spot_range),
+    the JOB= (and SPOT_RANGE=) lines of XDS.INP are replaced for this run only and
+    the file is put back afterwards.
+    """
+    xds_inp = os.path.join(folder, "XDS.INP")
+    xds_output = os.path.join(folder, output)
+    original = None
+    if job is not None:
+        with open(xds_inp) as f:
+            original = f.read()
+        replaced = ("JOB=", "SPOT_RANGE=") if spot_range is not None else ("JOB=",)
+        lines = [line for line in original.splitlines(keepends=True) if not line.lstrip().startswith(replaced)]
+        with open(xds_inp, "w") as f:
+            f.write(f"JOB= {job}\n")
+            f.writelines(lines)
+            if spot_range is not None:
+                f.write(f"SPOT_RANGE= {spot_range}\n")
+
+    # An old output file must not pass for the output of this run.
+    try:
+        os.remove(xds_output)
+    except FileNotFoundError:
+        pass
+
+    try:
+        res = run_cmd(
+            ["bash", "-lc", f"xds_par > {log_name} 2>&1"],
             cwd=folder,
             timeout=env.xds_timeout,
             env=env,
         )
-        if ok2 and os.path.isfile(xds_ascii):
+    finally:
+        if original is not None:
+            with open(xds_inp, "w") as f:
+                f.write(original)
+    return res.ok and os.path.isfile(xds_output)
+
+
+def run_xds(folder, env: PipelineEnv, job=None, fallback_spot_range=None):
+    """
+    Run XDS with the JOB of XDS.INP, or only job (e.g. "CORRECT") if given.
+    A partial job that fails is followed by the full job. With fallback_spot_range
+    (XDS.INP has spot wedges), low indexing first reruns from COLSPOT with it.
+    """
+    folder_name = os.path.basename(os.path.abspath(folder))
+
+    if job is not None:
+        if run_xds_once(folder, env, "XDS_rerun.log", job):
+            return True
+        print(f"XDS JOB= {job} failed for '{folder_name}'; running the full job")
+        print(f"  Check: {os.path.join(folder, 'XDS_rerun.log')}")
+
+    if run_xds_once(folder, env, "XDS_run.log"):
+        return True
+
+    if fallback_spot_range is not None and xds_failed_due_to_low_indexing(folder):
+        print(f"Low indexing with spot wedges for '{folder_name}'; "
+              f"searching spots in frames {fallback_spot_range.replace(' ', '-')}")
+        if run_xds_once(folder, env, "XDS_spots.log", SPOT_FALLBACK_JOB, spot_range=fallback_spot_range):
+            return True
+        if not xds_failed_due_to_low_indexing(folder):
+            print(f"XDS failed for '{folder_name}'")
+            print(f"  Check: {os.path.join(folder, 'XDS_spots.log')}")
+            return False
+
+    if xds_failed_due_to_low_indexing(folder):
+        print(f"Low indexing stop for '{folder_name}'; retrying with JOB= {LOW_INDEXING_RETRY_JOB}")
+        if run_xds_once(folder, env, "XDS_retry.log", LOW_INDEXING_RETRY_JOB):
             return True
 
         print(f"XDS retry failed for '{folder_name}'")
         print(f"  Check: {os.path.join(folder, 'XDS_retry.log')}")
         return False
 
-    folder_name = os.path.basename(os.path.abspath(folder))
     print(f"XDS failed for '{folder_name}'")
     print(f"  Check: {os.path.join(folder, 'XDS_run.log')}")
     return False
 
 
 # ============================================================
-# CCP4 / AIMLESS PIPELINE
+# XDS PARALLELISM
 # ============================================================
 
-def parse_aimless_summary(log_path):
-    space_group = "UNKNOWN"
-    high_res = "UNKNOWN"
+# xds_par threads per job used until the host has been calibrated with MODE = "xds-benchmark".
+DEFAULT_XDS_PROCESSORS_PER_JOB = 8
+# Every INTEGRATE job should get at least this many DELPHI wedges of frames.
+MIN_DELPHI_WEDGES_PER_JOB = 2
+# Detector size assumed when XDS.INP has no NX / NY (EIGER 16M).
+DEFAULT_DETECTOR_PIXELS = 4150 * 4371
+BYTES_PER_CACHED_PIXEL = 4
 
-    try:
-        with open(log_path, "r") as f:
-            text = f.read()
-    except FileNotFoundError:
-        return space_group, high_res
 
-    sg_matches = list(re.finditer(r"Space\s+group\s*[:=]\s*(.+)", text))
-    if sg_matches:
-        sg_line = sg_matches[-1].group(1).strip()
-        sg_line = re.sub(r"\(.*?\)", "", sg_line).strip()
-        space_group = sg_line
+@dataclass
+class XdsPlan:
+    jobs: int
+    processors: int
+    images_in_cache: int | None
+
 
-    res_matches = list(re.finditer(r"High\s+resolution\s+limit\s+([0-9.]+)", text))
-    if not res_matches:
-        res_matches = list(re.finditer(r"Resolution\s+range\s+[0-9.]+\s+to\s+([0-9.]+)", text))
-    if res_matches:
-        high_res = res_matches[-1].group(1)
+def host_memory_bytes():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
 
-    return space_group, high_res
 
+def concurrent_xds_runs(env: PipelineEnv):
+    return max(1, env.xds_workers) if env.scheduler == "staged" else dataset_workers(env)
 
-def run_ccp4_pipeline(folder, env: PipelineEnv, input_mode="hkl", hklin_path=None):
+
+def load_xds_tuning(env: PipelineEnv):
     """
-    input_mode:
-      - "hkl": use HKL → pointless + aimless + ctruncate + freerflag.
-      - "mtz": use MTZ → aimless + ctruncate + freerflag.
+    Calibration of this host from XDS_TUNING_FILE, or None.
     """
-    if input_mode == "hkl":
-        if hklin_path is None:
-            hklin_path = os.path.join(folder, "XDS_ASCII.HKL")
-        if not os.path.isfile(hklin_path):
-            return None
+    if env.xds_tuning_file is None:
+        return None
+    try:
+        with open(env.xds_tuning_file) as f:
+            return json.load(f).get(socket.gethostname())
+    except (OSError, ValueError):
+        return None
 
-        bash_cmd = (
-            f'source "{env.ccp4_setup}" && '
-            'export CCP4_SCR="$PWD/CCP4_SCRATCH" && mkdir -p "$CCP4_SCR" && '
-            'rm -f XDS_ASCII.mtz Merged.mtz Truncate.mtz Final_with_FreeR.mtz XDS.xml && '
-            f'pointless "{hklin_path}" hklout XDS_ASCII.mtz > pointless.log 2>&1 && '
-            'aimless HKLIN XDS_ASCII.mtz HKLOUT Merged.mtz XMLOUT XDS.xml --no-input > aimless.log 2>&1 && '
-            "ctruncate -mtzin Merged.mtz -mtzout Truncate.mtz -colin '/*/*/[IMEAN,SIGIMEAN]' > ctruncate.log 2>&1 && "
-            'freerflag HKLIN Truncate.mtz HKLOUT Final_with_FreeR.mtz > freerflag.log 2>&1 << EOF\n'
-            'FREERFRAC 0.05\n'
-            'END\n'
-            'EOF'
-        )
-    elif input_mode == "mtz":
-        if hklin_path is None:
-            hklin_path = os.path.join(folder, "XDS_ASCII.mtz")
-        if not os.path.isfile(hklin_path):
-            return None
 
-        bash_cmd = (
-            f'source "{env.ccp4_setup}" && '
-            'export CCP4_SCR="$PWD/CCP4_SCRATCH" && mkdir -p "$CCP4_SCR" && '
-            'rm -f Merged.mtz Truncate.mtz Final_with_FreeR.mtz XDS.xml && '
-            f'aimless HKLIN "{hklin_path}" HKLOUT Merged.mtz XMLOUT XDS.xml --no-input > aimless.log 2>&1 && '
-            "ctruncate -mtzin Merged.mtz -mtzout Truncate.mtz -colin '/*/*/[IMEAN,SIGIMEAN]' > ctruncate.log 2>&1 && "
-            'freerflag HKLIN Truncate.mtz HKLOUT Final_with_FreeR.mtz > freerflag.log 2>&1 << EOF\n'
-            'FREERFRAC 0.05\n'
-            'END\n'
-            'EOF'
-        )
-    else:
-        raise ValueError(f"Unknown input_mode='{input_mode}'")
+def save_xds_tuning(env: PipelineEnv, tuning):
+    try:
+        with open(env.xds_tuning_file) as f:
+            hosts = json.load(f)
+    except (OSError, ValueError):
+        hosts = {}
+    hosts[socket.gethostname()] = tuning
+    tmp = f"{env.xds_tuning_file}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(hosts, f, indent=1)
+    os.replace(tmp, env.xds_tuning_file)
+
+
+def first_keyword_number(keywords, name, default):
+    try:
+        return float(keywords[name][0].split()[0])
+    except (KeyError, IndexError, ValueError):
+        return default
 
-    ok, rc, timed_out = run_cmd(
-        ["bash", "-lc", bash_cmd],
-        cwd=folder,
-        timeout=env.ccp4_timeout,
-        env=env,
-    )
 
-    if not ok:
-        folder_name = os.path.basename(os.path.abspath(folder))
-        print(f"CCP4 pipeline failed for '{folder_name}'")
-        print("  Check logs:")
-        for log in ["pointless.log", "aimless.log", "ctruncate.log", "freerflag.log"]:
-            print(f"   - {os.path.join(folder, log)}")
+def plan_xds_parallelism(env: PipelineEnv, xds_inp, n_frames):
+    """
+    JOBS x PROCESSORS split and image cache for one dataset, or None to leave them to XDS.
+    """
+    if env.xds_parallelism is None:
         return None
+    if env.xds_parallelism != "auto":
+        raise ValueError(f"Unknown XDS_PARALLELISM='{env.xds_parallelism}'")
+
+    cores = xds_processors(env) or available_cores(env)
+    keywords = xds_inp_keywords(xds_inp)
+    oscillation = first_keyword_number(keywords, "OSCILLATION_RANGE", 0.1) or 0.1
+    delphi = first_keyword_number(keywords, "DELPHI", 5.0)
+    frames_per_wedge = max(1, math.ceil(delphi / oscillation))
+
+    tuning = load_xds_tuning(env)
+    per_job = tuning["processors_per_job"] if tuning else DEFAULT_XDS_PROCESSORS_PER_JOB
+    jobs_by_frames = max(1, n_frames // (MIN_DELPHI_WEDGES_PER_JOB * frames_per_wedge))
+    jobs = max(1, min(cores // max(1, per_job), jobs_by_frames))
+
+    # Each job keeps up to one DELPHI wedge of images in memory. A smaller cache only
+    # costs re-reading frames, so jobs are dropped only below half a wedge per job.
+    cache = frames_per_wedge
+    memory = host_memory_bytes()
+    if memory:
+        pixels = first_keyword_number(keywords, "NX", 0) * first_keyword_number(keywords, "NY", 0)
+        image_bytes = (pixels or DEFAULT_DETECTOR_PIXELS) * BYTES_PER_CACHED_PIXEL
+        budget = memory * env.xds_memory_fraction / concurrent_xds_runs(env)
+        min_cache = max(1, frames_per_wedge // 2)
+        while jobs > 1 and budget // (jobs * image_bytes) < min_cache:
+            jobs -= 1
+        cache = max(1, min(cache, int(budget // (jobs * image_bytes))))
+
+    return XdsPlan(jobs=jobs, processors=max(1, cores // jobs), images_in_cache=cache)
+
+
+def set_xds_inp_keywords(xds_inp, values):
+    """
+    Replace (or append) single-valued keywords in XDS.INP, e.g. {"MAXIMUM_NUMBER_OF_JOBS": 2},
+    also where they share a line with other keywords ("NX= 4150 NY= 4371").
+    """
+    with open(xds_inp) as f:
+        lines = f.readlines()
+    done = set()
+    new_lines = []
+    for line in lines:
+        text, bang, comment = line.rstrip("\n").partition("!")
+        matches = list(XDS_INP_KEYWORD.finditer(text))
+        if not any(m.group(1) in values for m in matches):
+            new_lines.append(line)
+            continue
+        parts = [text[:matches[0].start()]]
+        for m, nxt in zip(matches, matches[1:] + [None]):
+            key = m.group(1)
+            if key not in values:
+                parts.append(text[m.start():nxt.start() if nxt else len(text)])
+            elif key not in done:
+                parts.append(f"{key}= {values[key]}" + (" " if nxt else ""))
+                done.add(key)
+        text = "".join(parts).rstrip()
+        if text.strip():
+            new_lines.append(f"{text} !{comment}\n" if bang else f"{text}\n")
+        elif bang:
+            new_lines.append(f"!{comment}\n")
+    new_lines += [f"{key}= {value}\n" for key, value in values.items() if key not in done]
+    with open(xds_inp, "w") as f:
+        f.writelines(new_lines)
+
 
-    return parse_aimless_summary(os.path.join(folder, "aimless.log"))
+def benchmark_settings(cores, n_frames, frames_per_wedge):
+    """
+    (jobs, processors) splits of cores to time: powers of two per job, plus all cores in one job.
+    """
+    max_jobs = max(1, n_frames // (MIN_DELPHI_WEDGES_PER_JOB * frames_per_wedge))
+    settings = []
+    processors = 1
+    while processors <= cores:
+        jobs = cores // processors
+        if jobs <= max_jobs:
+            settings.append((jobs, processors))
+        processors *= 2
+    if (1, cores) not in settings:
+        settings.append((1, cores))
+    return settings
 
 
 # ============================================================
-# DIMPLE
+# CCP4 ENVIRONMENT
 # ============================================================
 
-def parse_dimple_blobs(folder):
-    log_path = os.path.join(folder, "dimple.log")
-    if not os.path.isfile(log_path):
-        return -1
+_ccp4_environments = {}
+_ccp4_environment_lock = threading.Lock()
+
+
+def ccp4_environment_key(setup_path):
+    st = os.stat(setup_path)
+    parent = hashlib.blake2b(
+        json.dumps(sorted(os.environ.items())).encode(), digest_size=16
+    ).hexdigest()
+    return [os.path.abspath(setup_path), st.st_mtime_ns, st.st_size, parent]
+
+
+def capture_ccp4_environment(setup_path):
+    """
+    Source the CCP4 setup script in a non-login bash and return the resulting environment.
+    """
+    p = subprocess.run(
+        ["bash", "-c", 'source "$1" >/dev/null 2>&1 && env -0', "ccp4-setup", setup_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if p.returncode != 0:
+        raise RuntimeError(f"Sourcing CCP4 setup failed (exit code {p.returncode}): {setup_path}")
+
+    environment = {}
+    for item in p.stdout.split(b"\0"):
+        name, sep, value = item.decode(errors="replace").partition("=")
+        if sep:
+            environment[name] = value
+    return environment
+
+
+def load_ccp4_environment(setup_path, cache_path=None):
+    key = ccp4_environment_key(setup_path)
+    if cache_path is not None:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached.get("key") == key:
+                return cached["environment"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    environment = capture_ccp4_environment(setup_path)
+    if cache_path is not None:
+        tmp = f"{cache_path}.tmp{os.getpid()}"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"key": key, "environment": environment}, f)
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            print(f"Could not write CCP4 environment cache {cache_path}: {e}")
+    return environment
+
+
+def prepare_ccp4_environment(env: PipelineEnv):
+    """
+    Load the CCP4 environment before any dataset starts, so a broken setup shows up once.
+    """
     try:
-        with open(log_path) as f:
-            text = f.read()
-    except Exception:
-        return -1
+        ccp4_environment(env)
+    except (OSError, RuntimeError) as e:
+        print(f"WARNING: could not load the CCP4 environment: {e}")
+
+
+def ccp4_environment(env: PipelineEnv):
+    """
+    CCP4 environment for this run; the setup script is only sourced the first time.
+    """
+    with _ccp4_environment_lock:
+        environment = _ccp4_environments.get(env.ccp4_setup)
+        if environment is None:
+            environment = load_ccp4_environment(env.ccp4_setup, env.ccp4_env_cache)
+            _ccp4_environments[env.ccp4_setup] = environment
+        return environment
+
+
+@dataclass
+class ToolStep:
+    name: str
+    argv: list
+    log: str
+    stdin: str | None = None
+
+
+def run_tool_steps(folder, steps, env: PipelineEnv, timeout, proc_env):
+    """
+    Run tools one after another, sharing one timeout.
+    Returns None if all succeeded, otherwise (failed step, returncode, timed_out).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for step in steps:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        res = run_cmd(
+            step.argv,
+            cwd=folder,
+            timeout=remaining,
+            env=env,
+            log_path=step.log,
+            stdin_text=step.stdin,
+            proc_env=proc_env,
+        )
+        if not res.ok:
+            return step, res.returncode, res.timed_out
+    return None
+
+
+# ============================================================
+# CCP4 / AIMLESS PIPELINE
+# ============================================================
+
+def parse_aimless_summary(log_path):
+    return log_parser.parse_aimless_summary(log_path)
+
+
+@dataclass
+class ShellStats:
+    overall: float | None = None
+    inner: float | None = None
+    outer: float | None = None
 
-    match = re.search(r"blobs?:\s*(\d+)", text, re.IGNORECASE)
-    if match:
-        return int(match.group(1))
-    if re.search(r"no blobs", text, re.IGNORECASE):
-        return 0
-    return -1
+
+@dataclass
+class AimlessStats:
+    space_group: str = "UNKNOWN"
+    high_resolution: str = "UNKNOWN"
+    cell: tuple | None = None
+    resolution_low: ShellStats = field(default_factory=ShellStats)
+    resolution_high: ShellStats = field(default_factory=ShellStats)
+    cc_half: ShellStats = field(default_factory=ShellStats)
+    completeness: ShellStats = field(default_factory=ShellStats)
+    multiplicity: ShellStats = field(default_factory=ShellStats)
+    rmerge: ShellStats = field(default_factory=ShellStats)
+    rmeas: ShellStats = field(default_factory=ShellStats)
+    rpim: ShellStats = field(default_factory=ShellStats)
+    i_over_sigma: ShellStats = field(default_factory=ShellStats)
+    n_observations: ShellStats = field(default_factory=ShellStats)
+    n_reflections: ShellStats = field(default_factory=ShellStats)
+    # "xml", "log", or "none" if neither could be read.
+    source: str = "none"
+
+
+# Per-shell result elements of aimless XMLOUT (<Result><Dataset>) -> AimlessStats field.
+AIMLESS_XML_FIELDS = {
+    "ResolutionLow": "resolution_low",
+    "ResolutionHigh": "resolution_high",
+    "CChalf": "cc_half",
+    "Completeness": "completeness",
+    "Multiplicity": "multiplicity",
+    "RmergeOverall": "rmerge",
+    "RmeasOverall": "rmeas",
+    "RpimOverall": "rpim",
+    "MeanIoverSD": "i_over_sigma",
+    "NumberObservations": "n_observations",
+    "NumberReflections": "n_reflections",
+}
+
+CELL_XML_TAGS = ("a", "b", "c", "alpha", "beta", "gamma")
+
+
+def _xml_float(elem):
+    if elem is None or elem.text is None:
+        return None
+    try:
+        return float(elem.text)
+    except ValueError:
+        return None
+
+
+def parse_aimless_xml(xml_path):
+    """
+    Stream-parse aimless XMLOUT and return AimlessStats, or None if the file is
+    missing, malformed or has no result section.
+    Only the first <Dataset> of <Result> is read; space group and cell use the last
+    occurrence in the file.
+    """
+    stats = AimlessStats(source="xml")
+    found_result = False
+    path = []
+
+    try:
+        for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+            if event == "start":
+                path.append(elem)
+                continue
+            path.pop()
+
+            tag = elem.tag
+            in_dataset = any(p.tag == "Dataset" for p in path)
+            if tag in AIMLESS_XML_FIELDS and in_dataset and not found_result:
+                setattr(stats, AIMLESS_XML_FIELDS[tag], ShellStats(
+                    overall=_xml_float(elem.find("Overall")),
+                    inner=_xml_float(elem.find("Inner")),
+                    outer=_xml_float(elem.find("Outer")),
+                ))
+            elif tag == "Dataset" and any(p.tag == "Result" for p in path):
+                found_result = True
+            elif tag == "SpacegroupName" and elem.text and elem.text.strip():
+                stats.space_group = elem.text.strip()
+            elif tag == "cell":
+                values = [_xml_float(elem.find(t)) for t in CELL_XML_TAGS]
+                if None not in values:
+                    stats.cell = tuple(values)
+
+            # Keep memory flat: drop every finished element below the root.
+            if len(path) <= 2:
+                elem.clear()
+    except (OSError, ET.ParseError):
+        return None
+
+    if not found_result:
+        return None
+    if stats.resolution_high.overall is not None:
+        stats.high_resolution = f"{stats.resolution_high.overall:.2f}"
+    return stats
+
+
+def read_aimless_results(folder):
+    """
+    Aimless statistics for one processing folder: XDS.xml if usable,
+    otherwise space group and resolution from aimless.log.
+    """
+    with event_log.phase("parse_aimless"):
+        stats = parse_aimless_xml(os.path.join(folder, "XDS.xml"))
+        if stats is not None and stats.space_group != "UNKNOWN":
+            return stats
+        space_group, high_res = parse_aimless_summary(os.path.join(folder, "aimless.log"))
+
+    if stats is None:
+        found = space_group != "UNKNOWN" or high_res != "UNKNOWN"
+        stats = AimlessStats(source="log" if found else "none")
+    stats.space_group = space_group
+    if stats.high_resolution == "UNKNOWN":
+        stats.high_resolution = high_res
+    return stats
+
+
+CTRUNCATE_COLIN = "/*/*/[IMEAN,SIGIMEAN]"
+FREERFLAG_INPUT = "FREERFRAC {fraction}\nEND\n"
+AIMLESS_RESOLUTION_INPUT = "RESOLUTION HIGH {high:.2f}\nEND\n"
+
+
+def triage_dataset(hklin_path, env: PipelineEnv):
+    """
+    Quick statistics from XDS_ASCII.HKL.
+    Returns (TriageResult or None, rejection reason or None).
+    """
+    try:
+        with event_log.phase("triage"):
+            tri = xds_ascii.triage(hklin_path, isigi_cutoff=env.triage_isigi_cutoff)
+    except (OSError, ValueError) as e:
+        return None, f"unreadable {os.path.basename(hklin_path)} ({e})"
+
+    completeness = tri.completeness
+    completeness_str = f"{100 * completeness:.0f}%" if completeness is not None else "N/A"
+    estimate = f"{tri.resolution_estimate:.2f} A" if tri.resolution_estimate else "none"
+    print(f"    Triage: {tri.n_unique} unique / {tri.n_obs} obs, completeness ~{completeness_str}, "
+          f"resolution estimate {estimate}")
+
+    if tri.n_unique < env.triage_min_unique:
+        return tri, f"{tri.n_unique} unique reflections (< {env.triage_min_unique})"
+    if env.triage_max_resolution is not None and (
+            tri.resolution_estimate is None or tri.resolution_estimate > env.triage_max_resolution):
+        return tri, f"resolution estimate {estimate} (limit {env.triage_max_resolution} A)"
+    return tri, None
+
+
+def builtin_freer_flags(env: PipelineEnv):
+    if env.freer_flags == "freerflag":
+        return False
+    if env.freer_flags != "builtin":
+        raise ValueError(f"Unknown FREER_FLAGS='{env.freer_flags}'")
+    return freer_flags is not None and env.freer_reference_dir is not None
+
+
+def add_freer_flags(folder, env: PipelineEnv):
+    """
+    Truncate.mtz -> Final_with_FreeR.mtz with the flags shared by the whole screen.
+    """
+    folder_name = os.path.basename(os.path.abspath(folder))
+    try:
+        with event_log.phase("freer_flags"):
+            info = freer_flags.flag_mtz(
+                os.path.join(folder, "Truncate.mtz"),
+                os.path.join(folder, "Final_with_FreeR.mtz"),
+                env.freer_reference_dir,
+                fraction=env.freer_fraction,
+                seed_mtz=env.freer_seed_mtz,
+            )
+    except (OSError, ValueError) as e:
+        print(f"CCP4 pipeline failed for '{folder_name}': FreeR flags: {e}")
+        return False
+    pct = 100.0 * info["free"] / info["nref"] if info["nref"] else 0.0
+    print(f"FreeR flags for '{folder_name}': {info['free']}/{info['nref']} free ({pct:.1f}%), "
+          f"{info['added']} new in {info['reference']}")
+    return True
+
+
+def run_ccp4_pipeline(folder, env: PipelineEnv, input_mode="hkl", hklin_path=None,
+                      high_resolution=None):
+    """
+    input_mode:
+      - "hkl": use HKL → pointless + aimless + ctruncate + FreeR flags.
+      - "mtz": use MTZ → aimless + ctruncate + FreeR flags.
+    high_resolution: optional high-resolution limit (A) for aimless.
+    """
+    if input_mode == "hkl":
+        if hklin_path is None:
+            hklin_path = os.path.join(folder, "XDS_ASCII.HKL")
+        if not os.path.isfile(hklin_path):
+            return None
+        outputs = ["XDS_ASCII.mtz", "Merged.mtz", "Truncate.mtz", "Final_with_FreeR.mtz", "XDS.xml"]
+        steps = [
+            ToolStep("pointless", ["pointless", hklin_path, "hklout", "XDS_ASCII.mtz"], "pointless.log"),
+        ]
+        aimless_hklin = "XDS_ASCII.mtz"
+    elif input_mode == "mtz":
+        if hklin_path is None:
+            hklin_path = os.path.join(folder, "XDS_ASCII.mtz")
+        if not os.path.isfile(hklin_path):
+            return None
+        outputs = ["Merged.mtz", "Truncate.mtz", "Final_with_FreeR.mtz", "XDS.xml"]
+        steps = []
+        aimless_hklin = hklin_path
+    else:
+        raise ValueError(f"Unknown input_mode='{input_mode}'")
+
+    aimless_argv = ["aimless", "HKLIN", aimless_hklin, "HKLOUT", "Merged.mtz", "XMLOUT", "XDS.xml"]
+    if high_resolution is None:
+        aimless_step = ToolStep("aimless", aimless_argv + ["--no-input"], "aimless.log")
+    else:
+        aimless_step = ToolStep("aimless", aimless_argv, "aimless.log",
+                                stdin=AIMLESS_RESOLUTION_INPUT.format(high=high_resolution))
+    steps += [
+        aimless_step,
+        ToolStep("ctruncate", ["ctruncate", "-mtzin", "Merged.mtz", "-mtzout", "Truncate.mtz",
+                               "-colin", CTRUNCATE_COLIN], "ctruncate.log"),
+    ]
+    builtin_flags = builtin_freer_flags(env)
+    if not builtin_flags:
+        steps.append(ToolStep(
+            "freerflag", ["freerflag", "HKLIN", "Truncate.mtz", "HKLOUT", "Final_with_FreeR.mtz"],
+            "freerflag.log", stdin=FREERFLAG_INPUT.format(fraction=env.freer_fraction),
+        ))
+
+    folder_name = os.path.basename(os.path.abspath(folder))
+    try:
+        proc_env = dict(ccp4_environment(env))
+    except (OSError, RuntimeError) as e:
+        print(f"CCP4 pipeline failed for '{folder_name}': {e}")
+        return None
+
+    scratch = os.path.join(folder, "CCP4_SCRATCH")
+    os.makedirs(scratch, exist_ok=True)
+    proc_env["CCP4_SCR"] = scratch
+    for name in outputs:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+    failed = run_tool_steps(folder, steps, env, env.ccp4_timeout, proc_env)
+    if failed is not None:
+        step, rc, timed_out = failed
+        reason = "timed out" if timed_out else f"exit code {rc}"
+        print(f"CCP4 pipeline failed for '{folder_name}': {step.name} {reason}")
+        print(f"  Check: {os.path.join(folder, step.log)}")
+        return None
+
+    if builtin_flags and not add_freer_flags(folder, env):
+        return None
+
+    return read_aimless_results(folder)
+
+
+# ============================================================
+# DIMPLE
+# ============================================================
+
+def parse_dimple_blobs(folder):
+    with event_log.phase("parse_dimple"):
+        return log_parser.parse_dimple_blobs(os.path.join(folder, "dimple.log"))
 
 
 def run_dimple(folder, pdb, outdir, env: PipelineEnv):
@@ -493,20 +2050,35 @@ def run_dimple(folder, pdb, outdir, env: PipelineEnv):
         print(f"DIMPLE skipped for '{folder_name}': PDB not found at {pdb}")
         return -1
 
-    bash_cmd = (
-        f'source "{env.ccp4_setup}" && '
-        f'dimple "{mtz}" "{pdb}" "{outdir}" > dimple.log 2>&1'
-    )
+    if mtz_file is not None:
+        summary, problems = mtz_file.validate_mtz(mtz, require_freer=True, require_amplitudes=True)
+        if problems:
+            print(f"DIMPLE skipped for '{folder_name}': Final_with_FreeR.mtz unusable ({'; '.join(problems)})")
+            return -1
+        if summary["d_min"] is not None:
+            resolution = f"{summary['d_max']:.2f}-{summary['d_min']:.2f} A"
+        else:
+            resolution = "resolution unknown"
+        print(f"    MTZ: {summary['nref']} reflections, {resolution}, "
+              f"free set {100 * summary['free_fraction']:.1f}%")
+
+    try:
+        proc_env = ccp4_environment(env)
+    except (OSError, RuntimeError) as e:
+        print(f"DIMPLE failed for '{folder_name}': {e}")
+        return -1
 
-    ok, rc, timed_out = run_cmd(
-        ["bash", "-lc", bash_cmd],
+    res = run_cmd(
+        ["dimple", mtz, pdb, outdir],
         cwd=folder,
         timeout=env.dimple_timeout,
         env=env,
+        log_path="dimple.log",
+        proc_env=proc_env,
     )
 
-    if not ok:
-        reason = "timed out" if timed_out else f"exit code {rc}"
+    if not res.ok:
+        reason = "timed out" if res.timed_out else f"exit code {res.returncode}"
         print(f"DIMPLE failed for '{folder_name}' ({reason})")
         print(f"  Check: {os.path.join(folder, 'dimple.log')}")
         return -1
@@ -517,10 +2089,7 @@ def run_dimple(folder, pdb, outdir, env: PipelineEnv):
 
     # Fallback: shallow search under folder (flexible)
     if final_pdb is None:
-        candidates = []
-        for root, _, files in os.walk(folder):
-            if "final.pdb" in files:
-                candidates.append(os.path.join(root, "final.pdb"))
+        candidates = find_files_named(folder, "final.pdb", prune=("CCP4_SCRATCH",))
         if not candidates:
             print(f"DIMPLE finished but final.pdb missing for '{folder_name}'")
             print(f"  Expected at: {expected_final}")
@@ -537,83 +2106,797 @@ def run_dimple(folder, pdb, outdir, env: PipelineEnv):
     return blobs
 
 # ============================================================
-# PIPELINE MODES
+# UP-TO-DATE CHECKS
 # ============================================================
 
-def full_pipeline(env: PipelineEnv):
-    print(f"\n=== FULL MODE: Starting batch processing in: {env.root_dir} ===\n")
-    write_summary_header(env.summary_file)
+# Per-dataset record of the last successful run of every stage.
+STAGE_STATE_FILE = "pipeline_state.json"
 
-    counts = {"xds_ok": 0, "xds_fail": 0, "ccp4_ok": 0, "ccp4_fail": 0,
-              "dimple_ok": 0, "dimple_fail": 0, "blobs_found": 0}
+# Files up to this size are fingerprinted by content, larger ones by size + mtime.
+CONTENT_HASH_LIMIT_BYTES = 1 << 20
 
-    for subdir, _, files in os.walk(env.root_dir):
-        if "XDS.INP" not in files:
-            continue
+# XDS.INP keywords that do not change the result (threads, job split, frame location).
+# The frame series itself is fingerprinted separately.
+XDS_INP_VOLATILE_KEYWORDS = (
+    "JOB=",
+    "MAXIMUM_NUMBER_OF_JOBS=",
+    "MAXIMUM_NUMBER_OF_PROCESSORS=",
+    "NUMBER_OF_IMAGES_IN_CACHE=",
+    "NAME_TEMPLATE_OF_DATA_FRAMES=",
+)
+
+_content_hashes = {}
+
+
+def file_signature(path, content=None):
+    """
+    Fingerprint of one file: a content hash for small files (or content=True),
+    otherwise [size, mtime_ns]. None if the file does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if content is None:
+        content = st.st_size <= CONTENT_HASH_LIMIT_BYTES
+    if not content:
+        return [st.st_size, st.st_mtime_ns]
+
+    key = (path, st.st_size, st.st_mtime_ns)
+    digest = _content_hashes.get(key)
+    if digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(partial(f.read, 1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        _content_hashes[key] = digest
+    return digest
+
+
+def tool_signature(name, search_path=None):
+    """
+    Stand-in for a tool version: resolved executable path, size and mtime.
+    """
+    path = shutil.which(name, path=search_path)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    return [path, file_signature(path, content=False)]
+
+
+def fingerprint(parts):
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def normalized_xds_inp(path):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            s = line.strip()
+            if not s or s.startswith("!") or s.startswith(XDS_INP_VOLATILE_KEYWORDS):
+                continue
+            lines.append(s)
+    return lines
+
+
+def series_signature(series: FrameSeries):
+    # Raw series are always .cbf.gz; leaving the suffix out keeps older state files valid.
+    data = asdict(series)
+    data.pop("suffix")
+    return data
+
+
+def frame_signatures(series: FrameSeries, data_range):
+    """
+    [size, mtime_ns] of every frame XDS reads, so a frame replaced anywhere in the
+    range (e.g. re-transferred after a bad copy) makes the XDS result stale.
+    """
+    return [file_signature(os.path.join(series.directory, name), content=False)
+            for name in series_frame_names(series, data_range)]
+
+
+def xds_fingerprint(folder, series: FrameSeries, data_range):
+    return fingerprint({
+        "xds_inp": normalized_xds_inp(os.path.join(folder, "XDS.INP")),
+        "series": series_signature(series),
+        "frames": frame_signatures(series, data_range),
+        "xds_par": tool_signature("xds_par"),
+    })
+
+
+def xds_data_fingerprint(series: FrameSeries, data_range):
+    """
+    Everything the XDS stage depends on apart from XDS.INP.
+    """
+    return fingerprint({
+        "series": series_signature(series),
+        "frames": frame_signatures(series, data_range),
+        "xds_par": tool_signature("xds_par"),
+    })
+
+
+def ccp4_tool_signatures(env: PipelineEnv, tools):
+    try:
+        search_path = ccp4_environment(env).get("PATH")
+    except (OSError, RuntimeError):
+        search_path = None
+    return {tool: tool_signature(tool, search_path) for tool in tools}
+
+
+def ccp4_fingerprint(env: PipelineEnv, input_mode, hklin_path):
+    return fingerprint({
+        "hklin": hklin_path,
+        "hklin_file": file_signature(hklin_path),
+        "input_mode": input_mode,
+        "ccp4_setup": file_signature(env.ccp4_setup, content=True),
+        "tools": ccp4_tool_signatures(env, ("pointless", "aimless", "ctruncate", "freerflag")),
+        "freer_flags": env.freer_flags if builtin_freer_flags(env) else "freerflag",
+        "freer_fraction": env.freer_fraction,
+        "freer_seed": file_signature(env.freer_seed_mtz) if env.freer_seed_mtz else None,
+        "triage_cutoff": env.triage_isigi_cutoff if env.triage and env.triage_apply_cutoff else None,
+    })
+
+
+def dimple_fingerprint(folder, env: PipelineEnv, pdb, outdir):
+    return fingerprint({
+        "mtz": file_signature(os.path.join(folder, "Final_with_FreeR.mtz")),
+        "pdb": file_signature(pdb, content=True),
+        "outdir": outdir,
+        "ccp4_setup": file_signature(env.ccp4_setup, content=True),
+        "tools": ccp4_tool_signatures(env, ("dimple",)),
+    })
+
+
+def load_stage_state(folder):
+    try:
+        with open(os.path.join(folder, STAGE_STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_stage_state(folder, state):
+    path = os.path.join(folder, STAGE_STATE_FILE)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def stage_up_to_date(folder, stage, stage_fingerprint, env: PipelineEnv):
+    if not env.skip_up_to_date:
+        return False
+    record = load_stage_state(folder).get(stage)
+    if record is None or record["fingerprint"] != stage_fingerprint:
+        return False
+    return all(
+        file_signature(os.path.join(folder, name)) == signature
+        for name, signature in record["outputs"].items()
+    )
+
+
+def xds_outputs_current(folder, env: PipelineEnv):
+    """
+    Cheap guess whether XDS will be skipped: its last outputs are still in place.
+    """
+    if not env.skip_up_to_date:
+        return False
+    record = load_stage_state(folder).get("xds")
+    return record is not None and all(
+        file_signature(os.path.join(folder, name)) == signature
+        for name, signature in record["outputs"].items()
+    )
+
+
+def forget_stage(folder, stage):
+    state = load_stage_state(folder)
+    if state.pop(stage, None) is not None:
+        save_stage_state(folder, state)
+
+
+def mark_stage_done(folder, stage, stage_fingerprint, outputs):
+    state = load_stage_state(folder)
+    state[stage] = {
+        "fingerprint": stage_fingerprint,
+        "outputs": {name: file_signature(os.path.join(folder, name)) for name in outputs},
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    save_stage_state(folder, state)
+
+
+# XDS.INP keywords and data of the last successful XDS run; kept when the
+# "xds" record is dropped, so a failed run does not lose it.
+XDS_SNAPSHOT = "xds_inputs"
+
+
+def save_xds_snapshot(folder, series: FrameSeries, data_range):
+    state = load_stage_state(folder)
+    state[XDS_SNAPSHOT] = {
+        "keywords": xds_inp_keywords(os.path.join(folder, "XDS.INP")),
+        "data": xds_data_fingerprint(series, data_range),
+    }
+    save_stage_state(folder, state)
+
+
+def xds_rerun_job(folder, series: FrameSeries, env: PipelineEnv, data_range):
+    """
+    (job, changed keywords) for rerunning XDS after XDS.INP changed since the last
+    successful run. job is None when the full job has to run.
+    """
+    if not env.skip_up_to_date:
+        return None, []
+    snapshot = load_stage_state(folder).get(XDS_SNAPSHOT)
+    if snapshot is None or snapshot["data"] != xds_data_fingerprint(series, data_range):
+        return None, []
+    changed = changed_xds_keywords(snapshot["keywords"], xds_inp_keywords(os.path.join(folder, "XDS.INP")))
+    return smallest_xds_job(folder, changed), changed
+
+
+# ============================================================
+# SCHEDULER
+# ============================================================
+
+@dataclass
+class DatasetResult:
+    dataset: Dataset
+    xds_ok: bool | None = None
+    ccp4_ok: bool | None = None
+    dimple_ok: bool | None = None
+    space_group: str = "UNKNOWN"
+    resolution: str = "UNKNOWN"
+    blobs: int = -1
+    write_summary: bool = False
+    stats: AimlessStats | None = None
+    # Stages skipped because they were up to date.
+    skipped: tuple = ()
+    # Set when the frame check rejected the dataset before XDS, or triage before CCP4.
+    rejected: str | None = None
+    # Resources of the external commands of each stage run; wall is the stage's elapsed time.
+    usage: dict = field(default_factory=dict)
+
+
+@dataclass
+class Stage:
+    name: str
+    # Returns True if the dataset should continue to the next stage.
+    run: Callable[[DatasetResult], bool]
+    workers: int = 1
+
+
+@dataclass
+class StagePlan:
+    banner: Callable[[Dataset], None]
+    stages: list[Stage]
+
+
+def available_cores(env: PipelineEnv):
+    return env.total_cores or os.cpu_count() or 1
+
+
+def dataset_workers(env: PipelineEnv):
+    """
+    Number of datasets processed at once by the pool scheduler;
+    never more than the core budget.
+    """
+    return max(1, min(env.max_concurrent_datasets, available_cores(env)))
+
+
+def xds_processors(env: PipelineEnv):
+    """
+    xds_par threads per dataset so that all running jobs fit the core budget.
+    Returns None when nothing is limited, so XDS keeps its own default.
+    """
+    if env.scheduler == "staged":
+        # CCP4 and DIMPLE tools are single threaded: reserve one core per worker.
+        light = env.ccp4_workers + env.dimple_workers
+        return max(1, (available_cores(env) - light) // max(1, env.xds_workers))
+    if env.total_cores is None and dataset_workers(env) == 1:
+        return None
+    return max(1, available_cores(env) // dataset_workers(env))
+
+
+def run_stage(stage: Stage, result: DatasetResult):
+    """
+    Run one stage; an unexpected error fails the stage instead of the whole batch.
+    """
+    usage = ResourceUsage()
+    collect_usage(usage)
+    event_log.context(dataset=result.dataset.dataset_id, stage=stage.name)
+    start = time.monotonic()
+    started = time.time()
+    try:
+        return stage.run(result)
+    except Exception as e:
+        print(f"{stage.name.upper()} stage crashed for '{result.dataset.dataset_id}': {e}")
+        if getattr(result, f"{stage.name}_ok", True) is None:
+            setattr(result, f"{stage.name}_ok", False)
+        return False
+    finally:
+        collect_usage(None)
+        usage.wall = time.monotonic() - start
+        result.usage[stage.name] = usage
+        event_log.timed("stage", started, time.time(), ok=getattr(result, f"{stage.name}_ok", None),
+                        skipped=stage.name in result.skipped, commands=usage.commands,
+                        cpu=round(usage.cpu, 3), max_rss_kb=usage.max_rss_kb)
+        event_log.context()
+
+
+def run_chain(ds: Dataset, plan: StagePlan):
+    result = DatasetResult(dataset=ds)
+    plan.banner(ds)
+    for stage in plan.stages:
+        if not run_stage(stage, result):
+            break
+    return result
+
+
+def run_pool(datasets, plan: StagePlan, env: PipelineEnv):
+    workers = dataset_workers(env)
+    if workers == 1:
+        for ds in datasets:
+            yield run_chain(ds, plan)
+        return
 
-        ds = derive_dataset_info_from_xds_dir(subdir, env.root_dir)
-        print(f"\n--- Dataset: {ds.dataset_id} ---")
-        print(f"    Processing dir: {ds.processing_dir}")
-        print(f"    Raw lookup dir: {os.path.join(env.raw_data_base_dir, ds.dataset_rel)}")
+    print(f"Running {workers} datasets concurrently "
+          f"(xds_par threads per dataset: {xds_processors(env)})")
+    # A worker takes the next dataset only when it is free, so datasets may be
+    # a lazy iterator (e.g. leases from the work queue).
+    datasets = iter(datasets)
+    lock = threading.Lock()
+    finished = queue.Queue()
 
+    def worker():
         try:
-            transform_xds_inp_auto_template(
-                os.path.join(ds.processing_dir, "XDS.INP"),
-                env.raw_data_base_dir,
-                ds.dataset_rel,
-                env.prefix_hint,
-                env.space_group_number,
-                env.unit_cell_constants,
-                env.data_range,
-                env.spot_range,
-                env.detector_type,
-            )
-        except Exception as e:
-            print(f"XDS.INP modification failed for '{ds.dataset_id}': {e}")
-            counts["xds_fail"] += 1
-            continue
+            while True:
+                with lock:
+                    ds = next(datasets, _STOP)
+                if ds is _STOP:
+                    break
+                finished.put(run_chain(ds, plan))
+        except BaseException as e:
+            finished.put(e)
+        finally:
+            finished.put(_STOP)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    running = workers
+    while running:
+        result = finished.get()
+        if result is _STOP:
+            running -= 1
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            yield result
+    for t in threads:
+        t.join()
 
-        if not run_xds(ds.processing_dir, env):
-            counts["xds_fail"] += 1
-            continue
-        counts["xds_ok"] += 1
 
-        result = run_ccp4_pipeline(ds.processing_dir, env, input_mode="hkl")
-        if result is None:
-            counts["ccp4_fail"] += 1
-            continue
-        counts["ccp4_ok"] += 1
-
-        sg, res = result
-        dimple_ok_str = "N/A"
-        blobs_str = "N/A"
-
-        if env.dimple_pdb is not None:
-            blobs = run_dimple(ds.processing_dir, env.dimple_pdb, env.dimple_outdir, env)
-            if blobs >= 0:
-                counts["dimple_ok"] += 1
-                dimple_ok_str = "OK"
-                blobs_str = str(blobs)
-                if blobs > 0:
-                    counts["blobs_found"] += 1
+_STOP = object()
+
+
+def run_staged(datasets, plan: StagePlan, env: PipelineEnv):
+    """
+    One worker pool per stage, connected by bounded queues.
+    A dataset that fails a stage leaves the pipeline immediately.
+    """
+    stages = plan.stages
+    inboxes = [queue.Queue(maxsize=max(1, env.stage_queue_size)) for _ in stages]
+    finished = queue.Queue()
+    remaining = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def worker(index):
+        stage = stages[index]
+        try:
+            while True:
+                result = inboxes[index].get()
+                if result is _STOP:
+                    break
+                if index == 0:
+                    plan.banner(result.dataset)
+                if run_stage(stage, result) and index + 1 < len(stages):
+                    inboxes[index + 1].put(result)
+                else:
+                    finished.put(result)
+        except BaseException as e:
+            finished.put(e)
+        finally:
+            # The last worker of a stage shuts down the next stage.
+            with lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            if last:
+                if index + 1 < len(stages):
+                    for _ in range(stages[index + 1].workers):
+                        inboxes[index + 1].put(_STOP)
+                else:
+                    finished.put(_STOP)
+
+    def feeder():
+        # datasets may be a lazy iterator that fails (work queue, watcher): hand the
+        # error to the caller and still shut the stages down.
+        try:
+            for ds in datasets:
+                inboxes[0].put(DatasetResult(dataset=ds))
+        except BaseException as e:
+            finished.put(e)
+        finally:
+            for _ in range(stages[0].workers):
+                inboxes[0].put(_STOP)
+
+    sizes = ", ".join(f"{stage.name} x{stage.workers}" for stage in stages)
+    print(f"Staged scheduler: {sizes} (xds_par threads per dataset: {xds_processors(env)})")
+
+    threads = [threading.Thread(target=feeder, daemon=True)]
+    for index, stage in enumerate(stages):
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(target=worker, args=(index,), daemon=True))
+    for t in threads:
+        t.start()
+
+    while True:
+        result = finished.get()
+        if result is _STOP:
+            break
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+    for t in threads:
+        t.join()
+
+
+def run_datasets(datasets, plan: StagePlan, env: PipelineEnv):
+    """
+    Yield one DatasetResult per dataset, in completion order.
+    """
+    if env.scheduler == "staged":
+        yield from run_staged(datasets, plan, env)
+    elif env.scheduler == "pool":
+        yield from run_pool(datasets, plan, env)
+    else:
+        raise ValueError(f"Unknown SCHEDULER='{env.scheduler}'. Use 'pool' or 'staged'.")
+
+
+def record_result(counts, result: DatasetResult, env: PipelineEnv, results: results_db.ResultsDB):
+    """
+    Update the counters and the results database. Only called from the main thread.
+    summary.txt is rewritten from the database whenever a batch has been stored.
+    """
+    count_result(counts, result)
+    if results.add(result_record(result, env)):
+        results.write_summary(env.summary_file)
+
+
+def count_result(counts, result: DatasetResult):
+    for stage in ("xds", "ccp4", "dimple"):
+        ok = getattr(result, f"{stage}_ok")
+        if ok is not None:
+            counts[f"{stage}_ok" if ok else f"{stage}_fail"] += 1
+
+    for stage in result.skipped:
+        counts[f"{stage}_skipped"] += 1
+
+    if result.rejected is not None:
+        counts["xds_rejected" if result.xds_ok is False else "ccp4_rejected"] += 1
+
+    if result.dimple_ok and result.blobs > 0:
+        counts["blobs_found"] += 1
+
+    counts["datasets"] += 1
+    for stage, usage in result.usage.items():
+        counts["usage"].setdefault(stage, ResourceUsage()).add(usage)
+
+
+# Output files recorded in the results database: kind -> (stage, path below the processing dir).
+ARTIFACTS = {
+    "xds_ascii": ("xds", "XDS_ASCII.HKL"),
+    "merged_mtz": ("ccp4", "Merged.mtz"),
+    "freer_mtz": ("ccp4", "Final_with_FreeR.mtz"),
+    "aimless_log": ("ccp4", "aimless.log"),
+    "aimless_xml": ("ccp4", "XDS.xml"),
+    "dimple_log": ("dimple", "dimple.log"),
+}
+DIMPLE_ARTIFACTS = {"dimple_pdb": "final.pdb", "dimple_mtz": "final.mtz"}
+
+
+def result_artifacts(result: DatasetResult, env: PipelineEnv):
+    folder = result.dataset.processing_dir
+    paths = {kind: (stage, os.path.join(folder, name)) for kind, (stage, name) in ARTIFACTS.items()}
+    for kind, name in DIMPLE_ARTIFACTS.items():
+        paths[kind] = ("dimple", os.path.join(folder, env.dimple_outdir, name))
+    return {kind: path for kind, (stage, path) in paths.items()
+            if getattr(result, f"{stage}_ok") and os.path.isfile(path)}
+
+
+def result_record(result: DatasetResult, env: PipelineEnv):
+    """
+    One row for the results database (see results_db.RESULT_COLUMNS).
+    """
+    stats = result.stats or AimlessStats()
+    dataset_rel = os.path.normpath(result.dataset.dataset_rel)
+    if result.dataset.quick_look_degrees is not None:
+        # Own row, next to the full result of the dataset.
+        dataset_rel = os.path.join(dataset_rel, env.quick_look_dir)
+    return {
+        "dataset_rel": dataset_rel,
+        "dataset_id": result.dataset.dataset_id,
+        "processing_dir": result.dataset.processing_dir,
+        "xds_ok": results_db.as_flag(result.xds_ok),
+        "ccp4_ok": results_db.as_flag(result.ccp4_ok),
+        "dimple_ok": results_db.as_flag(result.dimple_ok),
+        "skipped": ",".join(result.skipped) or None,
+        "rejected": result.rejected,
+        "space_group": result.space_group,
+        "resolution": result.resolution,
+        "blobs": result.blobs if result.dimple_ok else None,
+        "completeness_pct": stats.completeness.overall,
+        "multiplicity": stats.multiplicity.overall,
+        "cc_half_outer": stats.cc_half.outer,
+        "isigi_outer": stats.i_over_sigma.outer,
+        "rmeas": stats.rmeas.overall,
+        "cell": " ".join(f"{v:.2f}" for v in stats.cell) if stats.cell else None,
+        "stats_json": json.dumps(asdict(result.stats)) if result.stats is not None else None,
+        "in_summary": int(result.write_summary),
+        "stages": {
+            stage: {
+                "ok": results_db.as_flag(getattr(result, f"{stage}_ok", None)),
+                "skipped": int(stage in result.skipped),
+                "wall": usage.wall,
+                "user_cpu": usage.user_cpu,
+                "sys_cpu": usage.sys_cpu,
+                "max_rss_kb": usage.max_rss_kb,
+                "read_bytes": usage.read_bytes,
+                "write_bytes": usage.write_bytes,
+                "commands": usage.commands,
+            }
+            for stage, usage in result.usage.items()
+        },
+        "artifacts": result_artifacts(result, env),
+    }
+
+
+# ============================================================
+# STAGES
+# ============================================================
+
+def check_frames(checker: cbf_frames.FrameChecker, folder, series: FrameSeries, data_range):
+    """
+    None if every frame XDS will read is good, otherwise the reason (bad frames listed).
+    Without data_range the whole series is checked: frames missing between its
+    first and last frame are bad, rather than XDS quietly using a shorter run.
+    """
+    bad = {}
+    if data_range:
+        names = series_frame_names(series, data_range)
+    else:
+        gaps = {n for gap_start, gap_end in series.missing for n in range(gap_start, gap_end + 1)}
+        names = [series.frame_name(n) for n in range(series.first, series.last + 1) if n not in gaps]
+        bad = {os.path.join(series.directory, series.frame_name(n)): "missing" for n in gaps}
+    paths = [os.path.join(series.directory, name) for name in names]
+    with event_log.phase("frame_check", frames=len(paths)):
+        bad.update(checker.check(paths, cache_dir=folder))
+    if not bad:
+        return None
+    for path, reason in sorted(bad.items())[:10]:
+        print(f"    Bad frame {os.path.basename(path)}: {reason}")
+    if len(bad) > 10:
+        print(f"    ... and {len(bad) - 10} more")
+    return f"{len(bad)} bad frame(s) of {len(set(paths) | set(bad))}"
+
+
+def xds_stage(result: DatasetResult, env: PipelineEnv, raw_index, frame_staging=None, frame_checker=None):
+    ds = result.dataset
+    folder = ds.processing_dir
+    try:
+        series = select_frame_series(raw_index, env.raw_data_base_dir, ds.dataset_rel, env.prefix_hint)
+        print(f"    Frames: {series.template} {series.first}-{series.last} ({series.count} images)")
+        if series.missing:
+            gaps = ", ".join(f"{a}-{b}" for a, b in series.missing[:5])
+            if frame_checker is not None and not env.data_range and ds.quick_look_degrees is None:
+                print(f"    WARNING: missing frames {gaps}; the frame check will reject the dataset "
+                      "(FRAME_CHECK = False uses the longest run without gaps)")
             else:
-                counts["dimple_fail"] += 1
-                dimple_ok_str = "FAILED"
-                blobs_str = "N/A"
+                print(f"    WARNING: missing frames {gaps}; using frames "
+                      "{}-{}".format(*series.contiguous_range()))
+        header = series_frame_header(env, folder, series)
+        if header is not None:
+            print(f"    Header: {header.detector or 'unknown detector'}, {header.wavelength} A, "
+                  f"{header.distance} mm, {header.oscillation} deg, beam ({header.beam_x}, {header.beam_y})")
+        data_range = env.data_range or "{} {}".format(*series.contiguous_range())
+        first, last = (int(v) for v in data_range.split()[:2])
+        if ds.quick_look_degrees is not None:
+            oscillation = xds_oscillation(folder, header)
+            if not oscillation:
+                raise ValueError("OSCILLATION_RANGE unknown, cannot pick the quick-look frames")
+            last = min(last, first + max(1, round(ds.quick_look_degrees / oscillation)) - 1)
+            data_range = f"{first} {last}"
+            print(f"    Quick look: frames {first}-{last}")
+        xds_plan = plan_xds_parallelism(env, os.path.join(folder, "XDS.INP"), last - first + 1)
+        if xds_plan is not None:
+            print(f"    XDS: {xds_plan.jobs} job(s) x {xds_plan.processors} processors, "
+                  f"{xds_plan.images_in_cache} images in cache")
+        # The detector named in the header replaces DETECTOR_TYPE (and its fixed OVERLOAD).
+        header_detector = header is not None and header.detector_type and env.xds_inp_from_header != "check"
+        wedges = None
+        if not env.spot_range:
+            wedges = spot_wedges(env, first, last, xds_oscillation(folder, header))
+            if wedges:
+                print(f"    Spot wedges: {', '.join(r.replace(' ', '-') for r in wedges)}")
+        transform_xds_inp_auto_template(
+            os.path.join(folder, "XDS.INP"),
+            series,
+            env.space_group_number,
+            env.unit_cell_constants,
+            data_range,
+            wedges or env.spot_range,
+            None if header_detector else env.detector_type,
+            xds_plan.processors if xds_plan else xds_processors(env),
+            xds_plan.jobs if xds_plan else None,
+            xds_plan.images_in_cache if xds_plan else None,
+        )
+        if header is not None:
+            apply_frame_header(os.path.join(folder, "XDS.INP"), header, env.xds_inp_from_header)
+    except Exception as e:
+        print(f"XDS.INP modification failed for '{ds.dataset_id}': {e}")
+        result.xds_ok = False
+        return False
 
-        append_summary_line(env.summary_file, ds.dataset_id, sg, res, dimple_ok_str, blobs_str)
+    xds_fp = xds_fingerprint(folder, series, data_range)
+    if stage_up_to_date(folder, "xds", xds_fp, env):
+        print(f"XDS up to date for '{ds.dataset_id}', skipped")
+        result.xds_ok = True
+        result.skipped += ("xds",)
+        return True
 
-    print(f"\nSummary written to: {env.summary_file}")
-    print_counter(counts, env)
+    forget_stage(folder, "xds")
+    job, changed = xds_rerun_job(folder, series, env, data_range)
+    if job is not None:
+        print(f"    XDS.INP changed since the last run ({', '.join(changed)}); JOB= {job}")
+
+    # CORRECT does not read frames.
+    if frame_checker is not None and job != "CORRECT":
+        # A quick look only reads its first frames; otherwise DATA_RANGE or the whole series.
+        reason = check_frames(frame_checker, folder, series,
+                              data_range if ds.quick_look_degrees is not None else env.data_range)
+        if reason is not None:
+            print(f"XDS skipped for '{ds.dataset_id}': {reason}")
+            result.rejected = reason
+            result.xds_ok = False
+            return False
+
+    # The quick look reads its few frames from RAW_DATA_BASE_DIR.
+    staged = None
+    if frame_staging is not None and job != "CORRECT" and ds.quick_look_degrees is None:
+        staged = frame_staging.acquire(ds, series)
+    xds_inp = os.path.join(folder, "XDS.INP")
+    if staged is not None:
+        print(f"    Frames staged: {staged.template}")
+        set_xds_inp_keywords(xds_inp, {"NAME_TEMPLATE_OF_DATA_FRAMES": staged.template})
+    try:
+        result.xds_ok = run_xds(folder, env, job=job, fallback_spot_range=data_range if wedges else None)
+    finally:
+        if staged is not None:
+            # XDS.INP keeps pointing at the raw frames; the staged copy may be evicted.
+            set_xds_inp_keywords(xds_inp, {"NAME_TEMPLATE_OF_DATA_FRAMES": series.template})
+            frame_staging.release(ds)
+    if result.xds_ok:
+        mark_stage_done(folder, "xds", xds_fp, ["XDS_ASCII.HKL"])
+        save_xds_snapshot(folder, series, data_range)
+    return result.xds_ok
+
+
+def ccp4_stage(result: DatasetResult, env: PipelineEnv, input_mode="hkl", hklin_name=None):
+    ds = result.dataset
+    folder = ds.processing_dir
+    if hklin_name is None:
+        hklin_name = "XDS_ASCII.HKL" if input_mode == "hkl" else "XDS_ASCII.mtz"
+    hklin_path = os.path.join(folder, hklin_name)
+
+    ccp4_fp = ccp4_fingerprint(env, input_mode, hklin_path)
+    if stage_up_to_date(folder, "ccp4", ccp4_fp, env):
+        print(f"CCP4 up to date for '{ds.dataset_id}', skipped")
+        ccp4 = read_aimless_results(folder)
+        result.skipped += ("ccp4",)
+    else:
+        forget_stage(folder, "ccp4")
+        high_resolution = None
+        if env.triage and xds_ascii is not None and input_mode == "hkl" and os.path.isfile(hklin_path):
+            tri, reason = triage_dataset(hklin_path, env)
+            if reason is not None:
+                print(f"CCP4 skipped for '{ds.dataset_id}': rejected by triage, {reason}")
+                result.rejected = reason
+                result.ccp4_ok = False
+                return False
+            if env.triage_apply_cutoff:
+                high_resolution = tri.resolution_estimate
+        ccp4 = run_ccp4_pipeline(folder, env, input_mode=input_mode, hklin_path=hklin_path,
+                                 high_resolution=high_resolution)
+        if ccp4 is not None:
+            mark_stage_done(folder, "ccp4", ccp4_fp, ["Final_with_FreeR.mtz", "aimless.log"])
+
+    result.ccp4_ok = ccp4 is not None
+    if ccp4 is None:
+        return False
+    result.stats = ccp4
+    result.space_group, result.resolution = ccp4.space_group, ccp4.high_resolution
+    result.write_summary = True
+    return True
 
 
-def aimless_only(env: PipelineEnv):
-    print(f"\n=== AIMLESS-ONLY MODE: Searching under: {env.root_dir} ===\n")
-    write_summary_header(env.summary_file)
+def dimple_stage(result: DatasetResult, env: PipelineEnv):
+    ds = result.dataset
+    folder = ds.processing_dir
+    if ds.quick_look_degrees is not None:
+        return True
+
+    dimple_fp = dimple_fingerprint(folder, env, env.dimple_pdb, env.dimple_outdir)
+    if stage_up_to_date(folder, "dimple", dimple_fp, env):
+        print(f"DIMPLE up to date for '{ds.dataset_id}', skipped")
+        blobs = parse_dimple_blobs(folder)
+        result.skipped += ("dimple",)
+    else:
+        forget_stage(folder, "dimple")
+        blobs = run_dimple(folder, env.dimple_pdb, env.dimple_outdir, env)
+        if blobs >= 0:
+            outputs = ["dimple.log"]
+            if os.path.isfile(os.path.join(folder, env.dimple_outdir, "final.pdb")):
+                outputs.append(os.path.join(env.dimple_outdir, "final.pdb"))
+            mark_stage_done(folder, "dimple", dimple_fp, outputs)
+
+    result.dimple_ok = blobs >= 0
+    result.blobs = blobs
+    return result.dimple_ok
+
+
+def dimple_only_stage(result: DatasetResult, env: PipelineEnv):
+    result.stats = read_aimless_results(result.dataset.processing_dir)
+    result.space_group, result.resolution = result.stats.space_group, result.stats.high_resolution
+    result.write_summary = True
+    return dimple_stage(result, env)
+
+
+def full_banner(ds: Dataset, env: PipelineEnv):
+    print(f"\n--- Dataset: {ds.dataset_id} ---")
+    print(f"    Processing dir: {ds.processing_dir}")
+    print(f"    Raw lookup dir: {os.path.join(env.raw_data_base_dir, ds.dataset_rel)}")
+    if ds.estimated_seconds is not None:
+        print(f"    Estimated time: {format_hours(ds.estimated_seconds)}")
+
+
+def ccp4_only_banner(ds: Dataset):
+    print(f"\n--- CCP4-only dataset: {ds.dataset_id} ---")
+
+
+def dimple_only_banner(ds: Dataset):
+    print(f"\n--- DIMPLE-only dataset: {ds.dataset_id} ---")
+
+
+def dimple_stages(env: PipelineEnv):
+    if env.dimple_pdb is None:
+        return []
+    return [Stage("dimple", partial(dimple_stage, env=env), env.dimple_workers)]
+
+
+def full_plan(env: PipelineEnv, raw_index, frame_staging=None):
+    frame_checker = cbf_frames.FrameChecker(env.frame_check_threads) if env.frame_check else None
+    return StagePlan(
+        banner=partial(full_banner, env=env),
+        stages=[
+            Stage("xds", partial(xds_stage, env=env, raw_index=raw_index, frame_staging=frame_staging,
+                                 frame_checker=frame_checker),
+                  env.xds_workers),
+            Stage("ccp4", partial(ccp4_stage, env=env), env.ccp4_workers),
+        ] + dimple_stages(env),
+    )
 
-    counts = {"xds_ok": 0, "xds_fail": 0, "ccp4_ok": 0, "ccp4_fail": 0,
-              "dimple_ok": 0, "dimple_fail": 0, "blobs_found": 0}
 
+def aimless_only_plan(env: PipelineEnv):
     if env.aimless_input_file.lower().endswith(".hkl"):
         input_mode = "hkl"
     elif env.aimless_input_file.lower().endswith(".mtz"):
@@ -621,41 +2904,387 @@ def aimless_only(env: PipelineEnv):
     else:
         raise ValueError(f"AIMLESS_INPUT_FILE must be .hkl or .mtz, got '{env.aimless_input_file}'")
 
-    for subdir, _, files in os.walk(env.root_dir):
-        if env.aimless_input_file not in files:
-            continue
+    return StagePlan(
+        banner=ccp4_only_banner,
+        stages=[
+            Stage("ccp4", partial(ccp4_stage, env=env, input_mode=input_mode,
+                                  hklin_name=env.aimless_input_file), env.ccp4_workers),
+        ] + dimple_stages(env),
+    )
+
+
+def dimple_only_plan(env: PipelineEnv):
+    return StagePlan(
+        banner=dimple_only_banner,
+        stages=[Stage("dimple", partial(dimple_only_stage, env=env), env.dimple_workers)],
+    )
+
+
+# ============================================================
+# WATCH MODE
+# ============================================================
+
+def scan_frame_series(env: PipelineEnv, dir_rel):
+    try:
+        with os.scandir(os.path.join(env.raw_data_base_dir, dir_rel)) as it:
+            return summarize_frame_series(list(it))
+    except OSError:
+        return []
+
+
+def add_to_raw_index(raw_index, dir_rel, series_list):
+    raw_index[dir_rel] = series_list
+    parent = os.path.dirname(dir_rel)
+    while parent:
+        raw_index.setdefault(parent, [])
+        parent = os.path.dirname(parent)
+
+
+def last_frame_mtime(env: PipelineEnv, dir_rel, data):
+    series = FrameSeries(directory=os.path.join(env.raw_data_base_dir, dir_rel), **data)
+    try:
+        return os.stat(series.frame_path(series.last)).st_mtime
+    except OSError:
+        return time.time()
+
+
+def raw_dir_datasets(env: PipelineEnv, dir_rel):
+    """
+    Datasets whose images are in RAW_DATA_BASE_DIR/dir_rel: the processing folders
+    with XDS.INP in the same directory under ROOT_DIR, or in the closest parent that has any.
+    """
+    prune = discovery_prune(env)
+    rel = os.path.normpath(dir_rel)
+    while rel not in (".", ""):
+        found = []
+        try:
+            with os.scandir(os.path.join(env.root_dir, rel)) as it:
+                for e in it:
+                    if (e.name not in prune and e.is_dir()
+                            and os.path.isfile(os.path.join(e.path, "XDS.INP"))):
+                        found.append(derive_dataset_info_from_xds_dir(e.path, env.root_dir))
+        except OSError:
+            pass
+        if found:
+            return sorted(found, key=lambda ds: ds.processing_dir)
+        rel = os.path.dirname(rel)
+    return []
+
+
+def expected_last_frame(env: PipelineEnv, dir_rel, data):
+    """
+    Number of the last frame of a series still being collected: from
+    WATCH_EXPECTED_FRAMES, or the DATA_RANGE of its datasets' original XDS.INP.
+    """
+    if env.watch_expected_frames:
+        return data["first"] + env.watch_expected_frames - 1
+    lasts = []
+    for ds in raw_dir_datasets(env, dir_rel):
+        for name in ("XDS_org.INP", "XDS.INP"):
+            path = os.path.join(ds.processing_dir, name)
+            if not os.path.isfile(path):
+                continue
+            try:
+                lasts.append(int(xds_inp_keywords(path)["DATA_RANGE"][-1].split()[1]))
+            except (OSError, KeyError, IndexError, ValueError):
+                pass
+            break
+    return max(lasts) if lasts else None
+
+
+def watched_datasets(env: PipelineEnv, raw_index, active):
+    """
+    Yield every dataset whose image series is complete, as soon as it is, and add
+    it to the raw index. A dataset still in active (running) waits. Runs until
+    WATCH_STOP_IDLE_HOURS pass without a new dataset, or forever.
+    """
+    watcher = raw_watch.open_watcher(env.raw_data_base_dir, env.watch_method, env.watch_poll_seconds)
+    tracker = raw_watch.SeriesTracker(env.watch_settle_seconds, env.watch_quiet_seconds)
+    for dir_rel, series_list in raw_index.items():
+        for data in series_list:
+            changed = last_frame_mtime(env, dir_rel, data) if env.watch_existing else None
+            tracker.update(dir_rel, [data], changed=changed, handed_out=not env.watch_existing)
+    print(f"Watching {env.raw_data_base_dir} ({watcher.name}, {len(tracker.series)} series known); "
+          "stop with Ctrl-C")
+
+    expected = partial(expected_last_frame, env)
+    tick = max(1.0, min(env.watch_poll_seconds, env.watch_settle_seconds))
+    without_xds_inp = {}   # dir_rel -> reported
+    waiting = []
+    last_new = time.time()
+    try:
+        while True:
+            for dir_rel in watcher.wait(tick):
+                tracker.update(dir_rel, scan_frame_series(env, dir_rel))
+
+            for dir_rel, data in tracker.ready(expected):
+                series = FrameSeries(directory=os.path.join(env.raw_data_base_dir, dir_rel), **data)
+                print(f"[{time.strftime('%H:%M:%S')}] Image series complete: {series.template} "
+                      f"{series.first}-{series.last} ({series.count} images)")
+                add_to_raw_index(raw_index, dir_rel, scan_frame_series(env, dir_rel))
+                without_xds_inp.setdefault(dir_rel, False)
+
+            for dir_rel, reported in list(without_xds_inp.items()):
+                datasets = raw_dir_datasets(env, dir_rel)
+                if datasets:
+                    del without_xds_inp[dir_rel]
+                    waiting += [ds for ds in datasets if ds not in waiting]
+                elif not reported:
+                    without_xds_inp[dir_rel] = True
+                    print(f"  No XDS.INP for {dir_rel} under {env.root_dir} yet; waiting for it")
+
+            for ds in list(waiting):
+                if ds.dataset_id not in active:
+                    waiting.remove(ds)
+                    active.add(ds.dataset_id)
+                    last_new = time.time()
+                    yield ds
+
+            idle = time.time() - last_new
+            if (env.watch_stop_idle_hours is not None and not active and not waiting
+                    and idle >= env.watch_stop_idle_hours * 3600):
+                print(f"No new dataset for {format_hours(idle)}; watch finished")
+                return
+    finally:
+        watcher.close()
 
-        ds = derive_dataset_info_from_xds_dir(subdir, env.root_dir)
-        print(f"\n--- CCP4-only dataset: {ds.dataset_id} ---")
 
-        hklin_path = os.path.join(ds.processing_dir, env.aimless_input_file)
-        result = run_ccp4_pipeline(ds.processing_dir, env, input_mode=input_mode, hklin_path=hklin_path)
-        if result is None:
-            counts["ccp4_fail"] += 1
+# ============================================================
+# DATASET ORDER
+# ============================================================
+
+def read_priority_file(path):
+    """
+    Paths listed in the priority file, most important first.
+    """
+    with open(path) as f:
+        lines = (line.split("#", 1)[0].strip() for line in f)
+        return [os.path.normpath(line.strip("/")) for line in lines if line]
+
+
+def priority_rank(priorities, dataset_rel):
+    rel = os.path.normpath(dataset_rel)
+    for rank, prefix in enumerate(priorities):
+        if rel == prefix or rel.startswith(prefix + os.sep):
+            return rank
+    return len(priorities)
+
+
+def dataset_frame_count(env: PipelineEnv, raw_index, ds: Dataset):
+    """
+    Number of frames XDS will read for ds, or None if unknown.
+    """
+    if raw_index is None:
+        return None
+    try:
+        series = select_frame_series(raw_index, env.raw_data_base_dir, ds.dataset_rel, env.prefix_hint,
+                                     quiet=True)
+    except FileNotFoundError:
+        return None
+    return len(series_frame_names(series, env.data_range))
+
+
+def recorded_runtimes(env: PipelineEnv):
+    if env.results_db is None or not os.path.isfile(env.results_db):
+        return {}
+    try:
+        return results_db.dataset_runtimes(env.results_db)
+    except sqlite3.Error as e:
+        print(f"WARNING: no runtimes from {env.results_db}: {e}")
+        return {}
+
+
+def estimate_runtimes(env: PipelineEnv, datasets, raw_index):
+    """
+    {dataset_rel: seconds or None}: the last full run of the dataset from RESULTS_DB,
+    else its frame count times the median time per frame of the datasets with
+    timings (ESTIMATE_SECONDS_PER_FRAME if there are none).
+    """
+    runtimes = recorded_runtimes(env)
+    frames = {ds.dataset_rel: dataset_frame_count(env, raw_index, ds) for ds in datasets}
+    rates = sorted(runtimes[os.path.normpath(rel)] / n for rel, n in frames.items()
+                   if n and os.path.normpath(rel) in runtimes)
+    per_frame = rates[len(rates) // 2] if rates else env.estimate_seconds_per_frame
+    estimates = {}
+    for ds in datasets:
+        recorded = runtimes.get(os.path.normpath(ds.dataset_rel))
+        n = frames[ds.dataset_rel]
+        estimates[ds.dataset_rel] = recorded if recorded is not None else (n * per_frame if n else None)
+    return estimates
+
+
+def order_datasets(env: PipelineEnv, datasets, raw_index=None):
+    """
+    datasets sorted by env.dataset_order, each with its estimated_seconds.
+    """
+    order = [env.dataset_order] if isinstance(env.dataset_order, str) else list(env.dataset_order)
+    unknown = set(order) - {"priority", "unprocessed", "shortest", "path"}
+    if unknown:
+        raise ValueError(f"Unknown DATASET_ORDER {sorted(unknown)}. "
+                         "Use 'priority', 'unprocessed', 'shortest' and/or 'path'.")
+    priorities = read_priority_file(env.priority_file) if env.priority_file and "priority" in order else []
+    estimates = estimate_runtimes(env, datasets, raw_index)
+    datasets = [replace(ds, estimated_seconds=estimates[ds.dataset_rel]) for ds in datasets]
+
+    def key(ds: Dataset):
+        keys = []
+        for policy in order:
+            if policy == "priority":
+                keys.append(priority_rank(priorities, ds.dataset_rel))
+            elif policy == "unprocessed":
+                keys.append(bool(load_stage_state(ds.processing_dir)))
+            elif policy == "shortest":
+                # Unknown estimates last.
+                keys.append((ds.estimated_seconds is None, ds.estimated_seconds or 0))
+        return keys + [ds.dataset_rel]
+
+    datasets.sort(key=key)
+    known = [ds.estimated_seconds for ds in datasets if ds.estimated_seconds is not None]
+    if datasets:
+        print(f"Order: {', '.join(order)}; estimated {format_hours(sum(known))} of dataset time "
+              f"for {len(known)} of {len(datasets)} dataset(s)")
+    return datasets
+
+
+# ============================================================
+# QUICK LOOK
+# ============================================================
+
+def quick_look_dataset(env: PipelineEnv, ds: Dataset) -> Dataset:
+    """
+    Quick-look pass of ds, in env.quick_look_dir below its processing folder. The
+    XDS.INP there starts as a copy of the dataset's original XDS.INP.
+    """
+    folder = os.path.join(ds.processing_dir, env.quick_look_dir)
+    xds_inp = os.path.join(folder, "XDS.INP")
+    if not os.path.isfile(xds_inp):
+        os.makedirs(folder, exist_ok=True)
+        original = os.path.join(ds.processing_dir, "XDS_org.INP")
+        if not os.path.isfile(original):
+            original = os.path.join(ds.processing_dir, "XDS.INP")
+        shutil.copyfile(original, xds_inp)
+    return Dataset(
+        processing_dir=folder,
+        dataset_dir=ds.dataset_dir,
+        dataset_rel=ds.dataset_rel,
+        dataset_id=f"{ds.dataset_id}_quick",
+        quick_look_degrees=env.quick_look_degrees,
+    )
+
+
+def two_tier_datasets(env: PipelineEnv, datasets, verdicts: queue.Queue):
+    """
+    The quick look of every dataset, then the full pass of each dataset in the
+    order its quick look finishes. verdicts receives the quick-look DatasetResults
+    from the caller; with env.quick_look_skip_failed a failed one drops the full pass.
+    """
+    full = {}
+    for ds in datasets:
+        try:
+            quick = quick_look_dataset(env, ds)
+        except OSError as e:
+            print(f"Quick look not possible for '{ds.dataset_id}': {e}")
             continue
-        counts["ccp4_ok"] += 1
-
-        sg, res = result
-        dimple_ok_str = "N/A"
-        blobs_str = "N/A"
-
-        if env.dimple_pdb is not None:
-            blobs = run_dimple(ds.processing_dir, env.dimple_pdb, env.dimple_outdir, env)
-            if blobs >= 0:
-                counts["dimple_ok"] += 1
-                dimple_ok_str = "OK"
-                blobs_str = str(blobs)
-                if blobs > 0:
-                    counts["blobs_found"] += 1
-            else:
-                counts["dimple_fail"] += 1
-                dimple_ok_str = "FAILED"
-                blobs_str = "N/A"
+        full[ds.dataset_rel] = ds
+        yield quick
+    if not env.quick_look_full_pass:
+        return
+    for _ in range(len(full)):
+        result = verdicts.get()
+        ds = full[result.dataset.dataset_rel]
+        if env.quick_look_skip_failed and not dataset_ok(result):
+            print(f"Full pass skipped for '{ds.dataset_id}': quick look failed")
+            continue
+        yield ds
+
+
+# ============================================================
+# PIPELINE MODES
+# ============================================================
+
+def full_pipeline(env: PipelineEnv):
+    print(f"\n=== FULL MODE: Starting batch processing in: {env.root_dir} ===\n")
+
+    counts = new_counts()
+    run_id = new_run_id()
+    results = open_results(env, "full", run_id)
+    run_log = open_run_log(env, "full", run_id)
+    prepare_ccp4_environment(env)
+    raw_index = build_raw_index(env)
+    datasets = order_datasets(env, find_datasets(env, "XDS.INP"), raw_index)
+    frame_staging = FrameStaging(env, datasets, raw_index) if env.frame_cache_dir else None
+    plan = full_plan(env, raw_index, frame_staging)
+    try:
+        for result in run_datasets(datasets, plan, env):
+            record_result(counts, result, env, results)
+    finally:
+        if frame_staging is not None:
+            frame_staging.close()
+
+    close_results(results, env)
+    print(f"\nSummary written to: {env.summary_file}")
+    print_counter(counts, env)
+    close_run_log(run_log, counts)
+
+
+def quick_look(env: PipelineEnv):
+    print(f"\n=== QUICK-LOOK MODE: first {env.quick_look_degrees} deg of every dataset, "
+          f"then the full sweep, in: {env.root_dir} ===\n")
+
+    quick_counts, counts = new_counts(), new_counts()
+    skipped = 0
+    run_id = new_run_id()
+    results = open_results(env, "quick-look", run_id)
+    run_log = open_run_log(env, "quick-look", run_id)
+    prepare_ccp4_environment(env)
+    raw_index = build_raw_index(env)
+    datasets = order_datasets(env, find_datasets(env, "XDS.INP"), raw_index)
+    frame_staging = FrameStaging(env, datasets, raw_index) if env.frame_cache_dir else None
+    plan = full_plan(env, raw_index, frame_staging)
+    verdicts = queue.Queue()
+    try:
+        for result in run_datasets(two_tier_datasets(env, datasets, verdicts), plan, env):
+            if result.dataset.quick_look_degrees is None:
+                record_result(counts, result, env, results)
+                continue
+            record_result(quick_counts, result, env, results)
+            # The quick verdict goes into summary.txt right away.
+            results.flush()
+            results.write_summary(env.summary_file)
+            if env.quick_look_skip_failed and not dataset_ok(result):
+                skipped += 1
+            verdicts.put(result)
+    finally:
+        if frame_staging is not None:
+            frame_staging.close()
+
+    close_results(results, env)
+    print(f"\nSummary written to: {env.summary_file}")
+    print(f"\nQuick look ({env.quick_look_degrees} deg):")
+    print_counter(quick_counts, replace(env, dimple_pdb=None))
+    if env.quick_look_full_pass:
+        print(f"Full sweep ({skipped} dataset(s) skipped after a failed quick look):")
+        print_counter(counts, env)
+    close_run_log(run_log, counts)
 
-        append_summary_line(env.summary_file, ds.dataset_id, sg, res, dimple_ok_str, blobs_str)
 
+def aimless_only(env: PipelineEnv):
+    print(f"\n=== AIMLESS-ONLY MODE: Searching under: {env.root_dir} ===\n")
+
+    counts = new_counts()
+    run_id = new_run_id()
+    results = open_results(env, "aimless-only", run_id)
+    run_log = open_run_log(env, "aimless-only", run_id)
+    prepare_ccp4_environment(env)
+    plan = aimless_only_plan(env)
+    datasets = order_datasets(env, find_datasets(env, env.aimless_input_file))
+    for result in run_datasets(datasets, plan, env):
+        record_result(counts, result, env, results)
+
+    close_results(results, env)
     print(f"\nSummary written to: {env.summary_file}")
     print_counter(counts, env)
+    close_run_log(run_log, counts)
 
 
 def dimple_only(env: PipelineEnv):
@@ -664,36 +3293,256 @@ def dimple_only(env: PipelineEnv):
         return
 
     print(f"\n=== DIMPLE-ONLY MODE: Searching under: {env.root_dir} ===\n")
-    write_summary_header(env.summary_file)
 
-    counts = {"xds_ok": 0, "xds_fail": 0, "ccp4_ok": 0, "ccp4_fail": 0,
-              "dimple_ok": 0, "dimple_fail": 0, "blobs_found": 0}
+    counts = new_counts()
+    run_id = new_run_id()
+    results = open_results(env, "dimple-only", run_id)
+    run_log = open_run_log(env, "dimple-only", run_id)
+    prepare_ccp4_environment(env)
+    plan = dimple_only_plan(env)
+    datasets = order_datasets(env, find_datasets(env, "Final_with_FreeR.mtz"))
+    for result in run_datasets(datasets, plan, env):
+        record_result(counts, result, env, results)
+
+    close_results(results, env)
+    print(f"\nSummary written to: {env.summary_file}")
+    print_counter(counts, env)
+    close_run_log(run_log, counts)
+
 
-    for subdir, _, files in os.walk(env.root_dir):
-        if "Final_with_FreeR.mtz" not in files:
-            continue
+def mode_marker(env: PipelineEnv, mode):
+    """
+    File that marks a dataset for mode.
+    """
+    if mode == "full":
+        return "XDS.INP"
+    if mode == "aimless-only":
+        return env.aimless_input_file
+    if mode == "dimple-only":
+        return "Final_with_FreeR.mtz"
+    raise ValueError(f"Unknown WORK_MODE='{mode}'. Use 'full', 'aimless-only' or 'dimple-only'.")
 
-        ds = derive_dataset_info_from_xds_dir(subdir, env.root_dir)
-        print(f"\n--- DIMPLE-only dataset: {ds.dataset_id} ---")
 
-        sg, res = parse_aimless_summary(os.path.join(ds.processing_dir, "aimless.log"))
+def dataset_ok(result: DatasetResult):
+    return not any(getattr(result, f"{stage}_ok") is False for stage in ("xds", "ccp4", "dimple"))
 
-        blobs = run_dimple(ds.processing_dir, env.dimple_pdb, env.dimple_outdir, env)
-        if blobs >= 0:
-            counts["dimple_ok"] += 1
-            dimple_ok_str = "OK"
-            blobs_str = str(blobs)
-            if blobs > 0:
-                counts["blobs_found"] += 1
-        else:
-            counts["dimple_fail"] += 1
-            dimple_ok_str = "FAILED"
-            blobs_str = "N/A"
 
-        append_summary_line(env.summary_file, ds.dataset_id, sg, res, dimple_ok_str, blobs_str)
+def queue_coordinator(env: PipelineEnv):
+    """
+    Queue the datasets of WORK_MODE for the workers and store their results
+    in the results database until every dataset is done or failed.
+    """
+    mode = env.work_mode
+    marker = mode_marker(env, mode)
+    if mode == "dimple-only" and env.dimple_pdb is None:
+        print("ERROR: DIMPLE_PDB must be set for dimple-only mode.")
+        return
+    if env.work_queue is None:
+        print("ERROR: WORK_QUEUE must be set for coordinator mode.")
+        return
+
+    print(f"\n=== COORDINATOR ({mode}): Searching under: {env.root_dir} ===\n")
+
+    run_id = new_run_id()
+    results = open_results(env, f"coordinator {mode}", run_id)
+    raw_index = build_raw_index(env) if mode == "full" else None
+    datasets = order_datasets(env, find_datasets(env, marker), raw_index)
+    jobs = work_queue.WorkQueue(env.work_queue)
+    queued = jobs.enqueue([asdict(ds) for ds in datasets])
+    print(f"Queued {queued} of {len(datasets)} dataset(s) in {env.work_queue}"
+          + (f" ({len(datasets) - queued} still leased by a worker)" if queued < len(datasets) else ""))
+    print(f"Start workers with MODE = \"worker\" and WORK_MODE = \"{mode}\".")
+
+    failed = []
+    last = None
+    try:
+        while True:
+            requeued, lost = jobs.requeue_expired(env.lease_max_attempts)
+            for dataset_rel in requeued:
+                print(f"Lease of '{dataset_rel}' expired; queued again")
+            for dataset_rel in lost:
+                print(f"Lease of '{dataset_rel}' expired {env.lease_max_attempts} times; marked failed")
+            failed += lost
+            for record in jobs.take_finished():
+                if results.add(record):
+                    results.write_summary(env.summary_file)
+
+            counts = jobs.counts()
+            progress = (counts, len(jobs.workers()))
+            if progress != last:
+                last = progress
+                print(f"[{time.strftime('%H:%M:%S')}] queued {counts['queued']}, running {counts['leased']} "
+                      f"on {progress[1]} worker(s), done {counts['done']}, failed {counts['failed']}")
+            if counts["queued"] == 0 and counts["leased"] == 0:
+                break
+            time.sleep(env.work_poll_seconds)
+        for record in jobs.take_finished():
+            results.add(record)
+    finally:
+        jobs.close()
+
+    close_results(results, env)
+    print(f"\nSummary written to: {env.summary_file}")
+    if failed:
+        print(f"No result for {len(failed)} dataset(s) whose workers stopped responding:")
+        for dataset_rel in failed:
+            print(f"  {dataset_rel}")
+
+
+def worker_events_file(env: PipelineEnv, worker):
+    # One event log per worker: appends from several hosts to one file on NFS can interleave.
+    if env.events_file is None:
+        return None
+    base, ext = os.path.splitext(env.events_file)
+    return f"{base}.{worker}{ext}"
+
 
+def queue_worker(env: PipelineEnv):
+    """
+    Process datasets leased from WORK_QUEUE until it is empty; the results go back
+    to the queue, the coordinator stores them.
+    """
+    mode = env.work_mode
+    mode_marker(env, mode)
+    if env.work_queue is None or not os.path.exists(env.work_queue):
+        print(f"ERROR: no work queue at {env.work_queue}; start the coordinator first.")
+        return
+
+    name = work_queue.worker_name()
+    print(f"\n=== WORKER {name} ({mode}): queue {env.work_queue} ===\n")
+
+    counts = new_counts()
+    run_id = new_run_id()
+    run_log = open_run_log(replace(env, events_file=worker_events_file(env, name)), f"worker {mode}", run_id)
+    prepare_ccp4_environment(env)
+    if mode == "full":
+        # Frames are not staged: the next datasets of this worker are not known in advance.
+        plan = full_plan(env, build_raw_index(env))
+    elif mode == "aimless-only":
+        plan = aimless_only_plan(env)
+    else:
+        plan = dimple_only_plan(env)
+
+    jobs = work_queue.WorkQueue(env.work_queue)
+    heartbeat = work_queue.Heartbeat(jobs, name, env.lease_seconds)
+    heartbeat.start()
+    leases = work_queue.leased_datasets(jobs, name, env.lease_seconds, env.work_poll_seconds,
+                                        env.lease_max_attempts)
+    try:
+        for result in run_datasets((Dataset(**ds) for ds in leases), plan, env):
+            count_result(counts, result)
+            if not jobs.complete(name, result.dataset.dataset_rel, dataset_ok(result), result_record(result, env)):
+                print(f"Lease of '{result.dataset.dataset_id}' had expired; result dropped "
+                      f"(the dataset was queued again)")
+    finally:
+        heartbeat.stop()
+        jobs.close()
+
+    print_counter(counts, env)
+    close_run_log(run_log, counts)
+
+
+def watch_mode(env: PipelineEnv):
+    print(f"\n=== WATCH MODE: Watching: {env.raw_data_base_dir} ===\n")
+
+    counts = new_counts()
+    run_id = new_run_id()
+    results = open_results(env, "watch", run_id)
+    run_log = open_run_log(env, "watch", run_id)
+    prepare_ccp4_environment(env)
+    raw_index = build_raw_index(env)
+    plan = full_plan(env, raw_index)
+    active = set()
+    try:
+        for result in run_datasets(watched_datasets(env, raw_index, active), plan, env):
+            active.discard(result.dataset.dataset_id)
+            record_result(counts, result, env, results)
+            # Results are wanted while the visit is still running, not per batch.
+            results.flush()
+            results.write_summary(env.summary_file)
+    except KeyboardInterrupt:
+        print("\nWatch stopped; datasets still running are processed again on the next run.")
+
+    close_results(results, env)
     print(f"\nSummary written to: {env.summary_file}")
     print_counter(counts, env)
+    close_run_log(run_log, counts)
+
+
+def xds_benchmark(env: PipelineEnv):
+    """
+    Time DEFPIX INTEGRATE on the first frames of the first dataset at several
+    JOBS x PROCESSORS splits of all cores and store the best split for this host.
+    """
+    print(f"\n=== XDS BENCHMARK: first dataset under: {env.root_dir} ===\n")
+    if env.xds_tuning_file is None:
+        print("ERROR: XDS_TUNING_FILE must be set for xds-benchmark mode.")
+        return
+
+    datasets = find_datasets(env, "XDS.INP")
+    if not datasets:
+        print("No dataset with XDS.INP found.")
+        return
+    ds = datasets[0]
+    raw_index = build_raw_index(env)
+    try:
+        series = select_frame_series(raw_index, env.raw_data_base_dir, ds.dataset_rel, env.prefix_hint)
+    except Exception as e:
+        print(f"No raw images for '{ds.dataset_id}': {e}")
+        return
+
+    first, last = series.contiguous_range()
+    last = min(last, first + env.xds_benchmark_frames - 1)
+    cores = available_cores(env)
+    print(f"Dataset {ds.dataset_id}, frames {first}-{last}, {cores} cores on {socket.gethostname()}")
+
+    workdir = tempfile.mkdtemp(prefix="xds_benchmark_")
+    try:
+        xds_inp = os.path.join(workdir, "XDS.INP")
+        shutil.copy2(os.path.join(ds.processing_dir, "XDS.INP"), xds_inp)
+        transform_xds_inp_auto_template(
+            xds_inp, series, env.space_group_number, env.unit_cell_constants,
+            f"{first} {last}", f"{first} {last}", env.detector_type, cores,
+        )
+        # Spot finding and indexing are not timed.
+        if not run_xds_once(workdir, env, "XDS_prepare.log", "XYCORR INIT COLSPOT IDXREF", output="XPARM.XDS"):
+            print(f"Indexing the benchmark wedge failed; see {os.path.join(workdir, 'XDS_prepare.log')}")
+            return
+
+        keywords = xds_inp_keywords(xds_inp)
+        frames_per_wedge = max(1, math.ceil(
+            first_keyword_number(keywords, "DELPHI", 5.0)
+            / (first_keyword_number(keywords, "OSCILLATION_RANGE", 0.1) or 0.1)))
+        timings = []
+        for jobs, processors in benchmark_settings(cores, last - first + 1, frames_per_wedge):
+            set_xds_inp_keywords(xds_inp, {
+                "MAXIMUM_NUMBER_OF_JOBS": jobs,
+                "MAXIMUM_NUMBER_OF_PROCESSORS": processors,
+            })
+            start = time.monotonic()
+            ok = run_xds_once(workdir, env, f"XDS_{jobs}x{processors}.log", "DEFPIX INTEGRATE",
+                              output="INTEGRATE.HKL")
+            elapsed = time.monotonic() - start
+            print(f"  {jobs:>3} job(s) x {processors:>3} processors: "
+                  + (f"{elapsed:8.1f} s" if ok else "FAILED"))
+            if ok:
+                timings.append({"jobs": jobs, "processors": processors, "seconds": round(elapsed, 2)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if not timings:
+        print("No setting completed; nothing stored.")
+        return
+    best = min(timings, key=lambda t: t["seconds"])
+    save_xds_tuning(env, {
+        "cores": cores,
+        "processors_per_job": best["processors"],
+        "frames": last - first + 1,
+        "timings": timings,
+        "measured": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    print(f"\nBest: {best['jobs']} job(s) x {best['processors']} processors; "
+          f"stored in {env.xds_tuning_file}")
 
 
 # ============================================================
@@ -711,7 +3560,18 @@ if __name__ == "__main__":
         aimless_only(ENV)
     elif MODE == "full":
         full_pipeline(ENV)
+    elif MODE == "quick-look":
+        quick_look(ENV)
     elif MODE == "dimple-only":
         dimple_only(ENV)
+    elif MODE == "xds-benchmark":
+        xds_benchmark(ENV)
+    elif MODE == "coordinator":
+        queue_coordinator(ENV)
+    elif MODE == "worker":
+        queue_worker(ENV)
+    elif MODE == "watch":
+        watch_mode(ENV)
     else:
-        print(f"ERROR: Unknown MODE='{MODE}'. Use 'full', 'aimless-only', or 'dimple-only'.")
+        print(f"ERROR: Unknown MODE='{MODE}'. Use 'full', 'quick-look', 'aimless-only', 'dimple-only', "
+              f"'xds-benchmark', 'coordinator', 'worker' or 'watch'.")
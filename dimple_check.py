@@ -1,11 +1,22 @@
 import os
 import glob
 
+import results_db
+
+try:
+    import mtz_file
+except ImportError:  # NumPy not available: final.mtz is not checked
+    mtz_file = None
+
 # Parameters
 space = "P 6 2 2"
 res_cut = 3.0
 rfree_cut = 0.6
 prefix = "POS*"
+# Results database of crystal_pipeline.py (run this script in its ROOT_DIR). If it
+# exists, final.pdb files are looked up there instead of walking the folders.
+results_db_path = "results.sqlite"
+use_db = bool(results_db_path) and os.path.isfile(results_db_path)
 
 # Output files
 with open("dimple_results.dat", "w") as w, open("dimple_results_filtered.dat", "w") as wc:
@@ -19,7 +30,11 @@ with open("dimple_results.dat", "w") as w, open("dimple_results_filtered.dat", "
         print(f"==================== PROCESSING {os.path.abspath(folder)} ====================")
 
         # Walk through all subdirectories and files
-        for root, dirs, files in os.walk(folder):
+        if use_db:
+            walk = results_db.artifact_walk(results_db_path, folder, {"dimple_pdb"})
+        else:
+            walk = os.walk(folder)
+        for root, dirs, files in walk:
             for file in files:
                 if file == "final.pdb":
                     file_path = os.path.join(root, file)
@@ -38,6 +53,14 @@ with open("dimple_results.dat", "w") as w, open("dimple_results_filtered.dat", "
                             # Write to results
                             w.write(f"{folder};{cryst};{res};{rfree}\n")
 
+                            # Do not pass on datasets whose final.mtz is empty or broken
+                            mtz_problems = []
+                            if mtz_file is not None:
+                                _, mtz_problems = mtz_file.validate_mtz(os.path.join(root, "final.mtz"))
+                            if mtz_problems:
+                                print(f"Skipping {folder}: final.mtz unusable ({'; '.join(mtz_problems)})")
+                                continue
+
                             # Apply filters and write to filtered file
                             if space in cryst and float(res) <= res_cut and float(rfree) <= rfree_cut:
                                 wc.write(f"{folder};{cryst};{res};{rfree}\n")
@@ -0,0 +1,277 @@
+"""
+JSON-lines event log of a pipeline run, a /proc sampler for host load, and the
+end-of-run report built from both.
+
+Every line of the log is one event with an "event" type and a "run" id:
+
+    run      start / end of a run (mode, host)
+    phase    discovery, raw-frame indexing, log parsing, ...
+    tool     one external program (xds_par, pointless, aimless, ...)
+    stage    one stage (xds, ccp4, dimple) of one dataset
+    host     CPU, iowait and memory of the machine
+
+Timed events have "start" and "end" (Unix time) and "duration" (seconds).
+Events are written by any thread; the dataset and stage of the calling thread
+are added automatically (see context()).
+"""
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_active = None
+_context = threading.local()
+
+
+def context(**fields):
+    """
+    Fields added to every event of this thread (e.g. dataset, stage); no fields clears them.
+    """
+    _context.fields = fields
+
+
+def emit(event, **fields):
+    """
+    Write one event to the active log; does nothing when no log is open.
+    """
+    log = _active
+    if log is not None:
+        log.write(event, fields)
+
+
+def timed(event, start, end, **fields):
+    emit(event, start=round(start, 3), end=round(end, 3), duration=round(end - start, 3), **fields)
+
+
+@contextmanager
+def phase(name, **fields):
+    """
+    Log the duration of the with-block as a "phase" event.
+    """
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        timed("phase", start, time.time(), name=name, ok=ok, **fields)
+
+
+# ============================================================
+# LOG
+# ============================================================
+
+class RunLog:
+    """
+    Append-mode event log of one run. Timed events are also kept in memory for report().
+    """
+
+    def __init__(self, path, mode, run_id, sample_seconds=None):
+        self.path = path
+        self.run_id = run_id
+        self.start = time.time()
+        self.events = []
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a")
+        self.sampler = None
+
+        global _active
+        with _lock:
+            _active = self
+        emit("run", phase="start", mode=mode, host=socket.gethostname(), start=round(self.start, 3))
+        if sample_seconds:
+            self.sampler = HostSampler(sample_seconds)
+            self.sampler.start()
+
+    def write(self, event, fields):
+        record = {"event": event, "run": self.run_id}
+        record.update(getattr(_context, "fields", None) or {})
+        record.update(fields)
+        line = json.dumps(record, separators=(",", ":"))
+        with _lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            if "duration" in record:
+                self.events.append(record)
+
+    def close(self):
+        global _active
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.end = time.time()
+        emit("run", phase="end", end=round(self.end, 3), duration=round(self.end - self.start, 3))
+        with _lock:
+            if _active is self:
+                _active = None
+            self._file.close()
+            self._file = None
+
+
+# ============================================================
+# HOST SAMPLER
+# ============================================================
+
+def read_cpu_times():
+    """
+    (total, idle, iowait) jiffies from the first line of /proc/stat.
+    """
+    with open("/proc/stat") as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal [guest guest_nice, included in user/nice]
+    total = sum(values[:8])
+    return total, values[3], values[4]
+
+
+def read_memory_used():
+    """
+    Fraction of memory in use (MemTotal - MemAvailable) from /proc/meminfo.
+    """
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            info[key] = int(value.split()[0])
+    return 1.0 - info["MemAvailable"] / info["MemTotal"]
+
+
+class HostSampler(threading.Thread):
+    """
+    Log host CPU busy, iowait and memory use every interval seconds.
+    Does nothing where /proc is not available.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="host-sampler", daemon=True)
+        self.interval = interval
+        self.samples = []   # (time, cpu, iowait, memory) as fractions
+        self._halt = threading.Event()
+
+    def run(self):
+        try:
+            previous = read_cpu_times()
+        except (OSError, ValueError, IndexError):
+            return
+        while not self._halt.wait(self.interval):
+            try:
+                current = read_cpu_times()
+                memory = read_memory_used()
+            except (OSError, ValueError, KeyError, IndexError, ZeroDivisionError):
+                return
+            total = current[0] - previous[0]
+            if total <= 0:
+                continue
+            idle = current[1] - previous[1]
+            iowait = current[2] - previous[2]
+            previous = current
+            sample = (time.time(), 1.0 - (idle + iowait) / total, iowait / total, memory)
+            self.samples.append(sample)
+            emit("host", time=round(sample[0], 3), cpu=round(sample[1], 3),
+                 iowait=round(sample[2], 3), memory=round(sample[3], 3))
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+# ============================================================
+# REPORT
+# ============================================================
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def format_seconds(seconds):
+    if seconds >= 3600:
+        return f"{seconds / 3600:.2f} h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f} m"
+    return f"{seconds:.1f} s"
+
+
+def duration_table(title, groups):
+    lines = [f"  {title:<16}{'n':>6}{'p50':>10}{'p90':>10}{'max':>10}{'total':>10}"]
+    for name, durations in groups.items():
+        durations = sorted(durations)
+        lines.append(f"    {name:<14}{len(durations):>6}"
+                     f"{format_seconds(percentile(durations, 50)):>10}"
+                     f"{format_seconds(percentile(durations, 90)):>10}"
+                     f"{format_seconds(durations[-1]):>10}"
+                     f"{format_seconds(sum(durations)):>10}")
+    return lines
+
+
+def grouped(events, event, key):
+    groups = {}
+    for e in events:
+        if e["event"] == event:
+            groups.setdefault(e[key], []).append(e["duration"])
+    return groups
+
+
+def critical_path(events, run_start):
+    """
+    The dataset that finished last, and the stages and waits between the
+    start of the run and its end.
+    """
+    stages = {}
+    for e in events:
+        if e["event"] == "stage" and "dataset" in e:
+            stages.setdefault(e["dataset"], []).append(e)
+    if not stages:
+        return None
+    dataset, chain = max(stages.items(), key=lambda item: max(e["end"] for e in item[1]))
+    chain.sort(key=lambda e: e["start"])
+    parts = []
+    previous_end = run_start
+    for e in chain:
+        wait = e["start"] - previous_end
+        if wait >= 0.05:
+            parts.append(f"wait {format_seconds(wait)}")
+        parts.append(f"{e['stage']} {format_seconds(e['duration'])}")
+        previous_end = e["end"]
+    return dataset, parts
+
+
+def report(log: RunLog, datasets_done):
+    """
+    Lines of the end-of-run report: throughput, stage/tool/phase durations,
+    host load and the critical path.
+    """
+    wall = log.end - log.start
+    events = log.events
+    lines = [f"Run {log.run_id}: {format_seconds(wall)} wall, {datasets_done} dataset(s)"
+             + (f", {datasets_done / (wall / 3600):.1f} datasets/hour" if wall > 0 and datasets_done else "")]
+
+    stages = grouped(events, "stage", "stage")
+    if stages:
+        lines += duration_table("Stage", stages)
+    tools = grouped(events, "tool", "tool")
+    if tools:
+        lines += duration_table("Tool", tools)
+    phases = grouped(events, "phase", "name")
+    if phases:
+        lines += duration_table("Phase", phases)
+
+    samples = log.sampler.samples if log.sampler is not None else []
+    if samples:
+        cpu, iowait, memory = ([s[i] for s in samples] for i in (1, 2, 3))
+        lines.append(f"  Host: CPU {100 * sum(cpu) / len(cpu):.0f}% mean / {100 * max(cpu):.0f}% max, "
+                     f"iowait {100 * sum(iowait) / len(iowait):.0f}% mean / {100 * max(iowait):.0f}% max, "
+                     f"memory {100 * max(memory):.0f}% max")
+
+    path = critical_path(events, log.start)
+    if path is not None:
+        dataset, parts = path
+        lines.append(f"  Critical path ({dataset}, finished last): " + " -> ".join(parts))
+    lines.append(f"  Events: {log.path}")
+    return lines
@@ -0,0 +1,245 @@
+"""
+Local copy of raw image series, so XDS reads frames from a local disk instead of
+the raw-data share.
+
+A FrameCache holds one directory per staged series below cache_dir. Series are
+copied (or gunzipped) file by file on a thread pool in the background; acquire()
+waits for a series and pins it while XDS uses it. The cache is limited to
+max_bytes: when space is needed the least recently used unpinned series are
+removed. Completed series survive between runs and are reused if the source
+frames are unchanged.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+MARKER = ".staged.json"
+COPY_BLOCK = 4 << 20
+
+# gunzipped frames are larger than the .cbf.gz files; reserve this much per source byte.
+DECOMPRESSED_SIZE_FACTOR = 2.0
+
+
+class _Entry:
+    def __init__(self, key, path, source, reserved):
+        self.key = key
+        self.path = path
+        self.source = source
+        self.bytes = reserved
+        self.last_used = time.time()
+        self.pins = 0
+        self.pending = 0
+        self.staged_bytes = 0
+        self.complete = False
+        self.failed = None
+        self.done = threading.Event()
+
+
+class FrameCache:
+    def __init__(self, cache_dir, max_bytes, threads=8, decompress=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.decompress = decompress
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="frame-stage")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_existing()
+
+    # -------------------------------------------------------- bookkeeping
+
+    def _load_existing(self):
+        """
+        Register complete series left by earlier runs; remove partial ones.
+        """
+        for e in os.scandir(self.cache_dir):
+            if not e.is_dir(follow_symlinks=False):
+                continue
+            marker = os.path.join(e.path, MARKER)
+            try:
+                with open(marker) as f:
+                    info = json.load(f)
+                entry = _Entry(info["key"], e.path, info["source"], info["bytes"])
+                entry.last_used = os.stat(marker).st_mtime
+                entry.complete = True
+                entry.done.set()
+                self._entries[entry.key] = entry
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(e.path, ignore_errors=True)
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(entry.bytes for entry in self._entries.values())
+
+    def _evict_for(self, needed):
+        """
+        Drop least recently used, unpinned, finished series until needed bytes fit.
+        A failed series counts as finished only once none of its copies is still
+        writing. Called with the lock held. Returns False if they cannot fit.
+        """
+        if needed > self.max_bytes:
+            return False
+        used = sum(entry.bytes for entry in self._entries.values())
+        idle = sorted(
+            (entry for entry in self._entries.values()
+             if entry.pins == 0 and entry.pending == 0 and (entry.complete or entry.failed)),
+            key=lambda entry: entry.last_used,
+        )
+        for entry in idle:
+            if used + needed <= self.max_bytes:
+                break
+            self._remove(entry)
+            used -= entry.bytes
+        return used + needed <= self.max_bytes
+
+    def _remove(self, entry):
+        del self._entries[entry.key]
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+    # -------------------------------------------------------- staging
+
+    def _source_signature(self, src_dir, names):
+        """
+        (signature, total bytes) of the source frames. The signature holds size and
+        mtime of every frame, so a re-transferred frame anywhere in the series
+        makes the staged copy stale.
+        """
+        stats, total = [], 0
+        for name in names:
+            try:
+                st = os.stat(os.path.join(src_dir, name))
+                stats.append([name, st.st_size, st.st_mtime_ns])
+                total += st.st_size
+            except OSError:
+                stats.append([name, None, None])
+        return [os.path.abspath(src_dir), self.decompress, stats], total
+
+    def staged_name(self, name):
+        if self.decompress and name.endswith(".gz"):
+            return name[:-3]
+        return name
+
+    def _stage_file(self, entry, src, dst):
+        tmp = f"{dst}.part"
+        try:
+            if self.decompress and src.endswith(".gz"):
+                with gzip.open(src, "rb") as fin, open(tmp, "wb") as fout:
+                    shutil.copyfileobj(fin, fout, COPY_BLOCK)
+            else:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except FileNotFoundError:
+            # A gap in the series: XDS reports it as it would for the raw data.
+            return 0
+        except Exception as e:
+            entry.failed = f"{os.path.basename(src)}: {e}"
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return 0
+        return os.path.getsize(dst)
+
+    def _file_done(self, entry, future):
+        with self._lock:
+            if future.cancelled():
+                entry.failed = "staging cancelled"
+            else:
+                entry.staged_bytes += future.result()
+            entry.pending -= 1
+            if entry.pending:
+                return
+        if not entry.failed:
+            try:
+                with open(os.path.join(entry.path, MARKER), "w") as f:
+                    json.dump({"key": entry.key, "source": entry.source, "bytes": entry.staged_bytes}, f)
+            except OSError as e:
+                entry.failed = str(e)
+        with self._lock:
+            if not entry.failed:
+                entry.bytes = entry.staged_bytes
+                entry.complete = True
+        entry.done.set()
+
+    def prefetch(self, key, src_dir, names):
+        """
+        Start staging names from src_dir in the background unless already staged.
+        Returns False if the series does not fit in the cache.
+        """
+        if not names:
+            return False
+        source, src_bytes = self._source_signature(src_dir, names)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.source == source and not entry.failed:
+                return True
+
+        reserved = int(src_bytes * (DECOMPRESSED_SIZE_FACTOR if self.decompress else 1))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.source == source and not entry.failed:
+                    return True
+                if entry.pins or entry.pending or not (entry.complete or entry.failed):
+                    return False
+                self._remove(entry)
+            if not self._evict_for(reserved):
+                return False
+
+            digest = hashlib.blake2b(os.path.abspath(src_dir).encode(), digest_size=4).hexdigest()
+            path = os.path.join(self.cache_dir, f"{key}-{digest}")
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            entry = _Entry(key, path, source, reserved)
+            entry.pending = len(names)
+            self._entries[key] = entry
+
+        for name in names:
+            future = self._pool.submit(self._stage_file, entry, os.path.join(src_dir, name),
+                                       os.path.join(path, self.staged_name(name)))
+            future.add_done_callback(partial(self._file_done, entry))
+        return True
+
+    def acquire(self, key, src_dir, names):
+        """
+        Stage (or wait for) a series and pin it. Returns the local directory,
+        or None if it could not be staged; then read the frames from src_dir.
+        """
+        if not self.prefetch(key, src_dir, names):
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.pins += 1
+        entry.done.wait()
+        if entry.failed:
+            self.release(key)
+            return None
+        entry.last_used = time.time()
+        try:
+            os.utime(os.path.join(entry.path, MARKER))
+        except OSError:
+            pass
+        return entry.path
+
+    def failure(self, key):
+        entry = self._entries.get(key)
+        return entry.failed if entry is not None else None
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.pins > 0:
+                entry.pins -= 1
+                entry.last_used = time.time()
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,180 @@
+"""
+FreeR flags that are the same for every dataset of a screen.
+
+freerflag draws an independent random free set for each dataset. Here the flag
+of a reflection depends only on its (h,k,l): it is looked up in a reference table
+kept per space group and cell, and reflections not in the table yet get a flag
+from a fixed hash of (h,k,l) and are added to it. Flags follow the freerflag
+convention (0 .. nsets-1, 0 = free set), so DIMPLE/refmac use them unchanged.
+
+The table can be seeded from an existing MTZ (e.g. the one the reference model
+was refined against), so new datasets keep that model's free set. Indices must
+be in the standard CCP4 asymmetric unit, as written by aimless/ctruncate.
+"""
+import glob
+import os
+import threading
+
+import numpy as np
+
+import mtz_file
+
+FREER_LABEL = "FreeR_flag"
+
+# (h,k,l) packed into one int64, 21 bits per index.
+HKL_BITS = 21
+HKL_OFFSET = 1 << (HKL_BITS - 1)
+
+# Cells of the same crystal form differ by a little between datasets.
+CELL_TOLERANCE = 0.02   # relative, for lengths and angles
+
+HASH_SALT = 0x5EED_F4EE_0000_0001
+
+_reference_lock = threading.Lock()
+
+
+def hkl_keys(h, k, l):
+    h, k, l = (np.asarray(x).astype(np.int64) + HKL_OFFSET for x in (h, k, l))
+    return (h << (2 * HKL_BITS)) | (k << HKL_BITS) | l
+
+
+def hashed_flags(keys, nsets):
+    """
+    Flag in 0 .. nsets-1 for every key; depends only on the key (splitmix64 finaliser).
+    """
+    x = keys.astype(np.uint64) ^ np.uint64(HASH_SALT)
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(nsets)).astype(np.int32)
+
+
+def nsets_for_fraction(fraction):
+    if not 0 < fraction < 1:
+        raise ValueError(f"FreeR fraction must be between 0 and 1, got {fraction}")
+    return max(2, round(1 / fraction))
+
+
+def same_cell(a, b, tolerance=CELL_TOLERANCE):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return bool(np.all(np.abs(a - b) <= tolerance * np.abs(b)))
+
+
+def reference_name(space_group_number, cell):
+    return f"sg{space_group_number}_" + "_".join(f"{v:.1f}" for v in cell) + ".npz"
+
+
+def load_reference(path):
+    with np.load(path) as ref:
+        return {name: ref[name] for name in ref.files}
+
+
+def save_reference(path, ref):
+    tmp = f"{path}.tmp{os.getpid()}.npz"
+    np.savez(tmp, **ref)
+    os.replace(tmp, path)
+
+
+def find_reference(ref_dir, space_group_number, cell):
+    """
+    Path of the reference table for this space group and cell, or None.
+    """
+    for path in sorted(glob.glob(os.path.join(ref_dir, f"sg{space_group_number}_*.npz"))):
+        try:
+            ref = load_reference(path)
+        except (OSError, ValueError, KeyError):
+            continue
+        if int(ref["space_group"]) == space_group_number and same_cell(cell, ref["cell"]):
+            return path
+    return None
+
+
+def read_mtz_flags(mtz_path):
+    """
+    (space_group_number, cell, keys, flags) of an MTZ that already has FreeR flags.
+    """
+    with mtz_file.MtzFile(mtz_path) as mtz:
+        label = mtz.freer_column()
+        if label is None:
+            raise mtz_file.MtzError(f"{mtz_path}: no FreeR flag column")
+        flags = np.array(mtz.column(label))
+        keep = ~np.isnan(flags)
+        keys = hkl_keys(*(mtz.column(c)[keep] for c in ("H", "K", "L")))
+        return mtz.space_group_number, mtz.cell, keys, flags[keep].astype(np.int32)
+
+
+def new_reference(space_group_number, cell, nsets, seed_mtz=None):
+    ref = {
+        "space_group": np.int32(space_group_number),
+        "cell": np.asarray(cell, dtype=np.float64),
+        "nsets": np.int32(nsets),
+        "keys": np.empty(0, dtype=np.int64),
+        "flags": np.empty(0, dtype=np.int32),
+    }
+    if seed_mtz:
+        seed_sg, seed_cell, keys, flags = read_mtz_flags(seed_mtz)
+        if seed_sg == space_group_number and same_cell(cell, seed_cell):
+            keys, first = np.unique(keys, return_index=True)
+            ref["keys"], ref["flags"] = keys, flags[first]
+    return ref
+
+
+def assign_flags(ref, keys):
+    """
+    Flags for keys from the reference table, hashing the ones it does not have.
+    Returns (flags, mask of keys that were not in the table).
+    """
+    table_keys, table_flags = ref["keys"], ref["flags"]
+    if len(table_keys):
+        pos = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+        known = table_keys[pos] == keys
+    else:
+        pos = np.zeros(len(keys), dtype=np.intp)
+        known = np.zeros(len(keys), dtype=bool)
+    flags = np.empty(len(keys), dtype=np.int32)
+    flags[known] = table_flags[pos[known]]
+    flags[~known] = hashed_flags(keys[~known], int(ref["nsets"]))
+    return flags, ~known
+
+
+def extend_reference(ref, keys, flags):
+    all_keys = np.concatenate([ref["keys"], keys])
+    all_flags = np.concatenate([ref["flags"], flags])
+    order = np.argsort(all_keys, kind="stable")
+    ref["keys"], ref["flags"] = all_keys[order], all_flags[order]
+
+
+def flag_mtz(src, dst, ref_dir, fraction=0.05, seed_mtz=None):
+    """
+    Write dst = src plus a FreeR_flag column consistent with every other dataset
+    flagged against ref_dir. Returns a dict with counts for the log line.
+    """
+    with mtz_file.MtzFile(src) as mtz:
+        if mtz.space_group_number is None or mtz.cell is None:
+            raise mtz_file.MtzError(f"{src}: no space group or cell in header")
+        sg, cell = mtz.space_group_number, mtz.cell
+        keys = hkl_keys(*(mtz.column(c) for c in ("H", "K", "L")))
+
+    nsets = nsets_for_fraction(fraction)
+    os.makedirs(ref_dir, exist_ok=True)
+    with _reference_lock:
+        ref_path = find_reference(ref_dir, sg, cell)
+        if ref_path is None:
+            ref_path = os.path.join(ref_dir, reference_name(sg, cell))
+            ref = new_reference(sg, cell, nsets, seed_mtz)
+        else:
+            ref = load_reference(ref_path)
+        flags, new = assign_flags(ref, keys)
+        if new.any() or not os.path.exists(ref_path):
+            new_keys, first = np.unique(keys[new], return_index=True)
+            extend_reference(ref, new_keys, flags[new][first])
+            save_reference(ref_path, ref)
+
+    mtz_file.write_with_column(src, dst, FREER_LABEL, "I", flags.astype(np.float32))
+    return {
+        "nref": len(flags),
+        "free": int(np.count_nonzero(flags == 0)),
+        "added": int(np.count_nonzero(new)),
+        "reference": os.path.basename(ref_path),
+    }
@@ -0,0 +1,134 @@
+"""
+Shared parsing of the XDS / CCP4 / DIMPLE log files written by the pipeline scripts.
+
+Most values we want are printed near the end of a log and the last occurrence wins,
+so logs are read backwards in blocks and reading stops as soon as every requested
+field has been found. search_head() is the forward equivalent for values near the top.
+"""
+import os
+import re
+
+BLOCK_SIZE = 64 * 1024
+
+# aimless.log
+AIMLESS_SPACE_GROUP = re.compile(r"Space\s+group\s*[:=]\s*(.+)")
+AIMLESS_HIGH_RES = re.compile(r"High\s+resolution\s+limit\s+([0-9]+(?:\.[0-9]+)?)")
+AIMLESS_RES_RANGE = re.compile(
+    r"Resolution\s+range\s+[0-9]+(?:\.[0-9]+)?\s+to\s+([0-9]+(?:\.[0-9]+)?)"
+)
+
+# dimple.log
+DIMPLE_BLOBS = re.compile(r"blobs?:\s*(\d+)", re.IGNORECASE)
+DIMPLE_NO_BLOBS = re.compile(r"no blobs", re.IGNORECASE)
+
+# IDXREF.LP
+IDXREF_INSUFFICIENT = re.compile(r"INSUFFICIENT PERCENTAGE")
+IDXREF_INDEXED = re.compile(r"INDEXED REFLECTIONS")
+
+
+def iter_lines_reversed(path, block_size=BLOCK_SIZE):
+    """
+    Yield the lines of a file from last to first, reading block_size bytes at a time.
+    """
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        partial = b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + partial).split(b"\n")
+            # The first piece may continue in the previous block.
+            partial = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode(errors="replace")
+        yield partial.decode(errors="replace")
+
+
+def _search(lines, patterns):
+    found = dict.fromkeys(patterns)
+    missing = set(patterns)
+    for line in lines:
+        for name in list(missing):
+            m = patterns[name].search(line)
+            if m:
+                found[name] = m
+                missing.discard(name)
+        if not missing:
+            break
+    return found
+
+
+def search_tail(path, patterns):
+    """
+    Last match of every pattern in {name: compiled_regex}, as {name: Match or None}.
+    Patterns are matched line by line. Raises OSError if the file cannot be read.
+    """
+    return _search(iter_lines_reversed(path), patterns)
+
+
+def search_head(path, patterns):
+    """
+    First match of every pattern in {name: compiled_regex}, as {name: Match or None}.
+    """
+    with open(path, "r", errors="replace") as f:
+        return _search(f, patterns)
+
+
+def parse_aimless_summary(log_path):
+    """
+    Return (space_group, high_resolution_A) from aimless.log.
+    Missing values are 'UNKNOWN'.
+    """
+    space_group = "UNKNOWN"
+    high_res = "UNKNOWN"
+
+    try:
+        found = search_tail(log_path, {
+            "space_group": AIMLESS_SPACE_GROUP,
+            "high_res": AIMLESS_HIGH_RES,
+        })
+    except OSError:
+        return space_group, high_res
+
+    if found["space_group"]:
+        space_group = re.sub(r"\(.*?\)", "", found["space_group"].group(1).strip()).strip()
+
+    if found["high_res"]:
+        high_res = found["high_res"].group(1)
+    else:
+        res_range = search_tail(log_path, {"res_range": AIMLESS_RES_RANGE})["res_range"]
+        if res_range:
+            high_res = res_range.group(1)
+
+    return space_group, high_res
+
+
+def parse_dimple_blobs(log_path):
+    """
+    Number of blobs reported in dimple.log, 0 for 'no blobs', -1 if unknown.
+    """
+    try:
+        found = search_tail(log_path, {"blobs": DIMPLE_BLOBS, "no_blobs": DIMPLE_NO_BLOBS})
+    except OSError:
+        return -1
+
+    if found["blobs"]:
+        return int(found["blobs"].group(1))
+    if found["no_blobs"]:
+        return 0
+    return -1
+
+
+def idxref_low_indexing(lp_path):
+    """
+    True if IDXREF.LP stopped because too few reflections could be indexed.
+    """
+    try:
+        found = search_tail(lp_path, {
+            "insufficient": IDXREF_INSUFFICIENT,
+            "indexed": IDXREF_INDEXED,
+        })
+    except OSError:
+        return False
+    return found["insufficient"] is not None and found["indexed"] is not None
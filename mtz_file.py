@@ -0,0 +1,333 @@
+"""
+Minimal MTZ reader for quick checks of the files written by the pipeline.
+
+The file is memory-mapped and the reflection table is exposed as a NumPy array
+that points straight into the map, so a header check or one column costs
+almost no I/O. Only merged/unmerged MTZ files with IEEE floats are supported.
+write_with_column() writes a copy of a file with one extra column.
+"""
+import mmap
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+MTZ_DATA_OFFSET = 80
+MTZ_RECORD_LEN = 80
+
+FREER_LABELS = ("FreeR_flag", "FREE", "FreeRflag", "R-free-flags")
+
+
+class MtzError(ValueError):
+    pass
+
+
+@dataclass
+class MtzColumn:
+    label: str
+    type: str
+    min: float
+    max: float
+    dataset_id: int
+    index: int
+
+
+class MtzFile:
+    """
+    Open an MTZ file read-only. Use as a context manager, or call close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.title = ""
+        self.cell = None
+        self.space_group_name = None
+        self.space_group_number = None
+        self.ncol = 0
+        self.nref = 0
+        self.nbatch = 0
+        self.columns = []
+        self.resolution = (None, None)   # (d_max, d_min) in Angstrom
+        self.datasets = {}
+        self.history = []
+        self.header_offset = None
+        self._mm = None
+        self._data = None
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MTZ_DATA_OFFSET:
+                raise MtzError(f"{path}: too short for an MTZ file ({size} bytes)")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._read_header(size)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._data = None
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Column views are still referenced; the map closes when they go.
+                pass
+            self._mm = None
+
+    def _read_header(self, size):
+        mm = self._mm
+        if mm[:4] != b"MTZ ":
+            raise MtzError(f"{self.path}: not an MTZ file")
+
+        # Machine stamp: high nibble of byte 9 is the integer format, 1 = big endian.
+        self.endian = ">" if (mm[9] & 0xF0) == 0x10 else "<"
+        header_word = int(np.frombuffer(mm, dtype=f"{self.endian}i4", count=1, offset=4)[0])
+        if header_word == -1:
+            header_word = int(np.frombuffer(mm, dtype=f"{self.endian}i8", count=1, offset=12)[0])
+        header_offset = (header_word - 1) * 4
+        if not MTZ_DATA_OFFSET <= header_offset < size:
+            raise MtzError(f"{self.path}: header offset {header_offset} outside the file")
+        self.header_offset = header_offset
+
+        in_history = False
+        pos = header_offset
+        while pos + MTZ_RECORD_LEN <= size:
+            record = mm[pos:pos + MTZ_RECORD_LEN].decode("ascii", errors="replace")
+            pos += MTZ_RECORD_LEN
+            key = record[:4].upper()
+            if in_history:
+                if key in ("MTZB", "MTZE"):
+                    break
+                self.history.append(record.rstrip())
+                continue
+            if key == "MTZH":
+                in_history = True
+                continue
+            if key in ("MTZB", "MTZE"):
+                break
+            self._read_record(key, record)
+
+        if self.ncol != len(self.columns):
+            raise MtzError(f"{self.path}: NCOL says {self.ncol} columns, found {len(self.columns)}")
+        if MTZ_DATA_OFFSET + self.nref * self.ncol * 4 > header_offset:
+            raise MtzError(f"{self.path}: reflection data overlaps the header (truncated file?)")
+
+    def _read_record(self, key, record):
+        fields = record.split()
+        try:
+            if key == "TITL":
+                self.title = record[6:].strip()
+            elif key == "NCOL":
+                self.ncol, self.nref = int(fields[1]), int(fields[2])
+                self.nbatch = int(fields[3]) if len(fields) > 3 else 0
+            elif key == "CELL":
+                self.cell = tuple(float(v) for v in fields[1:7])
+            elif key == "SYMI":
+                # SYMINF nsym nsymp lattice sgnum 'name' pointgroup
+                self.space_group_number = int(fields[4])
+                quoted = record.split("'")
+                if len(quoted) >= 3:
+                    self.space_group_name = quoted[1].strip()
+            elif key == "RESO":
+                # Stored as 1/d^2 (min, max).
+                smin, smax = float(fields[1]), float(fields[2])
+                self.resolution = (
+                    smin ** -0.5 if smin > 0 else float("inf"),
+                    smax ** -0.5 if smax > 0 else None,
+                )
+            elif key == "COLU":
+                self.columns.append(MtzColumn(
+                    label=fields[1],
+                    type=fields[2],
+                    min=float(fields[3]),
+                    max=float(fields[4]),
+                    dataset_id=int(fields[5]) if len(fields) > 5 else 0,
+                    index=len(self.columns),
+                ))
+            elif key == "DATA":
+                self.datasets[int(fields[1])] = " ".join(fields[2:])
+        except (IndexError, ValueError) as e:
+            raise MtzError(f"{self.path}: bad header record {record.strip()!r}: {e}") from None
+
+    @property
+    def data(self):
+        """
+        Reflection table as an (nref, ncol) float32 array backed by the file map.
+        """
+        if self._data is None:
+            self._data = np.frombuffer(
+                self._mm,
+                dtype=f"{self.endian}f4",
+                count=self.nref * self.ncol,
+                offset=MTZ_DATA_OFFSET,
+            ).reshape(self.nref, self.ncol)
+        return self._data
+
+    @property
+    def labels(self):
+        return [c.label for c in self.columns]
+
+    def find_column(self, label):
+        for c in self.columns:
+            if c.label == label:
+                return c
+        return None
+
+    def column(self, label):
+        """
+        One column as a strided view into the file map (no copy).
+        """
+        c = self.find_column(label)
+        if c is None:
+            raise KeyError(f"{self.path}: no column '{label}'")
+        return self.data[:, c.index]
+
+    def freer_column(self):
+        for label in FREER_LABELS:
+            if self.find_column(label) is not None:
+                return label
+        for c in self.columns:
+            if c.type == "I" and "free" in c.label.lower():
+                return c.label
+        return None
+
+    def free_fraction(self, label=None):
+        """
+        Fraction of reflections in the free set (flag 0, as written by freerflag).
+        """
+        label = label or self.freer_column()
+        if label is None or self.nref == 0:
+            return None
+        flags = self.column(label)
+        present = ~np.isnan(flags)
+        n = int(np.count_nonzero(present))
+        if n == 0:
+            return None
+        return float(np.count_nonzero(flags[present] == 0)) / n
+
+    def summary(self):
+        return {
+            "path": self.path,
+            "nref": self.nref,
+            "columns": self.labels,
+            "cell": self.cell,
+            "space_group": self.space_group_name,
+            "d_max": self.resolution[0],
+            "d_min": self.resolution[1],
+            "free_fraction": self.free_fraction(),
+        }
+
+
+def validate_mtz(path, require_freer=False, require_amplitudes=False):
+    """
+    Check that an MTZ file can be read and holds reflections.
+    Returns (summary dict or None, list of problems); no problems means valid.
+    """
+    try:
+        with MtzFile(path) as mtz:
+            problems = []
+            if mtz.nref == 0:
+                problems.append("no reflections")
+            missing = [label for label in ("H", "K", "L") if mtz.find_column(label) is None]
+            if missing:
+                problems.append(f"missing columns {', '.join(missing)}")
+            if require_amplitudes and not any(c.type in ("F", "J") for c in mtz.columns):
+                problems.append("no amplitude or intensity column")
+            if require_freer and mtz.freer_column() is None:
+                problems.append("no FreeR flag column")
+            summary = mtz.summary()
+            if require_freer and mtz.freer_column() is not None and not summary["free_fraction"]:
+                problems.append("empty free set")
+            return summary, problems
+    except (OSError, MtzError) as e:
+        return None, [str(e)]
+
+
+MTZ_MAIN_HEADER_END = ("MTZH", "MTZB", "MTZE")
+MTZ_COLUMN_RECORDS = ("COLU", "COLS", "COLG")
+
+
+def _header_record(text):
+    return text[:MTZ_RECORD_LEN].ljust(MTZ_RECORD_LEN).encode("ascii")
+
+
+def write_with_column(src, dst, label, col_type, values, dataset_id=None):
+    """
+    Write dst as a copy of src with one extra column appended.
+
+    values must have one entry per reflection of src. The column goes into
+    dataset_id (default: the dataset of the last column of src). Everything
+    else (symmetry, datasets, history, batch headers) is copied unchanged.
+    dst is written to a temporary file first and renamed into place.
+    """
+    with MtzFile(src) as mtz:
+        if mtz.find_column(label) is not None:
+            raise MtzError(f"{src}: column '{label}' already present")
+        values = np.asarray(values, dtype=np.float32)
+        if values.shape != (mtz.nref,):
+            raise MtzError(f"{src}: {values.shape[0] if values.ndim else 0} values for {mtz.nref} reflections")
+        if dataset_id is None:
+            dataset_id = mtz.columns[-1].dataset_id if mtz.columns else 0
+
+        ncol = mtz.ncol + 1
+        table = np.empty((mtz.nref, ncol), dtype=f"{mtz.endian}f4")
+        table[:, :-1] = mtz.data
+        table[:, -1] = values
+
+        present = values[~np.isnan(values)]
+        vmin, vmax = (float(present.min()), float(present.max())) if present.size else (0.0, 0.0)
+        new_column = _header_record(f"COLUMN {label:<30} {col_type} {vmin:17.9g} {vmax:17.9g} {dataset_id:4d}")
+
+        # Main header records are edited; history and batch headers are copied verbatim.
+        mm = mtz._mm
+        records = []
+        pos = mtz.header_offset
+        last_column_record = None
+        while pos + MTZ_RECORD_LEN <= len(mm):
+            record = mm[pos:pos + MTZ_RECORD_LEN]
+            key = record[:4].decode("ascii", errors="replace").upper()
+            if key in MTZ_MAIN_HEADER_END:
+                break
+            if key == "NCOL":
+                record = _header_record(f"NCOL {ncol:8d} {mtz.nref:12d} {mtz.nbatch:8d}")
+            elif key in MTZ_COLUMN_RECORDS:
+                last_column_record = len(records)
+            records.append(record)
+            pos += MTZ_RECORD_LEN
+        if last_column_record is None:
+            raise MtzError(f"{src}: no COLUMN records")
+        records.insert(last_column_record + 1, new_column)
+        trailer = mm[pos:]
+        prefix = bytearray(mm[:MTZ_DATA_OFFSET])
+
+    header_offset = MTZ_DATA_OFFSET + table.nbytes
+    header_word = header_offset // 4 + 1
+    int_fmt = f"{mtz.endian}i4"
+    if header_word < 2 ** 31:
+        prefix[4:8] = np.array([header_word], dtype=int_fmt).tobytes()
+    else:
+        prefix[4:8] = np.array([-1], dtype=int_fmt).tobytes()
+        prefix[12:20] = np.array([header_word], dtype=f"{mtz.endian}i8").tobytes()
+
+    tmp = f"{dst}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(prefix)
+            f.write(table.tobytes())
+            f.writelines(records)
+            f.write(trailer)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
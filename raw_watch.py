@@ -0,0 +1,263 @@
+"""
+Watch the raw-data tree for new image series during a beamtime.
+
+A watcher reports the directories below top whose contents changed:
+InotifyWatcher uses Linux inotify (through libc, no extra package), PollWatcher
+compares directory modification times every interval and also works on NFS,
+where inotify does not see files written by other hosts. open_watcher() picks
+one.
+
+SeriesTracker decides when a series is complete: its expected last frame has
+appeared and no frame was added for settle_seconds, or no frame was added for
+quiet_seconds (frame count unknown, or collection stopped early).
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# Filesystems on which inotify misses changes made by other hosts.
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "beegfs",
+                       "glusterfs", "fuse.glusterfs", "fuse.sshfs", "ceph", "fuse.ceph"}
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def filesystem_type(path):
+    """
+    Type of the filesystem path is on, from /proc/mounts (None if unknown).
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def walk_dirs(top, prune=()):
+    """
+    Relative paths of top and every directory below it.
+    """
+    found = []
+    stack = ["."]
+    while stack:
+        rel = stack.pop()
+        found.append(rel)
+        try:
+            with os.scandir(os.path.join(top, rel)) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False) and e.name not in prune:
+                        stack.append(os.path.normpath(os.path.join(rel, e.name)))
+        except OSError:
+            continue
+    return found
+
+
+class InotifyWatcher:
+    """
+    inotify watches on top and all directories below it; new directories are
+    watched as they appear.
+    """
+
+    name = "inotify"
+
+    def __init__(self, top, prune=()):
+        self.top = top
+        self.prune = set(prune)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}   # watch descriptor -> relative dir
+        for rel in walk_dirs(top, self.prune):
+            self._add(rel)
+
+    def _add(self, rel):
+        path = os.path.join(self.top, rel).encode()
+        wd = self._libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify watch limit reached (fs.inotify.max_user_watches)")
+            return   # directory vanished or is not readable
+        self.dirs[wd] = rel
+
+    def wait(self, timeout):
+        """
+        Relative dirs that changed, waiting up to timeout seconds for the first change.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+                offset += EVENT_HEADER.size + length
+                name = os.fsdecode(name.rstrip(b"\0"))
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: report every directory.
+                    changed.update(self.dirs.values())
+                    continue
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                rel = self.dirs.get(wd)
+                if rel is None:
+                    continue
+                changed.add(rel)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name not in self.prune:
+                    # Frames may already be in the new directory before it is watched.
+                    for sub in walk_dirs(os.path.join(self.top, rel, name), self.prune):
+                        sub_rel = os.path.normpath(os.path.join(rel, name, sub))
+                        self._add(sub_rel)
+                        changed.add(sub_rel)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher:
+    """
+    Lists directories whose modification time changed, at most every interval seconds.
+    """
+
+    name = "poll"
+
+    def __init__(self, top, interval, prune=()):
+        self.top = top
+        self.interval = interval
+        self.prune = set(prune)
+        self.mtimes = self._scan()
+        self._last_scan = time.monotonic()
+
+    def _scan(self):
+        mtimes = {}
+        for rel in walk_dirs(self.top, self.prune):
+            try:
+                mtimes[rel] = os.stat(os.path.join(self.top, rel)).st_mtime_ns
+            except OSError:
+                continue
+        return mtimes
+
+    def wait(self, timeout):
+        time.sleep(max(0.0, min(timeout, self._last_scan + self.interval - time.monotonic())))
+        if time.monotonic() - self._last_scan < self.interval:
+            return set()
+        mtimes = self._scan()
+        self._last_scan = time.monotonic()
+        changed = {rel for rel, mtime in mtimes.items() if self.mtimes.get(rel) != mtime}
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(top, method, poll_seconds, prune=()):
+    """
+    method: "inotify", "poll", or "auto" (inotify unless top is on a network
+    filesystem or inotify is not available).
+    """
+    if method not in ("auto", "inotify", "poll"):
+        raise ValueError(f"Unknown WATCH_METHOD='{method}'. Use 'auto', 'inotify' or 'poll'.")
+    if method == "auto":
+        fstype = filesystem_type(top)
+        if fstype in NETWORK_FILESYSTEMS:
+            print(f"{top} is on {fstype}: polling every {poll_seconds} s")
+            method = "poll"
+    if method != "poll":
+        try:
+            return InotifyWatcher(top, prune)
+        except (OSError, AttributeError) as e:
+            if method == "inotify":
+                raise
+            print(f"inotify not available ({e}): polling every {poll_seconds} s")
+    return PollWatcher(top, poll_seconds, prune)
+
+
+class _Series:
+    def __init__(self, data, changed):
+        self.data = data
+        self.changed = changed
+        self.handed_out = None
+
+
+class SeriesTracker:
+    """
+    Image series seen so far, keyed by (dir_rel, prefix, width); data are the
+    series dicts of summarize_frame_series().
+    """
+
+    def __init__(self, settle_seconds, quiet_seconds):
+        self.settle_seconds = settle_seconds
+        self.quiet_seconds = quiet_seconds
+        self.series = {}
+
+    def update(self, dir_rel, series_list, changed=None, handed_out=False):
+        """
+        Record the current series of a directory. changed is when they last grew
+        (default: now if they grew). handed_out marks them as already processed.
+        """
+        now = time.time()
+        for data in series_list:
+            key = (dir_rel, data["prefix"], data["width"])
+            entry = self.series.get(key)
+            if entry is None:
+                entry = self.series[key] = _Series(data, now if changed is None else changed)
+            elif (data["count"], data["last"]) != (entry.data["count"], entry.data["last"]):
+                entry.data = data
+                entry.changed = now if changed is None else changed
+            if handed_out:
+                entry.handed_out = (data["count"], data["last"])
+
+    def ready(self, expected_last):
+        """
+        (dir_rel, data) of the series that are complete and were not handed out at
+        this size yet; they are marked as handed out. expected_last(dir_rel, data)
+        returns the number of the last frame of the series, or None if unknown.
+        """
+        now = time.time()
+        found = []
+        for (dir_rel, _prefix, _width), entry in self.series.items():
+            size = (entry.data["count"], entry.data["last"])
+            if entry.handed_out == size:
+                continue
+            quiet = now - entry.changed
+            if quiet < self.settle_seconds:
+                continue
+            if quiet < self.quiet_seconds:
+                expected = expected_last(dir_rel, entry.data)
+                if expected is None or entry.data["last"] < expected:
+                    continue
+            entry.handed_out = size
+            found.append((dir_rel, entry.data))
+        return found
@@ -0,0 +1,330 @@
+"""
+SQLite store for the results of all pipeline runs under one ROOT_DIR.
+
+One row per (run, dataset) holds stage status, aimless statistics and the
+DIMPLE result; per-stage timings and the paths of the output files are kept
+alongside. The database is in WAL mode and every batch of results is written in
+one transaction, so several pipeline runs (or other readers) can use it at the
+same time. summary.txt is generated from the `summary` view: the latest result
+of every dataset, so a partial rerun no longer drops the other datasets.
+
+Downstream scripts use latest_results() and artifacts() instead of walking the
+processed-data tree.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id      TEXT PRIMARY KEY,
+    mode        TEXT,
+    host        TEXT,
+    root_dir    TEXT,
+    started     REAL,
+    finished    REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id          TEXT NOT NULL,
+    dataset_rel     TEXT NOT NULL,
+    dataset_id      TEXT NOT NULL,
+    processing_dir  TEXT,
+    finished        REAL,
+    xds_ok          INTEGER,
+    ccp4_ok         INTEGER,
+    dimple_ok       INTEGER,
+    skipped         TEXT,
+    rejected        TEXT,
+    space_group     TEXT,
+    resolution      TEXT,
+    blobs           INTEGER,
+    completeness_pct REAL,
+    multiplicity    REAL,
+    cc_half_outer   REAL,
+    isigi_outer     REAL,
+    rmeas           REAL,
+    cell            TEXT,
+    stats_json      TEXT,
+    in_summary      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, dataset_rel)
+);
+CREATE INDEX IF NOT EXISTS results_by_dataset ON results (dataset_rel, finished);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id      TEXT NOT NULL,
+    dataset_rel TEXT NOT NULL,
+    stage       TEXT NOT NULL,
+    ok          INTEGER,
+    skipped     INTEGER,
+    wall        REAL,
+    user_cpu    REAL,
+    sys_cpu     REAL,
+    max_rss_kb  INTEGER,
+    read_bytes  INTEGER,
+    write_bytes INTEGER,
+    commands    INTEGER,
+    PRIMARY KEY (run_id, dataset_rel, stage)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id      TEXT NOT NULL,
+    dataset_rel TEXT NOT NULL,
+    kind        TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    PRIMARY KEY (run_id, dataset_rel, kind)
+);
+CREATE VIEW IF NOT EXISTS latest AS
+    SELECT r.* FROM results r
+    WHERE r.rowid = (SELECT r2.rowid FROM results r2 WHERE r2.dataset_rel = r.dataset_rel
+                     ORDER BY r2.finished DESC LIMIT 1);
+CREATE VIEW IF NOT EXISTS summary AS
+    SELECT * FROM latest WHERE in_summary = 1;
+"""
+
+RESULT_COLUMNS = (
+    "run_id", "dataset_rel", "dataset_id", "processing_dir", "finished",
+    "xds_ok", "ccp4_ok", "dimple_ok", "skipped", "rejected",
+    "space_group", "resolution", "blobs",
+    "completeness_pct", "multiplicity", "cc_half_outer", "isigi_outer", "rmeas", "cell",
+    "stats_json", "in_summary",
+)
+STAGE_COLUMNS = (
+    "run_id", "dataset_rel", "stage", "ok", "skipped", "wall", "user_cpu", "sys_cpu",
+    "max_rss_kb", "read_bytes", "write_bytes", "commands",
+)
+
+SUMMARY_HEADER = ("dataset\tspace_group\tresolution_A\tdimple_ok\tblobs\t"
+                  "completeness_pct\tmultiplicity\tcc_half_outer\tisigi_outer\trmeas\tcell")
+
+# Results are written in one transaction per this many datasets, or this often.
+BATCH_SIZE = 25
+BATCH_SECONDS = 30.0
+
+BUSY_TIMEOUT_SECONDS = 60
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def connect_readonly(path):
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True,
+                           timeout=BUSY_TIMEOUT_SECONDS)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def as_flag(value):
+    return None if value is None else int(bool(value))
+
+
+class ResultsDB:
+    """
+    Writer for one pipeline run. add() buffers a dataset result; the buffer is
+    written in one transaction every BATCH_SIZE results or BATCH_SECONDS.
+    """
+
+    def __init__(self, path, run_id, mode, root_dir, host=None):
+        self.path = path
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.conn.execute(statement)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs (run_id, mode, host, root_dir, started) VALUES (?, ?, ?, ?, ?)",
+                (run_id, mode, host, root_dir, time.time()),
+            )
+
+    def transaction(self):
+        return _Transaction(self.conn)
+
+    def add(self, record):
+        """
+        Queue one dataset result. record has the RESULT_COLUMNS (without run_id
+        and finished) plus "stages" {stage: dict of STAGE_COLUMNS} and
+        "artifacts" {kind: path}. Returns True if the batch was written.
+        """
+        with self._lock:
+            self._pending.append(dict(record, run_id=self.run_id, finished=time.time()))
+            due = (len(self._pending) >= BATCH_SIZE
+                   or time.monotonic() - self._last_flush >= BATCH_SECONDS)
+        if due:
+            self.flush()
+        return due
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        results, stages, artifacts = [], [], []
+        for record in pending:
+            results.append(tuple(record.get(c) for c in RESULT_COLUMNS))
+            for stage, values in record.get("stages", {}).items():
+                row = dict(values, run_id=self.run_id, dataset_rel=record["dataset_rel"], stage=stage)
+                stages.append(tuple(row.get(c) for c in STAGE_COLUMNS))
+            for kind, path in record.get("artifacts", {}).items():
+                artifacts.append((self.run_id, record["dataset_rel"], kind, path))
+
+        with self._lock, self.transaction():
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(RESULT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(RESULT_COLUMNS))})", results)
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO stages ({', '.join(STAGE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(STAGE_COLUMNS))})", stages)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO artifacts (run_id, dataset_rel, kind, path) VALUES (?, ?, ?, ?)",
+                artifacts)
+
+    def write_summary(self, summary_path):
+        """
+        Write summary.txt from the summary view (tab separated, sorted by dataset).
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM summary ORDER BY dataset_id").fetchall()
+        write_summary_file(summary_path, rows)
+
+    def close(self):
+        self.flush()
+        with self._lock, self.transaction():
+            self.conn.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), self.run_id))
+        self.conn.close()
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        # Take the write lock up front so concurrent writers queue on busy_timeout.
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, *exc):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def format_summary_row(row):
+    def fmt(value, spec):
+        return "N/A" if value is None else format(value, spec)
+
+    if row["dimple_ok"] is None:
+        dimple_ok, blobs = "N/A", "N/A"
+    elif row["dimple_ok"]:
+        dimple_ok, blobs = "OK", str(row["blobs"])
+    else:
+        dimple_ok, blobs = "FAILED", "N/A"
+    return "\t".join([
+        row["dataset_id"], row["space_group"], row["resolution"], dimple_ok, blobs,
+        fmt(row["completeness_pct"], ".1f"),
+        fmt(row["multiplicity"], ".1f"),
+        fmt(row["cc_half_outer"], ".3f"),
+        fmt(row["isigi_outer"], ".1f"),
+        fmt(row["rmeas"], ".3f"),
+        row["cell"] or "N/A",
+    ])
+
+
+def write_summary_file(summary_path, rows):
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    tmp = f"{summary_path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        f.write(SUMMARY_HEADER + "\n")
+        for row in rows:
+            f.write(format_summary_row(row) + "\n")
+    os.replace(tmp, summary_path)
+
+
+# ============================================================
+# QUERIES FOR DOWNSTREAM SCRIPTS
+# ============================================================
+
+def latest_results(db_path, summary_only=False):
+    """
+    Latest result of every dataset as a list of dicts, sorted by dataset_id.
+    stats_json is decoded into "stats".
+    """
+    conn = connect_readonly(db_path)
+    try:
+        view = "summary" if summary_only else "latest"
+        rows = conn.execute(f"SELECT * FROM {view} ORDER BY dataset_id").fetchall()
+    finally:
+        conn.close()
+    results = []
+    for row in rows:
+        result = dict(row)
+        result["stats"] = json.loads(result.pop("stats_json")) if row["stats_json"] else None
+        results.append(result)
+    return results
+
+
+def artifacts(db_path, kinds=None):
+    """
+    {dataset_rel: {kind: path}}: for every dataset the newest path of each kind,
+    optionally only for the given kinds. A kind comes from the last run that
+    produced it, so a dimple-only rerun keeps the Merged.mtz of the full run.
+    """
+    conn = connect_readonly(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT a.dataset_rel, a.kind, a.path FROM artifacts a "
+            "JOIN results r ON r.run_id = a.run_id AND r.dataset_rel = a.dataset_rel "
+            "ORDER BY a.dataset_rel, r.finished").fetchall()
+    finally:
+        conn.close()
+    found = {}
+    for dataset_rel, kind, path in rows:
+        if kinds is None or kind in kinds:
+            found.setdefault(dataset_rel, {})[kind] = path
+    return found
+
+
+def artifact_walk(db_path, top, kinds):
+    """
+    (root, dirs, files) tuples like os.walk(top), listing only the given kinds of
+    output files of the datasets below top (newest of each kind, see artifacts()).
+    """
+    top = os.path.abspath(top) + os.sep
+    for found in artifacts(db_path, kinds).values():
+        for path in found.values():
+            if path.startswith(top):
+                yield os.path.dirname(path), [], [os.path.basename(path)]
+
+
+# Run modes that take a dataset through XDS -> CCP4 (-> DIMPLE).
+FULL_CHAIN_MODES = ("full", "quick-look", "watch", "coordinator full")
+
+
+def dataset_runtimes(db_path):
+    """
+    {dataset_rel: seconds} summed over the stages of the latest complete run of
+    every dataset: a full-chain mode, XDS and CCP4 succeeded, no stage skipped
+    as up to date.
+    """
+    conn = connect_readonly(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT s.dataset_rel, SUM(s.wall) FROM stages s "
+            "JOIN results r ON r.run_id = s.run_id AND r.dataset_rel = s.dataset_rel "
+            "JOIN runs u ON u.run_id = r.run_id "
+            f"WHERE u.mode IN ({', '.join('?' * len(FULL_CHAIN_MODES))}) "
+            "AND r.xds_ok = 1 AND r.ccp4_ok = 1 AND r.skipped IS NULL "
+            "GROUP BY s.run_id, s.dataset_rel HAVING SUM(s.stage = 'xds') > 0 "
+            "ORDER BY MAX(r.finished)", FULL_CHAIN_MODES).fetchall()
+    finally:
+        conn.close()
+    return {dataset_rel: wall for dataset_rel, wall in rows if wall}
@@ -0,0 +1,240 @@
+"""
+Durable dataset queue for running crystal_pipeline.py on several hosts at once.
+
+The coordinator puts every dataset of a visit into one SQLite file on the shared
+filesystem; worker processes on any host lease datasets from it, renew their
+leases while they work (heartbeat) and hand back the result record. A dataset
+whose lease runs out (worker killed, host down) is queued again, at most
+MAX_ATTEMPTS times; after that it is marked failed.
+
+The file uses a rollback journal, not WAL: WAL needs shared memory and only
+works when all processes are on one host.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    dataset_rel     TEXT PRIMARY KEY,
+    dataset_json    TEXT NOT NULL,
+    position        INTEGER NOT NULL,
+    state           TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    worker          TEXT,
+    lease_expires   REAL,
+    enqueued        REAL,
+    finished        REAL,
+    ok              INTEGER,
+    record_json     TEXT,
+    imported        INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, position);
+"""
+
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+
+MAX_ATTEMPTS = 3
+BUSY_TIMEOUT_SECONDS = 120
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Connection to the queue file; one per process, usable from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self.transaction() as conn:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front; other processes wait on busy_timeout.
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+    # ------------------------------------------------------------
+    # coordinator
+    # ------------------------------------------------------------
+
+    def enqueue(self, datasets):
+        """
+        Queue datasets (dicts with at least "dataset_rel") in the given order.
+        Datasets already in the queue are queued again unless a worker holds them.
+        Returns the number of datasets queued.
+        """
+        now = time.time()
+        queued = 0
+        with self.transaction() as conn:
+            for position, ds in enumerate(datasets):
+                cur = conn.execute(
+                    "INSERT INTO jobs (dataset_rel, dataset_json, position, state, enqueued) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (dataset_rel) DO UPDATE SET dataset_json = excluded.dataset_json, "
+                    "position = excluded.position, state = excluded.state, attempts = 0, worker = NULL, "
+                    "lease_expires = NULL, enqueued = excluded.enqueued, finished = NULL, ok = NULL, "
+                    "record_json = NULL, imported = 0 "
+                    "WHERE jobs.state != ?",
+                    (ds["dataset_rel"], json.dumps(ds), position, QUEUED, now, LEASED))
+                queued += cur.rowcount
+        return queued
+
+    def requeue_expired(self, max_attempts=MAX_ATTEMPTS):
+        """
+        Queue datasets whose lease ran out again, or fail them after max_attempts leases.
+        Returns (requeued, failed) dataset_rel lists.
+        """
+        now = time.time()
+        requeued, failed = [], []
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT dataset_rel, attempts FROM jobs "
+                                "WHERE state = ? AND lease_expires < ?", (LEASED, now)).fetchall()
+            for row in rows:
+                if row["attempts"] >= max_attempts:
+                    conn.execute("UPDATE jobs SET state = ?, finished = ?, ok = 0 WHERE dataset_rel = ?",
+                                 (FAILED, now, row["dataset_rel"]))
+                    failed.append(row["dataset_rel"])
+                else:
+                    conn.execute("UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL "
+                                 "WHERE dataset_rel = ?", (QUEUED, row["dataset_rel"]))
+                    requeued.append(row["dataset_rel"])
+        return requeued, failed
+
+    def take_finished(self):
+        """
+        Result records of datasets finished since the last call, marked as imported.
+        """
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT dataset_rel, record_json FROM jobs "
+                                "WHERE state = ? AND imported = 0 AND record_json IS NOT NULL",
+                                (DONE,)).fetchall()
+            conn.executemany("UPDATE jobs SET imported = 1 WHERE dataset_rel = ?",
+                             [(row["dataset_rel"],) for row in rows])
+        return [json.loads(row["record_json"]) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update({state: n for state, n in rows})
+        return counts
+
+    def workers(self):
+        """
+        {worker: number of leased datasets} of the workers holding a lease.
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT worker, COUNT(*) FROM jobs WHERE state = ? GROUP BY worker",
+                                     (LEASED,)).fetchall()
+        return dict(rows)
+
+    # ------------------------------------------------------------
+    # worker
+    # ------------------------------------------------------------
+
+    def lease(self, worker, lease_seconds):
+        """
+        Lease the next queued dataset; returns its dict, or None if nothing is queued.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT dataset_rel, dataset_json FROM jobs WHERE state = ? "
+                               "ORDER BY position LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                         "WHERE dataset_rel = ?", (LEASED, worker, now + lease_seconds, row["dataset_rel"]))
+        return json.loads(row["dataset_json"])
+
+    def heartbeat(self, worker, lease_seconds):
+        """
+        Renew all leases of worker; returns the number renewed.
+        """
+        with self.transaction() as conn:
+            cur = conn.execute("UPDATE jobs SET lease_expires = ? WHERE state = ? AND worker = ?",
+                               (time.time() + lease_seconds, LEASED, worker))
+        return cur.rowcount
+
+    def complete(self, worker, dataset_rel, ok, record):
+        """
+        Store the result of a leased dataset. Returns False if worker no longer
+        held the lease (it expired and the dataset was queued again); the result
+        is then dropped.
+        """
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET state = ?, finished = ?, ok = ?, record_json = ?, lease_expires = NULL "
+                "WHERE dataset_rel = ? AND state = ? AND worker = ?",
+                (DONE, time.time(), int(bool(ok)), json.dumps(record), dataset_rel, LEASED, worker))
+        return cur.rowcount == 1
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renew the leases of worker every interval seconds until stopped.
+    """
+
+    def __init__(self, work_queue: WorkQueue, worker, lease_seconds):
+        super().__init__(name="lease-heartbeat", daemon=True)
+        self.work_queue = work_queue
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.interval = max(1.0, lease_seconds / 3)
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                self.work_queue.heartbeat(self.worker, self.lease_seconds)
+            except sqlite3.Error as e:
+                # Try again at the next beat; the lease lasts three intervals.
+                print(f"WARNING: lease heartbeat failed: {e}")
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+def leased_datasets(work_queue: WorkQueue, worker, lease_seconds, poll_seconds, max_attempts=MAX_ATTEMPTS):
+    """
+    Lease datasets one at a time, as the caller asks for the next one. When the
+    queue is empty but other workers still hold leases, wait: an expired lease
+    brings its dataset back (also without a running coordinator). Stops when
+    nothing is queued and no other worker holds a lease.
+    """
+    while True:
+        ds = work_queue.lease(worker, lease_seconds)
+        if ds is not None:
+            yield ds
+            continue
+        others = {w for w in work_queue.workers() if w != worker}
+        if not others:
+            return
+        time.sleep(poll_seconds)
+        work_queue.requeue_expired(max_attempts)
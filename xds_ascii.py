@@ -0,0 +1,341 @@
+"""
+Streaming reader for XDS_ASCII.HKL and a quick quality check before CCP4.
+
+The header is parsed into a dict and the reflection records are read in
+fixed-size byte chunks into structured NumPy arrays (h, k, l, iobs, sigma),
+so the text is never held in memory as a whole. triage() reduces the chunks
+to per-shell statistics (mean I/sigma, multiplicity, completeness estimate)
+and an estimated resolution limit without running any CCP4 program; it keeps
+16 bytes per observation.
+"""
+import re
+from dataclasses import dataclass, field
+
+import numpy as np
+
+CHUNK_BYTES = 8 << 20
+
+END_OF_HEADER = b"!END_OF_HEADER"
+END_OF_DATA = b"!END_OF_DATA"
+
+HEADER_KEY = re.compile(r"([A-Za-z][A-Za-z0-9_()'/,\-]*)=")
+
+REFLECTION_DTYPE = np.dtype([
+    ("h", np.int32), ("k", np.int32), ("l", np.int32),
+    ("iobs", np.float32), ("sigma", np.float32),
+])
+REFLECTION_ITEMS = {
+    "h": "ITEM_H", "k": "ITEM_K", "l": "ITEM_L",
+    "iobs": "ITEM_IOBS", "sigma": "ITEM_SIGMA(IOBS)",
+}
+
+# Lattice centring of the chiral space groups (the only ones macromolecular
+# crystals take); every other space group is counted as primitive.
+CENTRING_FACTOR = {
+    5: 2, 20: 2, 21: 2, 22: 4, 23: 2, 24: 2, 79: 2, 80: 2, 97: 2, 98: 2,
+    146: 3, 155: 3, 196: 4, 197: 2, 199: 2, 209: 4, 210: 4, 211: 2, 214: 2,
+}
+# Trigonal groups with the 2-fold axes along a+b (312 type); other trigonal
+# groups with 2-folds are 321 type.
+LAUE_312_GROUPS = {149, 151, 153, 157, 159, 162, 163}
+
+
+class XdsAsciiError(ValueError):
+    pass
+
+
+# ============================================================
+# READER
+# ============================================================
+
+def parse_header_line(text):
+    """
+    '!KEY1=value KEY2= v1 v2' -> {'KEY1': 'value', 'KEY2': 'v1 v2'}
+    """
+    text = text.lstrip("!")
+    matches = list(HEADER_KEY.finditer(text))
+    fields = {}
+    for m, nxt in zip(matches, matches[1:] + [None]):
+        end = nxt.start() if nxt else len(text)
+        fields[m.group(1)] = text[m.end():end].strip()
+    return fields
+
+
+def read_header(f):
+    """
+    Header fields of an open (binary) XDS_ASCII.HKL; leaves f at the first record.
+    """
+    header = {}
+    for raw in f:
+        if not raw.startswith(b"!"):
+            raise XdsAsciiError("reflection record before !END_OF_HEADER")
+        if raw.startswith(END_OF_HEADER):
+            return header
+        header.update(parse_header_line(raw.decode("ascii", errors="replace").strip()))
+    raise XdsAsciiError("no !END_OF_HEADER")
+
+
+def record_columns(header):
+    try:
+        nitems = int(header["NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD"])
+        columns = {name: int(header[key]) - 1 for name, key in REFLECTION_ITEMS.items()}
+    except (KeyError, ValueError) as e:
+        raise XdsAsciiError(f"incomplete header: {e}") from None
+    return nitems, columns
+
+
+def _to_records(text, nitems, columns):
+    values = np.array(text.split(), dtype=np.float64)
+    if values.size % nitems:
+        raise XdsAsciiError(f"record with other than {nitems} items")
+    values = values.reshape(-1, nitems)
+    out = np.empty(len(values), dtype=REFLECTION_DTYPE)
+    for name, col in columns.items():
+        out[name] = values[:, col]
+    return out
+
+
+def iter_reflections(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Yield (header, records) with records a structured array of up to about
+    chunk_bytes of text each. The header dict is the same object every time.
+    """
+    with open(path, "rb") as f:
+        header = read_header(f)
+        nitems, columns = record_columns(header)
+        partial = b""
+        while True:
+            block = f.read(chunk_bytes)
+            text = partial + block
+            end = text.find(END_OF_DATA)
+            if end >= 0:
+                text, block = text[:end], b""
+            elif block:
+                cut = text.rfind(b"\n") + 1
+                text, partial = text[:cut], text[cut:]
+            if text.strip():
+                yield header, _to_records(text, nitems, columns)
+            if not block:
+                return
+
+
+# ============================================================
+# SYMMETRY / GEOMETRY
+# ============================================================
+
+def _closure(generators):
+    group = {np.eye(3, dtype=np.int64).tobytes(): np.eye(3, dtype=np.int64)}
+    frontier = list(group.values())
+    while frontier:
+        new = []
+        for a in frontier:
+            for g in generators:
+                m = a @ g
+                key = m.tobytes()
+                if key not in group:
+                    group[key] = m
+                    new.append(m)
+        frontier = new
+    return list(group.values())
+
+
+def laue_operators(space_group_number):
+    """
+    Laue group (point group plus inversion) as integer matrices acting on hkl rows.
+    """
+    m = lambda rows: np.array(rows, dtype=np.int64)
+    inversion = m([[-1, 0, 0], [0, -1, 0], [0, 0, -1]])
+    two_a = m([[1, 0, 0], [0, -1, 0], [0, 0, -1]])
+    two_b = m([[-1, 0, 0], [0, 1, 0], [0, 0, -1]])
+    two_c = m([[-1, 0, 0], [0, -1, 0], [0, 0, 1]])
+    four_c = m([[0, 1, 0], [-1, 0, 0], [0, 0, 1]])          # (h,k,l) -> (-k,h,l)
+    three_c = m([[0, -1, 0], [1, -1, 0], [0, 0, 1]])        # (h,k,l) -> (k,-h-k,l)
+    two_321 = m([[0, 1, 0], [1, 0, 0], [0, 0, -1]])         # (h,k,l) -> (k,h,-l)
+    two_312 = m([[0, -1, 0], [-1, 0, 0], [0, 0, -1]])       # (h,k,l) -> (-k,-h,-l)
+    three_diag = m([[0, 0, 1], [1, 0, 0], [0, 1, 0]])       # (h,k,l) -> (k,l,h)
+
+    n = space_group_number
+    if n <= 2:
+        gens = []
+    elif n <= 15:
+        gens = [two_b]
+    elif n <= 74:
+        gens = [two_a, two_b]
+    elif n <= 88:
+        gens = [four_c]
+    elif n <= 142:
+        gens = [four_c, two_a]
+    elif n <= 148:
+        gens = [three_c]
+    elif n <= 167:
+        gens = [three_c, two_312 if n in LAUE_312_GROUPS else two_321]
+    elif n <= 176:
+        gens = [three_c, two_c]
+    elif n <= 194:
+        gens = [three_c, two_c, two_321]
+    elif n <= 206:
+        gens = [two_a, two_b, three_diag]
+    elif n <= 230:
+        gens = [two_a, two_b, three_diag, four_c]
+    else:
+        raise XdsAsciiError(f"space group number {n} out of range")
+    return _closure(gens + [inversion])
+
+
+def reciprocal_metric(cell):
+    a, b, c, alpha, beta, gamma = cell
+    ca, cb, cg = (np.cos(np.radians(x)) for x in (alpha, beta, gamma))
+    g = np.array([
+        [a * a, a * b * cg, a * c * cb],
+        [a * b * cg, b * b, b * c * ca],
+        [a * c * cb, b * c * ca, c * c],
+    ])
+    return np.linalg.inv(g), float(np.sqrt(np.linalg.det(g)))
+
+
+def inverse_d_squared(records, g_star):
+    hkl = np.stack([records["h"], records["k"], records["l"]], axis=1).astype(np.float64)
+    return np.einsum("ij,jk,ik->i", hkl, g_star, hkl)
+
+
+HKL_BITS = 21
+HKL_OFFSET = 1 << (HKL_BITS - 1)
+
+
+def unique_keys(records, operators):
+    """
+    One int64 per reflection, equal for symmetry-equivalent indices.
+    """
+    hkl = np.stack([records["h"], records["k"], records["l"]], axis=1).astype(np.int64)
+    best = None
+    for op in operators:
+        e = hkl @ op + HKL_OFFSET
+        key = (e[:, 0] << (2 * HKL_BITS)) | (e[:, 1] << HKL_BITS) | e[:, 2]
+        best = key if best is None else np.maximum(best, key)
+    return best
+
+
+# ============================================================
+# TRIAGE
+# ============================================================
+
+@dataclass
+class Shell:
+    d_low: float
+    d_high: float
+    n_obs: int
+    n_unique: int
+    n_expected: float
+    mean_isigi: float | None
+
+    @property
+    def multiplicity(self):
+        return self.n_obs / self.n_unique if self.n_unique else 0.0
+
+    @property
+    def completeness(self):
+        return min(1.0, self.n_unique / self.n_expected) if self.n_expected else None
+
+    @property
+    def merged_isigi(self):
+        """
+        <I/sigma> of the observations scaled by sqrt(multiplicity): what aimless
+        would roughly report for merged intensities.
+        """
+        if self.mean_isigi is None:
+            return None
+        return self.mean_isigi * self.multiplicity ** 0.5
+
+
+@dataclass
+class TriageResult:
+    space_group_number: int
+    cell: tuple
+    n_obs: int
+    n_unique: int
+    shells: list = field(default_factory=list)
+    resolution_estimate: float | None = None
+
+    @property
+    def completeness(self):
+        expected = sum(s.n_expected for s in self.shells)
+        return min(1.0, self.n_unique / expected) if expected else None
+
+
+def header_symmetry(header):
+    try:
+        sg = int(header["SPACE_GROUP_NUMBER"])
+        cell = tuple(float(v) for v in header["UNIT_CELL_CONSTANTS"].split()[:6])
+    except (KeyError, ValueError) as e:
+        raise XdsAsciiError(f"no usable space group / cell in header: {e}") from None
+    if len(cell) != 6:
+        raise XdsAsciiError("UNIT_CELL_CONSTANTS needs six values")
+    return sg, cell
+
+
+def triage(path, n_shells=20, isigi_cutoff=1.5, chunk_bytes=CHUNK_BYTES):
+    """
+    Per-shell statistics and a resolution estimate from XDS_ASCII.HKL.
+
+    Shells have equal reciprocal volume. The resolution estimate is the high
+    edge of the last shell, counting out from low resolution, whose estimated
+    merged I/sigma is at least isigi_cutoff. Rejected observations (sigma <= 0)
+    are ignored. Completeness is estimated from the cell volume and the Laue
+    group order (systematic absences are not subtracted).
+    """
+    sg = cell = None
+    s2_all, isigi_all, keys_all = [], [], []
+    for header, records in iter_reflections(path, chunk_bytes):
+        if sg is None:
+            sg, cell = header_symmetry(header)
+            g_star, volume = reciprocal_metric(cell)
+            operators = laue_operators(sg)
+        records = records[records["sigma"] > 0]
+        if not len(records):
+            continue
+        s2_all.append(inverse_d_squared(records, g_star).astype(np.float32))
+        isigi_all.append(records["iobs"] / records["sigma"])
+        keys_all.append(unique_keys(records, operators))
+
+    if sg is None:
+        with open(path, "rb") as f:
+            sg, cell = header_symmetry(read_header(f))
+        return TriageResult(sg, cell, 0, 0)
+    if not s2_all:
+        return TriageResult(sg, cell, 0, 0)
+
+    s2 = np.concatenate(s2_all)
+    isigi = np.concatenate(isigi_all)
+    keys = np.concatenate(keys_all)
+    del s2_all, isigi_all, keys_all
+
+    s_max = float(np.sqrt(s2.max()))
+    s_min = float(np.sqrt(max(s2.min(), 0.0)))
+    # Equal-volume shells: edges evenly spaced in s^3.
+    edges = np.cbrt(np.linspace(s_min ** 3, s_max ** 3, n_shells + 1))
+    shell = np.clip(np.searchsorted(edges, np.sqrt(s2), side="right") - 1, 0, n_shells - 1)
+
+    n_obs = np.bincount(shell, minlength=n_shells)
+    isigi_sum = np.bincount(shell, weights=isigi, minlength=n_shells)
+    uniq, first = np.unique(keys, return_index=True)
+    n_unique = np.bincount(shell[first], minlength=n_shells)
+
+    lattice_points = len(operators) * CENTRING_FACTOR.get(sg, 1)
+    n_expected = 4.0 / 3.0 * np.pi * np.diff(edges ** 3) * volume / lattice_points
+
+    result = TriageResult(sg, cell, int(len(s2)), int(len(uniq)))
+    for i in range(n_shells):
+        result.shells.append(Shell(
+            d_low=1.0 / edges[i] if edges[i] > 0 else float("inf"),
+            d_high=1.0 / edges[i + 1],
+            n_obs=int(n_obs[i]),
+            n_unique=int(n_unique[i]),
+            n_expected=float(n_expected[i]),
+            mean_isigi=float(isigi_sum[i] / n_obs[i]) if n_obs[i] else None,
+        ))
+
+    for s in result.shells:
+        if s.merged_isigi is None or s.merged_isigi < isigi_cutoff:
+            break
+        result.resolution_estimate = s.d_high
+    return result